@@ -3,7 +3,7 @@ Configuration management for DiffRhythm API
 """
 import os
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 
 
 class Settings:
@@ -27,6 +27,95 @@ class Settings:
     # Task settings
     MAX_TASK_AGE_SECONDS: int = 86400  # 24 hours
     
+    # Inference worker
+    MAX_QUEUE_SIZE: int = int(os.getenv("MAX_QUEUE_SIZE", "16"))
+    WORKER_CONCURRENCY: int = int(os.getenv("WORKER_CONCURRENCY", "1"))
+    QUEUE_RETRY_AFTER_SECONDS: int = int(os.getenv("QUEUE_RETRY_AFTER_SECONDS", "60"))
+    PRELOAD_AUDIO_LENGTH: int = int(os.getenv("PRELOAD_AUDIO_LENGTH", "95"))
+    MAX_BATCH_SIZE: int = int(os.getenv("MAX_BATCH_SIZE", "4"))
+    MAX_BATCH_WAIT_SECONDS: float = float(os.getenv("MAX_BATCH_WAIT_SECONDS", "0.5"))
+    # Iteration-level batching: generation jobs join the running batch between sampling steps
+    # and leave it when done, up to MAX_BATCH_SIZE rows (Euler steps with batched guidance)
+    CONTINUOUS_BATCHING: bool = os.getenv("CONTINUOUS_BATCHING", "False").lower() == "true"
+    # Preemption: a continuous batch of long songs is suspended between two sampling steps for
+    # queued 95s jobs that would otherwise take longer than SHORT_JOB_SLO_SECONDS from submission
+    # to the end of sampling; keeps the models of both lengths loaded
+    PREEMPTION: bool = os.getenv("PREEMPTION", "False").lower() == "true"
+    SHORT_JOB_SLO_SECONDS: float = float(os.getenv("SHORT_JOB_SLO_SECONDS", "60"))
+    # Queue order: "fifo", or "sjf" (shortest predicted run time first, minus SJF_AGING x seconds waited)
+    SCHEDULING_POLICY: str = os.getenv("SCHEDULING_POLICY", "fifo")
+    SJF_AGING: float = float(os.getenv("SJF_AGING", "1.0"))
+    # Cost model coefficients, loaded at startup and saved as they follow measured run times,
+    # and infer/benchmark.py --json results to start from
+    COST_MODEL_PATH: Optional[str] = os.getenv("COST_MODEL_PATH") or None
+    COST_BENCHMARK_PATHS: List[str] = [p for p in os.getenv("COST_BENCHMARK_PATHS", "").split(",") if p]
+    
+    # CPU execution profile: dtype ("auto": bfloat16 with AMX, else float32), intra-op threads
+    # per worker (0: the worker's share of the CPUs), inter-op threads, and pinning workers to CPUs
+    CPU_DTYPE: str = os.getenv("CPU_DTYPE", "auto")
+    CPU_THREADS: int = int(os.getenv("CPU_THREADS", "0"))
+    CPU_INTEROP_THREADS: int = int(os.getenv("CPU_INTEROP_THREADS", "1"))
+    CPU_AFFINITY: bool = os.getenv("CPU_AFFINITY", "True").lower() == "true"
+    
+    # Sampling
+    BATCH_CFG: bool = os.getenv("BATCH_CFG", "True").lower() == "true"
+    SAMPLING_STEPS: int = int(os.getenv("SAMPLING_STEPS", "32"))
+    SAMPLING_SOLVER: str = os.getenv("SAMPLING_SOLVER", "euler")
+    # SAMPLING_SOLVER=picard: steps solved together in one batched forward, and the update below which a step is final
+    PICARD_WINDOW: int = int(os.getenv("PICARD_WINDOW", "8"))
+    PICARD_TOLERANCE: float = float(os.getenv("PICARD_TOLERANCE", "1e-3"))
+    SAMPLING_SCHEDULE: str = os.getenv("SAMPLING_SCHEDULE", "linear")
+    SWAY_SAMPLING_COEF: Optional[float] = (
+        float(os.environ["SWAY_SAMPLING_COEF"]) if os.getenv("SWAY_SAMPLING_COEF") else None
+    )
+    # Guidance only for t in "lo,hi", and the unconditional branch only every k guided steps
+    CFG_INTERVAL: Optional[Tuple[float, float]] = (
+        tuple(float(v) for v in os.environ["CFG_INTERVAL"].split(",")) if os.getenv("CFG_INTERVAL") else None
+    )
+    CFG_CACHE_STEPS: int = int(os.getenv("CFG_CACHE_STEPS", "1"))
+    # Full DiT forward every k model calls, only the first DEEP_CACHE_DEPTH blocks in between
+    DEEP_CACHE_INTERVAL: int = int(os.getenv("DEEP_CACHE_INTERVAL", "1"))
+    DEEP_CACHE_DEPTH: Optional[int] = (
+        int(os.environ["DEEP_CACHE_DEPTH"]) if os.getenv("DEEP_CACHE_DEPTH") else None
+    )
+    
+    # Attention over chunks of this many frames (exact), bounds attention memory for long songs
+    ATTN_CHUNK_SIZE: Optional[int] = (
+        int(os.environ["ATTN_CHUNK_SIZE"]) if os.getenv("ATTN_CHUNK_SIZE") else None
+    )
+    # Token merging: fraction of the frames merged into a neighbour in each DiT block,
+    # one value for all blocks or one per block; lyric frames are never merged
+    TOKEN_MERGE_RATIO: Optional[List[float]] = (
+        [float(r) for r in os.environ["TOKEN_MERGE_RATIO"].split(",")] if os.getenv("TOKEN_MERGE_RATIO") else None
+    )
+    
+    # Progressive preview: every k model evaluations the first PREVIEW_SECONDS of the current
+    # estimate of the song are decoded and served at /api/preview/{task_id} (0: no previews)
+    PREVIEW_INTERVAL: int = int(os.getenv("PREVIEW_INTERVAL", "0"))
+    PREVIEW_SECONDS: float = float(os.getenv("PREVIEW_SECONDS", "30"))
+    
+    # Compiled inference: the DiT is compiled with torch.compile and song lengths are padded
+    # to COMPILE_BUCKETS frames, which are compiled at startup when COMPILE_WARMUP is set
+    COMPILE_MODEL: bool = os.getenv("COMPILE_MODEL", "False").lower() == "true"
+    COMPILE_MODE: Optional[str] = os.getenv("COMPILE_MODE") or None
+    COMPILE_BUCKETS: List[int] = [
+        int(b) for b in os.getenv("COMPILE_BUCKETS", "2048,2560,3072,3584,4096,4608,5120,5632,6144").split(",")
+    ]
+    COMPILE_WARMUP: bool = os.getenv("COMPILE_WARMUP", "True").lower() == "true"
+    
+    # INT8 DiT for CPU inference: converted at load time, or loaded from an artifact saved by
+    # infer/quantize.py ("{max_frames}" is replaced by 2048 or 6144)
+    QUANTIZE_MODEL: bool = os.getenv("QUANTIZE_MODEL", "False").lower() == "true"
+    QUANTIZED_MODEL_PATH: Optional[str] = os.getenv("QUANTIZED_MODEL_PATH") or None
+    
+    # Weight streaming for low-memory nodes: GB of DiT block weights kept on the device (unset: all,
+    # 0: none), the other blocks are streamed in per call from host memory or from STREAM_PATH
+    # ("{max_frames}" is replaced by 2048 or 6144), a file memory-mapped and written on first use
+    STREAM_BUDGET_GB: Optional[float] = (
+        float(os.environ["STREAM_BUDGET_GB"]) if os.getenv("STREAM_BUDGET_GB") else None
+    )
+    STREAM_PATH: Optional[str] = os.getenv("STREAM_PATH") or None
+    
     # DiffRhythm settings
     DIFFRHYTHM_BASE_DIR: Path = BASE_DIR
     
@@ -0,0 +1,152 @@
+"""
+Device execution profiles
+Pick the model dtype per device and the CPU threading layout of the inference workers
+"""
+import logging
+import os
+import threading
+from typing import List, Optional
+
+import torch
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+def cpu_flags() -> set:
+    """CPU feature flags from /proc/cpuinfo (empty where unavailable)"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def cpu_supports_bf16() -> bool:
+    """Check for AMX bf16 tiles, the only CPUs where bf16 matmuls beat float32"""
+    return "amx_bf16" in cpu_flags()
+
+
+def available_cpus() -> List[int]:
+    """CPUs this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class DeviceProfile:
+    """Dtype and threading settings for one device"""
+
+    def __init__(
+        self,
+        device: str,
+        dtype: torch.dtype,
+        num_threads: Optional[int] = None,
+        interop_threads: Optional[int] = None,
+        worker_cpus: Optional[List[List[int]]] = None,
+        bf16_supported: bool = False,
+    ):
+        """
+        Args:
+            device: Torch device name
+            dtype: Dtype the CFM model runs in
+            num_threads: Intra-op threads per worker (CPU only)
+            interop_threads: Inter-op threads of the process (CPU only)
+            worker_cpus: CPUs each worker thread is pinned to (CPU only, None: no pinning)
+            bf16_supported: Whether the CPU has AMX bf16 support
+        """
+        self.device = device
+        self.dtype = dtype
+        self.num_threads = num_threads
+        self.interop_threads = interop_threads
+        self.worker_cpus = worker_cpus
+        self.bf16_supported = bf16_supported
+
+    def apply(self):
+        """Apply process wide settings, call once before the models are loaded"""
+        if self.interop_threads:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError as e:
+                # can only be set before the first inter-op parallel work
+                logger.warning(f"Could not set inter-op threads: {str(e)}")
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+    def apply_to_worker(self, index: int):
+        """
+        Apply per worker settings, call from the worker thread itself
+
+        Args:
+            index: Worker index, selects the CPU set the thread is pinned to
+        """
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        if self.worker_cpus and hasattr(os, "sched_setaffinity"):
+            cpus = self.worker_cpus[index % len(self.worker_cpus)]
+            # the native thread id pins this thread only, threads it starts inherit the set
+            os.sched_setaffinity(threading.get_native_id(), cpus)
+            logger.info(f"Pinned inference worker {index} to CPUs {cpus}")
+
+    def to_dict(self) -> dict:
+        """Profile summary for the health endpoint"""
+        return {
+            "device": self.device,
+            "dtype": str(self.dtype).replace("torch.", ""),
+            "num_threads": self.num_threads,
+            "interop_threads": self.interop_threads,
+            "worker_cpus": self.worker_cpus,
+            "bf16_supported": self.bf16_supported,
+        }
+
+
+def select_device_profile(device: str, workers: int = 1) -> DeviceProfile:
+    """
+    Choose the execution profile for a device
+
+    GPUs run in float16. CPUs run in bfloat16 when they have AMX, else in float32
+    (half precision matmuls are slow and fragile there), unless CPU_DTYPE is set.
+    The CPUs are split evenly between the workers.
+
+    Args:
+        device: Torch device name
+        workers: Number of inference worker threads
+
+    Returns:
+        The device profile
+    """
+    if device != "cpu":
+        return DeviceProfile(device, torch.float16)
+
+    bf16_supported = cpu_supports_bf16()
+    if settings.CPU_DTYPE == "auto":
+        dtype = torch.bfloat16 if bf16_supported else torch.float32
+    else:
+        dtype = DTYPES[settings.CPU_DTYPE]
+
+    cpus = available_cpus()
+    workers = max(1, workers)
+    per_worker = max(1, len(cpus) // workers)
+    num_threads = settings.CPU_THREADS or per_worker
+
+    worker_cpus = None
+    if settings.CPU_AFFINITY and len(cpus) >= workers:
+        worker_cpus = [cpus[i * per_worker:(i + 1) * per_worker] for i in range(workers)]
+
+    return DeviceProfile(
+        device,
+        dtype,
+        num_threads=num_threads,
+        interop_threads=settings.CPU_INTEROP_THREADS or None,
+        worker_cpus=worker_cpus,
+        bf16_supported=bf16_supported,
+    )
@@ -5,8 +5,9 @@ Wraps the existing infer.py functionality for API use
 import os
 import sys
 import logging
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import Callable, List, Optional
 
 # Add parent directory to path to import DiffRhythm modules
 sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -14,23 +15,62 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 import torch
 import torchaudio
 from config import settings
+from device_profile import select_device_profile
 
 logger = logging.getLogger(__name__)
 
 
+def get_max_frames(audio_length: int) -> int:
+    """
+    Map an audio length to the frame budget of the model that serves it
+    
+    Args:
+        audio_length: Audio length in seconds
+        
+    Returns:
+        2048 for the 95s model, 6144 for the full-length model
+    """
+    if audio_length == 95:
+        return 2048
+    elif 95 < audio_length <= 285:
+        return 6144
+    else:
+        raise ValueError(
+            f"Invalid audio_length: {audio_length}. "
+            "Supported values are exactly 95 or any value between 96 and 285 (inclusive)."
+        )
+
+
+def solver_options() -> Optional[dict]:
+    """Options of the configured sampling solver"""
+    if settings.SAMPLING_SOLVER == "picard":
+        return {"window": settings.PICARD_WINDOW, "tol": settings.PICARD_TOLERANCE}
+    return None
+
+
 class DiffRhythmInference:
     """Wrapper around DiffRhythm inference functionality"""
     
-    def __init__(self):
-        """Initialize the inference engine"""
+    def __init__(self, workers: int = 1):
+        """
+        Initialize the inference engine
+        
+        Args:
+            workers: Number of worker threads sharing the engine, the CPUs are split between them
+        """
         self.device = self._get_device()
+        self.profile = select_device_profile(self.device, workers)
+        self.profile.apply()
+        self.dtype = self.profile.dtype
         self.cfm = None
         self.vae = None
         self.tokenizer = None
         self.muq = None
         self.max_frames = None
+        self._resident_cfms = {}  # max_frames -> cfm, models kept loaded for preemption
+        self._model_lock = threading.Lock()
         
-        logger.info(f"Using device: {self.device}")
+        logger.info(f"Using device: {self.device}, profile: {self.profile.to_dict()}")
     
     def _get_device(self) -> str:
         """Determine the best available device"""
@@ -41,38 +81,137 @@ class DiffRhythmInference:
         else:
             return "cpu"
     
-    def _initialize_models(self, audio_length: int):
+    def _initialize_models(self, audio_length: int) -> tuple:
         """
         Initialize models if not already initialized
         
+        Worker threads share the engine and another job may switch the model at
+        any time, so a job works with the snapshot returned here, never with
+        self.cfm or self.max_frames.
+        
         Args:
             audio_length: Audio length in seconds to determine model size
+            
+        Returns:
+            (cfm, max_frames) of the model for that length
         """
         # Determine max_frames based on audio length
-        if audio_length == 95:
-            max_frames = 2048
-        elif 95 < audio_length <= 285:
-            max_frames = 6144
-        else:
-            raise ValueError(
-                f"Invalid audio_length: {audio_length}. "
-                "Supported values are exactly 95 or any value between 96 and 285 (inclusive)."
-            )
+        max_frames = get_max_frames(audio_length)
         
         # Initialize models if needed or if max_frames changed
+        with self._model_lock:
+            self._switch_models(max_frames)
+            return self.cfm, self.max_frames
+    
+    def _switch_models(self, max_frames: int):
+        """Load the CFM model for max_frames, called with the model lock held"""
         if self.cfm is None or self.max_frames != max_frames:
+            if max_frames in self._resident_cfms:
+                self.cfm = self._resident_cfms[max_frames]
+                self.max_frames = max_frames
+                return
+            
             logger.info(f"Initializing models with max_frames={max_frames}")
             
             # Import DiffRhythm modules
-            from infer.infer_utils import prepare_model
+            from infer.infer_utils import prepare_cfm_model, prepare_model
             
             self.max_frames = max_frames
-            self.cfm, self.tokenizer, self.muq, self.vae = prepare_model(
-                max_frames, self.device
-            )
+            quantized_path = None
+            if settings.QUANTIZED_MODEL_PATH:
+                quantized_path = settings.QUANTIZED_MODEL_PATH.format(max_frames=max_frames)
+            stream_budget = stream_path = None
+            if settings.STREAM_BUDGET_GB is not None:
+                stream_budget = int(settings.STREAM_BUDGET_GB * 1024**3)
+            if settings.STREAM_PATH:
+                stream_path = settings.STREAM_PATH.format(max_frames=max_frames)
+            if self.vae is None:
+                self.cfm, self.tokenizer, self.muq, self.vae = prepare_model(
+                    max_frames, self.device, dtype=self.dtype,
+                    quantize=settings.QUANTIZE_MODEL, quantized_path=quantized_path,
+                    stream_budget=stream_budget, stream_path=stream_path,
+                )
+            else:
+                # tokenizer, MuQ and VAE are shared by both models
+                self.cfm = None
+                self.cfm = prepare_cfm_model(
+                    max_frames, self.device, dtype=self.dtype,
+                    quantize=settings.QUANTIZE_MODEL, quantized_path=quantized_path,
+                    stream_budget=stream_budget, stream_path=stream_path,
+                )
+            if settings.COMPILE_MODEL:
+                self._compile_model()
+            if settings.PREEMPTION:
+                # short jobs preempt long ones, so both models stay loaded
+                self._resident_cfms[max_frames] = self.cfm
             
             logger.info("Models initialized successfully")
     
+    def _compile_model(self):
+        """Compile the DiT and, if enabled, compile every length bucket ahead of the first request"""
+        self.cfm.compile_for_inference(buckets=settings.COMPILE_BUCKETS, mode=settings.COMPILE_MODE)
+        if settings.TOKEN_MERGE_RATIO is not None:
+            logger.warning("TOKEN_MERGE_RATIO is ignored by the compiled model")
+        if not settings.COMPILE_WARMUP:
+            return
+        
+        logger.info(f"Warming up compiled model for length buckets {self.cfm.length_buckets}...")
+        with torch.inference_mode():
+            self.cfm.warmup(
+                batch_cfg=settings.BATCH_CFG,
+                cfg_interval=settings.CFG_INTERVAL,
+                cfg_cache_steps=settings.CFG_CACHE_STEPS,
+                deep_cache_interval=settings.DEEP_CACHE_INTERVAL,
+                deep_cache_depth=settings.DEEP_CACHE_DEPTH,
+                attn_chunk_size=settings.ATTN_CHUNK_SIZE
+            )
+    
+    def load_models(self, audio_length: int):
+        """
+        Load the models for an audio length ahead of the first request
+        
+        Args:
+            audio_length: Audio length in seconds to determine model size
+        """
+        self._initialize_models(audio_length)
+    
+    def _preview_callback(self, outputs: List[tuple], on_preview: Optional[Callable] = None):
+        """
+        Build the sampling callback that writes previews while a batch is sampled
+        
+        Args:
+            outputs: (batch row, frames, output directory) of each song that gets a preview
+            on_preview: Called as on_preview(index, preview_path, t) after each preview is written,
+                index being the position in outputs and t the flow time from 0 (noise) to 1
+            
+        Returns:
+            The callback for CFM.sample, or None if previews are disabled
+        """
+        if settings.PREVIEW_INTERVAL <= 0:
+            return None
+        
+        from infer.infer import preview_audio
+        
+        preview_frames = int(settings.PREVIEW_SECONDS * 44100 / 2048)
+        
+        def save_previews(evals, t, latents):
+            for index, (row, frames, output_dir) in enumerate(outputs):
+                try:
+                    preview = preview_audio(latents[row:row + 1, :frames], self.vae, max_frames=preview_frames)
+                    os.makedirs(output_dir, exist_ok=True)
+                    preview_path = os.path.join(output_dir, "preview.wav")
+                    # written next to the old preview and swapped in, so downloads never see a partial file
+                    tmp_path = os.path.join(output_dir, "preview.tmp.wav")
+                    torchaudio.save(tmp_path, preview, sample_rate=44100)
+                    os.replace(tmp_path, preview_path)
+                    if on_preview:
+                        on_preview(index, preview_path, t)
+                except Exception as e:
+                    # a failed preview must not fail the song
+                    logger.warning(f"Could not write preview to {output_dir}: {str(e)}")
+        
+        return save_previews
+    
     def generate(
         self,
         lrc_path: str,
@@ -98,77 +237,251 @@ class DiffRhythmInference:
         Returns:
             Path to generated audio file
         """
+        return self.generate_batch([
+            {
+                "lrc_path": lrc_path,
+                "ref_audio_path": ref_audio_path,
+                "ref_prompt": ref_prompt,
+                "audio_length": audio_length,
+                "output_dir": output_dir,
+                "chunked": chunked,
+                "batch_infer_num": batch_infer_num,
+            }
+        ])[0]
+    
+    def _prepare_request(self, request: dict, max_frames: int) -> tuple:
+        """
+        Tokenize the lyrics and embed the style of a generation request
+        
+        Args:
+            request: Dictionary with the keyword arguments of generate()
+            max_frames: max_frames of the model the request is sampled with
+            
+        Returns:
+            lrc_prompt, start_time, end_frame, song_duration, style_prompt
+        """
+        from infer.infer_utils import get_lrc_token, get_style_prompt
+        
+        # Load lyrics
+        with open(request["lrc_path"], "r", encoding='utf-8') as f:
+            lrc = f.read()
+        
+        # Get LRC tokens
+        lrc_prompt, start_time, end_frame, song_duration = get_lrc_token(
+            max_frames, lrc, self.tokenizer, request["audio_length"], self.device, dtype=self.dtype
+        )
+        
+        # Get style prompt
+        if request.get("ref_audio_path"):
+            style_prompt = get_style_prompt(self.muq, request["ref_audio_path"], dtype=self.dtype)
+        else:
+            style_prompt = get_style_prompt(self.muq, prompt=request.get("ref_prompt"), dtype=self.dtype)
+        
+        return lrc_prompt, start_time, end_frame, song_duration, style_prompt
+    
+    def generate_batch(self, requests: List[dict], on_preview: Optional[Callable] = None) -> List[str]:
+        """
+        Generate music for several requests in a single sampling call
+        
+        All requests must map to the same max_frames; songs of different
+        lengths are padded and masked inside the batch. Each request
+        contributes batch_infer_num rows to the batch and gets one of its own
+        rows back.
+        
+        Args:
+            requests: List of dictionaries with the keyword arguments of generate()
+            on_preview: Called as on_preview(request_index, preview_path, t) for each
+                preview written while sampling (see PREVIEW_INTERVAL)
+            
+        Returns:
+            Paths to the generated audio files, in request order
+        """
         try:
+            if len({get_max_frames(request["audio_length"]) for request in requests}) != 1:
+                raise ValueError("All requests in a batch must use the same model")
+            
             # Initialize models
-            self._initialize_models(audio_length)
+            cfm, max_frames = self._initialize_models(requests[0]["audio_length"])
             
             # Import inference utilities
             from infer.infer_utils import (
-                get_lrc_token,
-                get_style_prompt,
                 get_negative_style_prompt,
                 get_reference_latent,
-                decode_audio,
             )
-            from infer.infer import inference
-            from einops import rearrange
+            from infer.infer import batch_inference
+            from torch.nn.utils.rnn import pad_sequence
             import random
             
-            # Load lyrics
-            with open(lrc_path, "r", encoding='utf-8') as f:
-                lrc = f.read()
-            
-            # Get LRC tokens
-            lrc_prompt, start_time, end_frame, song_duration = get_lrc_token(
-                self.max_frames, lrc, self.tokenizer, audio_length, self.device
-            )
+            texts, style_prompts, start_times, song_durations = [], [], [], []
+            end_frames, chunked, owners = [], [], []
+            for i, request in enumerate(requests):
+                lrc_prompt, start_time, end_frame, song_duration, style_prompt = self._prepare_request(
+                    request, max_frames
+                )
+                
+                for _ in range(request.get("batch_infer_num", 1)):
+                    texts.append(lrc_prompt[0])
+                    end_frames.append(end_frame)
+                    style_prompts.append(style_prompt)
+                    start_times.append(start_time)
+                    song_durations.append(song_duration)
+                    chunked.append(request.get("chunked", True))
+                    owners.append(i)
             
-            # Get style prompt
-            if ref_audio_path:
-                style_prompt = get_style_prompt(self.muq, ref_audio_path)
-            else:
-                style_prompt = get_style_prompt(self.muq, prompt=ref_prompt)
+            batch = len(owners)
             
             # Get negative style prompt
-            negative_style_prompt = get_negative_style_prompt(self.device)
+            negative_style_prompt = get_negative_style_prompt(self.device, dtype=self.dtype)
             
             # Get reference latent (no edit mode)
             latent_prompt, pred_frames = get_reference_latent(
-                self.device, self.max_frames, False, None, None, self.vae
+                self.device, max_frames, False, None, None, self.vae
+            )
+            
+            # Preview the first row of each request
+            preview_callback = self._preview_callback(
+                [(owners.index(i), end_frames[owners.index(i)], request["output_dir"]) for i, request in enumerate(requests)],
+                on_preview
             )
             
             # Run inference
-            logger.info("Running music generation inference...")
-            generated_songs = inference(
-                cfm_model=self.cfm,
+            logger.info(f"Running music generation inference for {len(requests)} request(s), batch size {batch}...")
+            generated_songs = batch_inference(
+                cfm_model=cfm,
                 vae_model=self.vae,
-                cond=latent_prompt,
-                text=lrc_prompt,
-                duration=end_frame,
-                style_prompt=style_prompt,
-                negative_style_prompt=negative_style_prompt,
-                start_time=start_time,
+                cond=latent_prompt.expand(batch, -1, -1),
+                text=pad_sequence(texts, batch_first=True, padding_value=0),
+                duration=end_frames,
+                style_prompt=torch.cat(style_prompts),
+                negative_style_prompt=negative_style_prompt.expand(batch, -1),
+                start_time=torch.cat(start_times),
                 pred_frames=pred_frames,
                 chunked=chunked,
-                batch_infer_num=batch_infer_num,
-                song_duration=song_duration
+                song_duration=torch.cat(song_durations),
+                batch_cfg=settings.BATCH_CFG,
+                steps=settings.SAMPLING_STEPS,
+                solver=settings.SAMPLING_SOLVER,
+                solver_options=solver_options(),
+                schedule=settings.SAMPLING_SCHEDULE,
+                sway_sampling_coef=settings.SWAY_SAMPLING_COEF,
+                cfg_interval=settings.CFG_INTERVAL,
+                cfg_cache_steps=settings.CFG_CACHE_STEPS,
+                deep_cache_interval=settings.DEEP_CACHE_INTERVAL,
+                deep_cache_depth=settings.DEEP_CACHE_DEPTH,
+                attn_chunk_size=settings.ATTN_CHUNK_SIZE,
+                merge_ratio=settings.TOKEN_MERGE_RATIO,
+                preview_callback=preview_callback,
+                preview_interval=settings.PREVIEW_INTERVAL
             )
             
-            # Select one song from the batch
-            generated_song = random.sample(generated_songs, 1)[0]
+            output_paths = []
+            for i, request in enumerate(requests):
+                # Select one song from the request's rows
+                songs = [song for song, owner in zip(generated_songs, owners) if owner == i]
+                generated_song = random.sample(songs, 1)[0]
+                
+                # Save output
+                os.makedirs(request["output_dir"], exist_ok=True)
+                output_path = os.path.join(request["output_dir"], "output.wav")
+                torchaudio.save(output_path, generated_song, sample_rate=44100)
+                
+                logger.info(f"Music generated successfully: {output_path}")
+                output_paths.append(output_path)
             
-            # Save output
-            os.makedirs(output_dir, exist_ok=True)
-            output_path = os.path.join(output_dir, "output.wav")
-            torchaudio.save(output_path, generated_song, sample_rate=44100)
-            
-            logger.info(f"Music generated successfully: {output_path}")
-            return output_path
+            return output_paths
             
         except Exception as e:
             logger.error(f"Error during music generation: {str(e)}")
             raise
     
+    def continuous_sampler(self, audio_length: int, max_batch_size: int):
+        """
+        Create a sampler for iteration-level batching of generation requests
+        
+        Songs join the running batch between two sampling steps and leave it as
+        soon as they are done, see model/continuous.py. It samples with Euler
+        steps and batched guidance whatever SAMPLING_SOLVER and BATCH_CFG say.
+        
+        Args:
+            audio_length: Audio length in seconds, selects the model
+            max_batch_size: Maximum number of songs sampled at once
+            
+        Returns:
+            ContinuousBatchSampler for the model of that length
+        """
+        from model.continuous import ContinuousBatchSampler
+        
+        cfm, _ = self._initialize_models(audio_length)
+        return ContinuousBatchSampler(
+            cfm,
+            max_batch_size=max_batch_size,
+            steps=settings.SAMPLING_STEPS,
+            schedule=settings.SAMPLING_SCHEDULE,
+            sway_sampling_coef=settings.SWAY_SAMPLING_COEF,
+            attn_chunk_size=settings.ATTN_CHUNK_SIZE,
+            merge_ratio=settings.TOKEN_MERGE_RATIO
+        )
+    
+    def add_to_sampler(self, sampler, request: dict, tag=None) -> list:
+        """
+        Add a generation request to a running continuous sampler
+        
+        Args:
+            sampler: Sampler from continuous_sampler(), for the model of this request's length
+            request: Dictionary with the keyword arguments of generate()
+            tag: Tag of the request's slots, to recognize them when they finish
+            
+        Returns:
+            The request's slots, batch_infer_num of them
+        """
+        from infer.infer_utils import get_negative_style_prompt, get_reference_latent
+        
+        # the sampler's model, the engine may have switched to the other one since
+        max_frames = sampler.cfm.max_frames
+        if get_max_frames(request["audio_length"]) != max_frames:
+            raise ValueError("The request does not use the sampler's model")
+        
+        lrc_prompt, start_time, end_frame, song_duration, style_prompt = self._prepare_request(request, max_frames)
+        negative_style_prompt = get_negative_style_prompt(self.device, dtype=self.dtype)
+        latent_prompt, pred_frames = get_reference_latent(
+            self.device, max_frames, False, None, None, self.vae
+        )
+        
+        return [
+            sampler.add(
+                latent_prompt[0], lrc_prompt[0], end_frame, style_prompt[0], negative_style_prompt[0],
+                start_time[0], song_duration[0], pred_frames, tag=tag
+            )
+            for _ in range(request.get("batch_infer_num", 1))
+        ]
+    
+    def save_song(self, request: dict, latents: List[torch.Tensor]) -> str:
+        """
+        Decode one of a request's sampled songs and save it
+        
+        Args:
+            request: Dictionary with the keyword arguments of generate()
+            latents: Sampled latents of the request's rows, [frames, channels] each
+            
+        Returns:
+            Path to the generated audio file
+        """
+        from infer.infer import postprocess_latent
+        import random
+        
+        # Select one song, only that one is decoded
+        latent = random.sample(latents, 1)[0]
+        with torch.inference_mode():
+            generated_song = postprocess_latent(latent[None], self.vae, chunked=request.get("chunked", True))
+        
+        # Save output
+        os.makedirs(request["output_dir"], exist_ok=True)
+        output_path = os.path.join(request["output_dir"], "output.wav")
+        torchaudio.save(output_path, generated_song, sample_rate=44100)
+        
+        logger.info(f"Music generated successfully: {output_path}")
+        return output_path
+    
     def edit(
         self,
         lrc_path: str,
@@ -180,6 +493,7 @@ class DiffRhythmInference:
         output_dir: str = None,
         chunked: bool = True,
         batch_infer_num: int = 1,
+        on_preview: Optional[Callable] = None,
     ) -> str:
         """
         Edit specific segments of an existing song
@@ -194,13 +508,14 @@ class DiffRhythmInference:
             output_dir: Output directory for edited music
             chunked: Use chunked decoding
             batch_infer_num: Number of songs per batch
+            on_preview: Called as on_preview(0, preview_path, t) for each preview written while sampling
             
         Returns:
             Path to edited audio file
         """
         try:
             # Initialize models
-            self._initialize_models(audio_length)
+            cfm, max_frames = self._initialize_models(audio_length)
             
             # Import inference utilities
             from infer.infer_utils import (
@@ -218,27 +533,30 @@ class DiffRhythmInference:
             
             # Get LRC tokens
             lrc_prompt, start_time, end_frame, song_duration = get_lrc_token(
-                self.max_frames, lrc, self.tokenizer, audio_length, self.device
+                max_frames, lrc, self.tokenizer, audio_length, self.device, dtype=self.dtype
             )
             
             # Get style prompt
             if ref_audio_path:
-                style_prompt = get_style_prompt(self.muq, ref_audio_path)
+                style_prompt = get_style_prompt(self.muq, ref_audio_path, dtype=self.dtype)
             else:
-                style_prompt = get_style_prompt(self.muq, prompt=ref_prompt)
+                style_prompt = get_style_prompt(self.muq, prompt=ref_prompt, dtype=self.dtype)
             
             # Get negative style prompt
-            negative_style_prompt = get_negative_style_prompt(self.device)
+            negative_style_prompt = get_negative_style_prompt(self.device, dtype=self.dtype)
             
             # Get reference latent (with edit mode)
             latent_prompt, pred_frames = get_reference_latent(
-                self.device, self.max_frames, True, edit_segments, ref_song_path, self.vae
+                self.device, max_frames, True, edit_segments, ref_song_path, self.vae
             )
             
+            # Preview the first song of the batch
+            preview_callback = self._preview_callback([(0, end_frame, output_dir)], on_preview)
+            
             # Run inference
             logger.info("Running music editing inference...")
             generated_songs = inference(
-                cfm_model=self.cfm,
+                cfm_model=cfm,
                 vae_model=self.vae,
                 cond=latent_prompt,
                 text=lrc_prompt,
@@ -249,7 +567,21 @@ class DiffRhythmInference:
                 pred_frames=pred_frames,
                 chunked=chunked,
                 batch_infer_num=batch_infer_num,
-                song_duration=song_duration
+                song_duration=song_duration,
+                batch_cfg=settings.BATCH_CFG,
+                steps=settings.SAMPLING_STEPS,
+                solver=settings.SAMPLING_SOLVER,
+                solver_options=solver_options(),
+                schedule=settings.SAMPLING_SCHEDULE,
+                sway_sampling_coef=settings.SWAY_SAMPLING_COEF,
+                cfg_interval=settings.CFG_INTERVAL,
+                cfg_cache_steps=settings.CFG_CACHE_STEPS,
+                deep_cache_interval=settings.DEEP_CACHE_INTERVAL,
+                deep_cache_depth=settings.DEEP_CACHE_DEPTH,
+                attn_chunk_size=settings.ATTN_CHUNK_SIZE,
+                merge_ratio=settings.TOKEN_MERGE_RATIO,
+                preview_callback=preview_callback,
+                preview_interval=settings.PREVIEW_INTERVAL
             )
             
             # Select one song from the batch
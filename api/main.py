@@ -19,8 +19,17 @@ from models import (
     TaskStatusResponse,
     HealthResponse,
 )
-from tasks import generate_music_task, edit_music_task, get_task_status, cleanup_task
+from tasks import (
+    generate_music_batch_task,
+    edit_music_task,
+    get_task_status,
+    cleanup_task,
+    continuous_generation,
+    fail_task,
+)
 from storage import StorageManager
+from inference import get_max_frames
+from worker import InferenceWorker, QueueFullError
 from config import settings
 
 # Configure logging
@@ -51,6 +60,65 @@ app.add_middleware(
 # Initialize storage manager
 storage = StorageManager(settings.STORAGE_PATH)
 
+# Initialize inference worker (started on application startup)
+worker = InferenceWorker(
+    max_queue_size=settings.MAX_QUEUE_SIZE,
+    concurrency=settings.WORKER_CONCURRENCY,
+    max_batch_size=settings.MAX_BATCH_SIZE,
+    max_batch_wait=settings.MAX_BATCH_WAIT_SECONDS,
+)
+
+
+@app.on_event("startup")
+def start_worker():
+    """Load the models and start the inference worker"""
+    worker.start()
+
+
+@app.on_event("shutdown")
+def stop_worker():
+    """Stop the inference worker"""
+    worker.stop(timeout=5)
+
+
+def queue_full_error() -> HTTPException:
+    """Build the 429 response returned when the inference queue is full"""
+    return HTTPException(
+        status_code=429,
+        detail="Inference queue is full, please retry later",
+        headers={"Retry-After": str(settings.QUEUE_RETRY_AFTER_SECONDS)},
+    )
+
+
+def enqueue_task(handler, task_params: dict, batch_key=None, continuous=None):
+    """
+    Submit a task to the inference worker
+    
+    The task directory is removed again if the queue filled up in the meantime,
+    or if the audio length maps to no model.
+    Short songs get a higher priority, they may preempt long ones.
+    """
+    task_id = task_params["task_id"]
+    try:
+        priority = 1 if get_max_frames(task_params["audio_length"]) == 2048 else 0
+    except ValueError as e:
+        storage.cleanup_task(task_id)
+        raise HTTPException(status_code=400, detail=str(e))
+    storage.update_task_status(task_id, "queued")
+    try:
+        worker.submit(
+            handler,
+            task_params,
+            batch_key=batch_key,
+            size=task_params.get("batch_infer_num", 1),
+            continuous=continuous,
+            priority=priority,
+            fail=fail_task,
+        )
+    except QueueFullError:
+        storage.cleanup_task(task_id)
+        raise queue_full_error()
+
 
 @app.get("/", response_model=dict)
 async def root():
@@ -69,7 +137,8 @@ async def health_check():
     return HealthResponse(
         status="healthy",
         message="DiffRhythm API is running",
-        version="1.0.0"
+        version="1.0.0",
+        device_profile=worker.engine.profile.to_dict() if worker.engine else None
     )
 
 
@@ -108,6 +177,9 @@ async def generate_music(
                 detail="Audio length must be 95 or between 96-285 seconds"
             )
         
+        if worker.is_full():
+            raise queue_full_error()
+        
         # Generate task ID
         task_id = str(uuid.uuid4())
         logger.info(f"Creating new generation task: {task_id}")
@@ -135,8 +207,16 @@ async def generate_music(
             "output_dir": str(task_dir / "output"),
         }
         
-        # Start background task
-        background_tasks.add_task(generate_music_task, task_params)
+        # Hand the task to the inference worker, generation jobs served by
+        # the same model are batched together, or join the running batch
+        # between sampling steps with continuous batching
+        batch_key = ("generate", get_max_frames(audio_length))
+        enqueue_task(
+            generate_music_batch_task,
+            task_params,
+            batch_key=batch_key,
+            continuous=continuous_generation if settings.CONTINUOUS_BATCHING else None
+        )
         
         # Schedule cleanup after 24 hours
         background_tasks.add_task(cleanup_task, task_id, delay=86400)
@@ -188,6 +268,15 @@ async def edit_music(
                 detail="Only one of ref_audio or ref_prompt should be provided"
             )
         
+        if audio_length < 95 or audio_length > 285:
+            raise HTTPException(
+                status_code=400,
+                detail="Audio length must be 95 or between 96-285 seconds"
+            )
+        
+        if worker.is_full():
+            raise queue_full_error()
+        
         # Generate task ID
         task_id = str(uuid.uuid4())
         logger.info(f"Creating new edit task: {task_id}")
@@ -217,8 +306,8 @@ async def edit_music(
             "output_dir": str(task_dir / "output"),
         }
         
-        # Start background task
-        background_tasks.add_task(edit_music_task, task_params)
+        # Hand the task to the inference worker
+        enqueue_task(edit_music_task, task_params)
         
         # Schedule cleanup after 24 hours
         background_tasks.add_task(cleanup_task, task_id, delay=86400)
@@ -288,6 +377,47 @@ async def download_result(task_id: str):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+@app.get("/api/preview/{task_id}")
+async def download_preview(task_id: str):
+    """
+    Download the latest preview of a task that is being sampled
+    
+    Previews are written every PREVIEW_INTERVAL model evaluations, each one closer
+    to the final song. Once the task is completed the final audio is returned.
+    """
+    try:
+        status = get_task_status(task_id)
+        
+        if status is None:
+            raise HTTPException(status_code=404, detail="Task not found")
+        
+        if status.status == "completed" and status.output_path:
+            preview_path = Path(status.output_path)
+        elif status.preview_path:
+            preview_path = Path(status.preview_path)
+        else:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No preview available yet. Current status: {status.status}"
+            )
+        
+        if not preview_path.exists():
+            raise HTTPException(status_code=404, detail="Preview file not found")
+        
+        return FileResponse(
+            path=preview_path,
+            media_type="audio/wav",
+            filename=f"{task_id}_preview.wav",
+            headers={"Cache-Control": "no-store"}
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error downloading preview: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+
 @app.delete("/api/tasks/{task_id}")
 async def delete_task(task_id: str):
     """Delete a task and its associated files"""
@@ -53,13 +53,26 @@ class TaskStatusResponse(BaseModel):
     progress: Optional[int] = Field(None, ge=0, le=100, description="Progress percentage")
     message: Optional[str] = Field(None, description="Status message or error details")
     output_path: Optional[str] = Field(None, description="Path to generated audio file")
+    preview_path: Optional[str] = Field(None, description="Path to the latest preview while sampling")
+    preview_t: Optional[float] = Field(None, ge=0, le=1, description="Sampling time of the latest preview, 0 (noise) to 1 (final)")
     created_at: Optional[str] = Field(None, description="Task creation timestamp")
     completed_at: Optional[str] = Field(None, description="Task completion timestamp")
     error: Optional[str] = Field(None, description="Error message if failed")
 
 
+class DeviceProfileInfo(BaseModel):
+    """Execution profile of the inference engine"""
+    device: str = Field(..., description="Torch device")
+    dtype: str = Field(..., description="Model dtype")
+    num_threads: Optional[int] = Field(None, description="Intra-op threads per worker (CPU)")
+    interop_threads: Optional[int] = Field(None, description="Inter-op threads (CPU)")
+    worker_cpus: Optional[List[List[int]]] = Field(None, description="CPUs each worker is pinned to (CPU)")
+    bf16_supported: bool = Field(False, description="Whether the CPU supports AMX bf16")
+
+
 class HealthResponse(BaseModel):
     """Response model for health check"""
     status: str = Field(..., description="Service status")
     message: str = Field(..., description="Status message")
     version: str = Field(..., description="API version")
+    device_profile: Optional[DeviceProfileInfo] = Field(None, description="Execution profile, once the engine is up")
@@ -0,0 +1,123 @@
+"""
+Job cost model for queue scheduling
+Predicts how long a job runs from its song length, rows and sampling steps, and
+recalibrates itself from the measured run times
+"""
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds per latent frame, per sampling step and per row before any benchmark or
+# measurement is known
+DEFAULT_FRAME_STEP_SECONDS = 2e-4
+
+
+def model_frames(audio_length: int) -> int:
+    """
+    max_frames of the model serving audio_length, like inference.get_max_frames
+
+    Total: lengths the API rejects are clamped to the nearest model rather than
+    raising, so a cost is never the reason a job fails.
+    """
+    return 2048 if audio_length <= 95 else 6144
+
+
+def song_frames(audio_length: int) -> int:
+    """Latent frames sampled for a song of audio_length seconds"""
+    return max(0, min(int(audio_length * 44100 / 2048), model_frames(audio_length)))
+
+
+class CostModel:
+    """
+    Linear cost model of an inference job
+
+    A job costs frames x steps x rows times a per model coefficient, in seconds.
+    The coefficients start from device benchmarks (infer/benchmark.py --json)
+    when given, and follow the measured run times as jobs complete.
+    """
+
+    def __init__(self, path: Optional[str] = None, benchmark_paths: Optional[List[str]] = None, smoothing: float = 0.2):
+        """
+        Args:
+            path: JSON file the coefficients are loaded from and saved to after each update
+            benchmark_paths: Results of infer/benchmark.py --json to seed the coefficients with
+            smoothing: Weight of a new measurement in the running coefficient
+        """
+        self.path = path
+        self.smoothing = smoothing
+        self.frame_step_seconds: Dict[int, float] = {}  # max_frames -> seconds per frame, step and row
+        self._lock = threading.Lock()
+        for benchmark_path in benchmark_paths or []:
+            self.load_benchmark(benchmark_path)
+        if path and os.path.exists(path):
+            with open(path) as f:
+                coefficients = json.load(f)["frame_step_seconds"]
+            self.frame_step_seconds.update({int(k): float(v) for k, v in coefficients.items()})
+        logger.info(f"Cost model coefficients: {self.frame_step_seconds or 'defaults'}")
+
+    def load_benchmark(self, path: str):
+        """Seed the coefficient of a model from the reference variant of a benchmark run"""
+        with open(path) as f:
+            results = json.load(f)
+        reference = results[0]
+        steps = int(reference["variant"].split(":")[1])
+        frames = song_frames(reference["audio_length"])
+        self.frame_step_seconds[model_frames(reference["audio_length"])] = (
+            reference["seconds"] / (frames * steps * reference["batch"])
+        )
+
+    def units(self, task_params: dict) -> float:
+        """Frames x steps x rows of a job"""
+        return (
+            song_frames(task_params["audio_length"])
+            * settings.SAMPLING_STEPS
+            * task_params.get("batch_infer_num", 1)
+        )
+
+    def coefficient(self, max_frames: int) -> float:
+        """Seconds per frame, step and row of a model, taken from the other model until it is known"""
+        coefficients = self.frame_step_seconds
+        if max_frames in coefficients:
+            return coefficients[max_frames]
+        if coefficients:
+            return sum(coefficients.values()) / len(coefficients)
+        return DEFAULT_FRAME_STEP_SECONDS
+
+    def predict(self, task_params: dict) -> float:
+        """Predicted run time of a job in seconds"""
+        return self.units(task_params) * self.coefficient(model_frames(task_params["audio_length"]))
+
+    def observe(self, jobs: List[dict], seconds: float):
+        """
+        Log the predicted and actual run time of jobs that ran together and recalibrate
+
+        Args:
+            jobs: Task parameters of the jobs, all served by the same model
+            seconds: Measured run time of the jobs
+        """
+        if not jobs or seconds <= 0:
+            return
+        max_frames = model_frames(jobs[0]["audio_length"])
+        predicted = sum(self.predict(task_params) for task_params in jobs)
+        logger.info(
+            f"Cost of {len(jobs)} job(s) for max_frames={max_frames}: "
+            f"predicted {predicted:.1f}s, actual {seconds:.1f}s ({', '.join(p['task_id'] for p in jobs)})"
+        )
+
+        measured = seconds / sum(self.units(task_params) for task_params in jobs)
+        with self._lock:
+            current = self.frame_step_seconds.get(max_frames)
+            self.frame_step_seconds[max_frames] = (
+                measured if current is None else (1 - self.smoothing) * current + self.smoothing * measured
+            )
+            if self.path:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"frame_step_seconds": self.frame_step_seconds}, f, indent=2)
+                os.replace(tmp_path, self.path)
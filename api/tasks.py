@@ -7,7 +7,7 @@ import logging
 import time
 import traceback
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 from storage import StorageManager
@@ -20,66 +20,147 @@ logger = logging.getLogger(__name__)
 # Initialize storage manager
 storage = StorageManager(settings.STORAGE_PATH)
 
-# Initialize inference engine (lazy loading)
-_inference_engine = None
+
+def preview_reporter(task_ids: List[str]):
+    """
+    Build the on_preview hook of the inference engine for a list of tasks
+    
+    Records the latest preview of each task and moves its progress along
+    with the sampling time, from 10 at the start to 90 at the end.
+    
+    Args:
+        task_ids: Task identifiers, in the order of the requests passed to the engine
+    """
+    def on_preview(index: int, preview_path: str, t: float):
+        storage.update_task_status(
+            task_ids[index],
+            "processing",
+            progress=10 + int(80 * t),
+            preview_path=preview_path,
+            preview_t=round(t, 3)
+        )
+    
+    return on_preview
 
 
-def get_inference_engine():
-    """Get or initialize the inference engine"""
-    global _inference_engine
-    if _inference_engine is None:
-        logger.info("Initializing DiffRhythm inference engine...")
-        _inference_engine = DiffRhythmInference()
-        logger.info("Inference engine initialized successfully")
-    return _inference_engine
+def generation_request(task_params: dict) -> dict:
+    """Keyword arguments of DiffRhythmInference.generate() for a generation task"""
+    return {
+        "lrc_path": task_params["lyrics_path"],
+        "ref_audio_path": task_params.get("ref_audio_path"),
+        "ref_prompt": task_params.get("ref_prompt"),
+        "audio_length": task_params["audio_length"],
+        "output_dir": task_params["output_dir"],
+        "chunked": task_params.get("chunked", True),
+        "batch_infer_num": task_params.get("batch_infer_num", 1),
+    }
 
 
-def generate_music_task(task_params: dict):
+def generate_music_batch_task(batch_params: List[dict], inference: DiffRhythmInference):
     """
-    Background task for music generation
+    Worker task for music generation, run as one batch for all given tasks
     
     Args:
-        task_params: Dictionary containing task parameters
+        batch_params: List of task parameter dictionaries sharing one frame bucket
+        inference: Inference engine owned by the worker
     """
-    task_id = task_params["task_id"]
+    task_ids = [task_params["task_id"] for task_params in batch_params]
     
     try:
-        logger.info(f"Starting generation task: {task_id}")
-        storage.update_task_status(task_id, "processing", progress=0)
-        
-        # Get inference engine
-        inference = get_inference_engine()
+        logger.info(f"Starting generation batch: {', '.join(task_ids)}")
+        for task_id in task_ids:
+            storage.update_task_status(task_id, "processing", progress=0)
         
         # Update progress
-        storage.update_task_status(task_id, "processing", progress=10)
+        for task_id in task_ids:
+            storage.update_task_status(task_id, "processing", progress=10)
         
         # Run inference
-        output_path = inference.generate(
-            lrc_path=task_params["lyrics_path"],
-            ref_audio_path=task_params.get("ref_audio_path"),
-            ref_prompt=task_params.get("ref_prompt"),
-            audio_length=task_params["audio_length"],
-            output_dir=task_params["output_dir"],
-            chunked=task_params.get("chunked", True),
-            batch_infer_num=task_params.get("batch_infer_num", 1),
+        output_paths = inference.generate_batch(
+            [generation_request(task_params) for task_params in batch_params],
+            on_preview=preview_reporter(task_ids)
         )
         
         # Update status to completed
-        storage.update_task_status(
-            task_id,
-            "completed",
-            progress=100,
-            output_path=output_path,
-            completed_at=datetime.now().isoformat()
-        )
-        
-        logger.info(f"Task {task_id} completed successfully")
+        for task_id, output_path in zip(task_ids, output_paths):
+            storage.update_task_status(
+                task_id,
+                "completed",
+                progress=100,
+                output_path=output_path,
+                completed_at=datetime.now().isoformat()
+            )
+            
+            logger.info(f"Task {task_id} completed successfully")
         
     except Exception as e:
         error_msg = f"Error in generation task: {str(e)}"
-        logger.error(f"Task {task_id} failed: {error_msg}")
+        logger.error(f"Tasks {', '.join(task_ids)} failed: {error_msg}")
         logger.error(traceback.format_exc())
         
+        for task_id in task_ids:
+            storage.update_task_status(
+                task_id,
+                "failed",
+                error=error_msg,
+                completed_at=datetime.now().isoformat()
+            )
+
+
+class ContinuousGeneration:
+    """
+    Handlers of a generation task sampled with iteration-level batching
+    
+    The worker admits the task into its running sampler, reports its progress
+    after sampling steps and pauses, and hands its latents to finish() for decoding.
+    """
+    
+    def admit(self, task_params: dict, inference: DiffRhythmInference, sampler, tag=None) -> list:
+        """
+        Add the task to a running sampler
+        
+        Returns:
+            The task's sampler slots
+        """
+        task_id = task_params["task_id"]
+        logger.info(f"Adding generation task to the running batch: {task_id}")
+        storage.update_task_status(task_id, "processing", progress=10)
+        return inference.add_to_sampler(sampler, generation_request(task_params), tag=tag)
+    
+    def progress(self, task_params: dict, fraction: float):
+        """Record the sampling progress, fraction of the steps done"""
+        storage.update_task_status(task_params["task_id"], "processing", progress=10 + int(80 * fraction))
+    
+    def suspended(self, task_params: dict):
+        """Record that sampling is paused for jobs of higher priority"""
+        storage.update_task_status(task_params["task_id"], "processing", message="Paused for shorter jobs")
+    
+    def resumed(self, task_params: dict):
+        """Record that sampling goes on after a pause"""
+        storage.update_task_status(task_params["task_id"], "processing", message="Resumed")
+    
+    def finish(self, task_params: dict, inference: DiffRhythmInference, latents: list):
+        """Decode and save the sampled song, run off the sampling thread"""
+        task_id = task_params["task_id"]
+        try:
+            output_path = inference.save_song(generation_request(task_params), latents)
+            storage.update_task_status(
+                task_id,
+                "completed",
+                progress=100,
+                output_path=output_path,
+                completed_at=datetime.now().isoformat()
+            )
+            logger.info(f"Task {task_id} completed successfully")
+        except Exception as e:
+            self.fail(task_params, e)
+    
+    def fail(self, task_params: dict, error: Exception):
+        """Mark the task as failed"""
+        task_id = task_params["task_id"]
+        error_msg = f"Error in generation task: {str(error)}"
+        logger.error(f"Task {task_id} failed: {error_msg}")
+        logger.error(traceback.format_exc())
         storage.update_task_status(
             task_id,
             "failed",
@@ -88,12 +169,16 @@ def generate_music_task(task_params: dict):
         )
 
 
-def edit_music_task(task_params: dict):
+continuous_generation = ContinuousGeneration()
+
+
+def edit_music_task(task_params: dict, inference: DiffRhythmInference):
     """
-    Background task for music editing
+    Worker task for music editing
     
     Args:
         task_params: Dictionary containing task parameters
+        inference: Inference engine owned by the worker
     """
     task_id = task_params["task_id"]
     
@@ -101,9 +186,6 @@ def edit_music_task(task_params: dict):
         logger.info(f"Starting edit task: {task_id}")
         storage.update_task_status(task_id, "processing", progress=0)
         
-        # Get inference engine
-        inference = get_inference_engine()
-        
         # Update progress
         storage.update_task_status(task_id, "processing", progress=10)
         
@@ -118,6 +200,7 @@ def edit_music_task(task_params: dict):
             output_dir=task_params["output_dir"],
             chunked=task_params.get("chunked", True),
             batch_infer_num=task_params.get("batch_infer_num", 1),
+            on_preview=preview_reporter([task_id]),
         )
         
         # Update status to completed
@@ -144,6 +227,18 @@ def edit_music_task(task_params: dict):
         )
 
 
+def fail_task(task_params: dict, error: Exception):
+    """Mark a queued task as failed that will not run"""
+    task_id = task_params["task_id"]
+    logger.error(f"Task {task_id} failed: {str(error)}")
+    storage.update_task_status(
+        task_id,
+        "failed",
+        error=str(error),
+        completed_at=datetime.now().isoformat()
+    )
+
+
 def get_task_status(task_id: str) -> Optional[TaskStatusResponse]:
     """
     Get the status of a task
@@ -165,6 +260,8 @@ def get_task_status(task_id: str) -> Optional[TaskStatusResponse]:
         progress=int(metadata.get("progress", 0)) if "progress" in metadata else None,
         message=metadata.get("message"),
         output_path=metadata.get("output_path"),
+        preview_path=metadata.get("preview_path"),
+        preview_t=float(metadata["preview_t"]) if "preview_t" in metadata else None,
         created_at=metadata.get("created_at"),
         completed_at=metadata.get("completed_at"),
         error=metadata.get("error")
@@ -0,0 +1,431 @@
+"""
+Inference worker with a bounded job queue
+Owns the DiffRhythm inference engine and runs queued jobs in order
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, List, Optional
+
+from config import settings
+from inference import DiffRhythmInference
+from scheduler import CostModel
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+
+
+class Job:
+    """A queued unit of work"""
+
+    def __init__(
+        self,
+        handler: Callable,
+        task_params: dict,
+        batch_key: Optional[Hashable] = None,
+        size: int = 1,
+        continuous: Optional[Any] = None,
+        priority: int = 0,
+        cost: float = 0.0,
+        fail: Optional[Callable] = None,
+    ):
+        """
+        Args:
+            handler: Task function, see InferenceWorker.submit
+            task_params: Dictionary containing task parameters
+            batch_key: Jobs with equal keys may be run together (None: never batched)
+            size: Number of batch rows the job occupies
+            continuous: Handlers for iteration-level batching (see tasks.ContinuousGeneration),
+                used instead of handler; requires a batch key
+            priority: Jobs of higher priority may preempt running continuous jobs of lower priority
+            cost: Predicted run time in seconds, orders the queue with shortest job first
+            fail: Called as fail(task_params, error) if the worker stops before running the job,
+                continuous jobs use continuous.fail
+        """
+        self.handler = handler
+        self.task_params = task_params
+        self.batch_key = batch_key
+        self.size = size
+        self.continuous = continuous if batch_key is not None else None
+        self.priority = priority
+        self.cost = cost
+        self.fail = self.continuous.fail if self.continuous is not None else fail
+        self.enqueued_at = time.monotonic()
+
+
+class InferenceWorker:
+    """Long-lived worker that drains a bounded queue of inference jobs"""
+
+    def __init__(
+        self,
+        max_queue_size: int,
+        concurrency: int = 1,
+        max_batch_size: int = 1,
+        max_batch_wait: float = 0.0,
+    ):
+        """
+        Initialize the worker
+
+        Args:
+            max_queue_size: Maximum number of jobs waiting to be processed
+            concurrency: Number of jobs run at the same time on the device
+            max_batch_size: Maximum number of batch rows coalesced into one call
+            max_batch_wait: Seconds a batchable job may wait for companions,
+                counted from when it was enqueued
+        """
+        self.max_queue_size = max_queue_size
+        self.concurrency = max(1, concurrency)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_wait = max_batch_wait
+        self.engine: Optional[DiffRhythmInference] = None
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        # songs sampled with iteration-level batching are decoded here, off the sampling loop
+        self._decoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decoder")
+        # priority -> running average of the seconds its preempting jobs took
+        self._service_seconds = {}
+        self.cost_model = CostModel(settings.COST_MODEL_PATH, settings.COST_BENCHMARK_PATHS)
+
+    def start(self):
+        """Initialize the inference engine and start the worker threads"""
+        logger.info("Initializing DiffRhythm inference engine...")
+        self.engine = DiffRhythmInference(workers=self.concurrency)
+        if settings.PRELOAD_AUDIO_LENGTH:
+            self.engine.load_models(settings.PRELOAD_AUDIO_LENGTH)
+        logger.info("Inference engine initialized successfully")
+
+        self._stop.clear()
+        for i in range(self.concurrency):
+            thread = threading.Thread(
+                target=self._run, args=(i,), name=f"inference-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info(
+            f"Inference worker started (concurrency={self.concurrency}, "
+            f"max_queue_size={self.max_queue_size}, max_batch_size={self.max_batch_size})"
+        )
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the worker threads after their current job finishes, and fail the jobs still queued"""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+        with self._cond:
+            # nothing would run them, the threads take no new jobs once stopping
+            jobs = list(self._jobs)
+            self._jobs.clear()
+        for job in jobs:
+            if job.fail is not None:
+                job.fail(job.task_params, RuntimeError("The inference worker was stopped"))
+        self._decoder.shutdown(wait=False)
+        logger.info("Inference worker stopped")
+
+    def is_full(self) -> bool:
+        """Check whether the queue has no free slot"""
+        with self._cond:
+            return len(self._jobs) >= self.max_queue_size
+
+    def qsize(self) -> int:
+        """Number of jobs waiting to be processed"""
+        with self._cond:
+            return len(self._jobs)
+
+    def submit(
+        self,
+        handler: Callable,
+        task_params: dict,
+        batch_key: Optional[Hashable] = None,
+        size: int = 1,
+        continuous: Optional[Any] = None,
+        priority: int = 0,
+        fail: Optional[Callable] = None,
+    ):
+        """
+        Enqueue a job without blocking
+
+        Jobs without a batch key are run as handler(task_params, engine).
+        Jobs with a batch key are run as handler([task_params, ...], engine)
+        together with other queued jobs that have the same key.
+        Jobs with continuous handlers join a running sampler between two
+        steps instead, and leave it as soon as they are done. The queue is run
+        in submission order, or with SCHEDULING_POLICY=sjf by predicted cost
+        minus SJF_AGING times the seconds waited. With PREEMPTION,
+        such a batch is suspended between two steps for queued jobs of higher
+        priority that would otherwise miss SHORT_JOB_SLO_SECONDS.
+
+        Args:
+            handler: Task function
+            task_params: Dictionary containing task parameters
+            batch_key: Key of the batch bucket, or None to run the job alone
+            size: Number of batch rows the job occupies
+            continuous: Handlers for iteration-level batching (see tasks.ContinuousGeneration)
+            priority: Priority of the job, higher runs first on preemption
+            fail: Called as fail(task_params, error) if the worker stops before running the job
+
+        Raises:
+            QueueFullError: If the queue is at capacity
+        """
+        with self._cond:
+            if len(self._jobs) >= self.max_queue_size:
+                raise QueueFullError(
+                    f"Inference queue is full ({self.max_queue_size} jobs waiting)"
+                )
+            self._jobs.append(Job(
+                handler, task_params, batch_key=batch_key, size=size, continuous=continuous, priority=priority,
+                cost=self.cost_model.predict(task_params), fail=fail,
+            ))
+            self._cond.notify_all()
+
+    def _ordered_jobs(self) -> List[Job]:
+        """
+        Queued jobs in the order they should run, holding the lock
+        
+        Shortest job first minimises the mean latency, the ageing term lowers the
+        score of a waiting job by SJF_AGING per second so long songs are not starved.
+        """
+        if settings.SCHEDULING_POLICY != "sjf":
+            return list(self._jobs)
+        now = time.monotonic()
+        return sorted(self._jobs, key=lambda job: job.cost - settings.SJF_AGING * (now - job.enqueued_at))
+
+    def _take_companion(self, first: Job, batch_size: int) -> Optional[Job]:
+        """Remove and return the next queued job that fits into first's batch"""
+        for job in self._ordered_jobs():
+            if job.batch_key == first.batch_key and batch_size + job.size <= self.max_batch_size:
+                self._jobs.remove(job)
+                return job
+        return None
+
+    def _next_batch(self) -> Optional[List[Job]]:
+        """
+        Wait for the next job and collect batch companions for it
+
+        Returns:
+            Jobs to run together, or None when the worker is stopping
+        """
+        with self._cond:
+            while not self._jobs and not self._stop.is_set():
+                self._cond.wait(timeout=1.0)
+            if self._stop.is_set():
+                return None
+
+            first = self._ordered_jobs()[0]
+            self._jobs.remove(first)
+            return self._collect_batch(first, first.enqueued_at + self.max_batch_wait)
+
+    def _collect_batch(self, first: Job, deadline: float) -> List[Job]:
+        """Collect batch companions for first until the batch is full or the deadline passes, holding the lock"""
+        batch = [first]
+        if first.batch_key is None or first.continuous is not None:
+            return batch
+
+        batch_size = first.size
+        while batch_size < self.max_batch_size and not self._stop.is_set():
+            job = self._take_companion(first, batch_size)
+            if job is not None:
+                batch.append(job)
+                batch_size += job.size
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(timeout=remaining)
+        return batch
+
+    def _take_joiners(self, batch_key: Hashable, free_rows: int) -> List[Job]:
+        """
+        Remove and return the queued jobs that can join a running continuous batch
+        
+        Jobs are taken in queue order and none overtakes a job that cannot join,
+        so other jobs run once the batch drains instead of waiting forever.
+        """
+        jobs = []
+        with self._cond:
+            for job in self._ordered_jobs():
+                if job.continuous is None or job.batch_key != batch_key or job.size > free_rows:
+                    break
+                self._jobs.remove(job)
+                jobs.append(job)
+                free_rows -= job.size
+        return jobs
+
+    def _take_preemptor(self, priority: int, remaining_seconds: float) -> Optional[Job]:
+        """
+        Remove and return the queued job that a continuous batch of this priority should pause for
+        
+        The oldest job of higher priority preempts the batch once it would miss
+        SHORT_JOB_SLO_SECONDS by waiting for the batch to finish: its wait so far,
+        plus the batch's remaining sampling time, plus its own expected run time.
+        
+        Args:
+            priority: Priority of the running batch
+            remaining_seconds: Expected sampling time left in the running batch
+        """
+        if not settings.PREEMPTION:
+            return None
+        with self._cond:
+            for job in self._jobs:
+                if job.priority <= priority:
+                    continue
+                waited = time.monotonic() - job.enqueued_at
+                latency = waited + remaining_seconds + self._service_seconds.get(job.priority, 0.0)
+                if latency <= settings.SHORT_JOB_SLO_SECONDS:
+                    # younger jobs have waited less, none of them is late either
+                    return None
+                self._jobs.remove(job)
+                return job
+        return None
+
+    def _preempt(self, job: Job):
+        """Run a preempting job with the companions already queued for it, and record how long it took"""
+        start = time.monotonic()
+        with self._cond:
+            # the paused batch should not wait for companions
+            batch = self._collect_batch(job, deadline=0.0)
+        try:
+            self._run_batch(batch)
+        except Exception as e:
+            logger.error(f"Unhandled error in preempting job: {str(e)}")
+        seconds = time.monotonic() - start
+        average = self._service_seconds.get(job.priority)
+        self._service_seconds[job.priority] = seconds if average is None else 0.8 * average + 0.2 * seconds
+
+    def _run_continuous(self, first: Job):
+        """
+        Sample continuous jobs with iteration-level batching until none is left
+
+        Queued jobs with the same batch key join between two sampling steps.
+        A job leaves the batch when its rows are done and is decoded on the
+        decoder thread while sampling goes on.
+        
+        With PREEMPTION, the batch is suspended between two steps while queued
+        jobs of higher priority run (see _take_preemptor), its state moved off
+        the device, and resumed afterwards with bit-identical results.
+        """
+        handlers = first.continuous
+        try:
+            sampler = self.engine.continuous_sampler(
+                first.task_params["audio_length"], max(self.max_batch_size, first.size)
+            )
+        except Exception as e:
+            handlers.fail(first.task_params, e)
+            return
+
+        active = {}  # id(job) -> (job, slots, finished latents)
+        joining = [first]
+        admitted = []
+        steps = 0
+        step_seconds = None  # running average of the time per step
+        start = time.monotonic()
+        paused = 0.0
+        while True:
+            for job in joining:
+                try:
+                    slots = job.continuous.admit(job.task_params, self.engine, sampler, tag=job)
+                    active[id(job)] = (job, slots, [])
+                    admitted.append(job.task_params)
+                except Exception as e:
+                    job.continuous.fail(job.task_params, e)
+            if self._stop.is_set():
+                # nothing would finish the jobs still being sampled
+                for job, _, _ in active.values():
+                    job.continuous.fail(job.task_params, RuntimeError("The inference worker was stopped"))
+                break
+            if not len(sampler):
+                self.cost_model.observe(admitted, time.monotonic() - start - paused)
+                break
+            if joining:
+                logger.info(f"Continuous batch of {len(active)} job(s), {len(sampler)} row(s)")
+
+            if step_seconds is not None:
+                remaining = max(len(slot.timesteps) - 1 - slot.step for slot in sampler.slots) * step_seconds
+                preemptor = self._take_preemptor(first.priority, remaining)
+                if preemptor is not None:
+                    paused += self._suspend(sampler, first, active, preemptor, remaining)
+
+            step_start = time.monotonic()
+            try:
+                finished = sampler.step()
+            except Exception as e:
+                for job, _, _ in active.values():
+                    job.continuous.fail(job.task_params, e)
+                break
+            steps += 1
+            seconds = time.monotonic() - step_start
+            step_seconds = seconds if step_seconds is None else 0.8 * step_seconds + 0.2 * seconds
+
+            for slot in finished:
+                job, slots, latents = active[id(slot.tag)]
+                latents.append(slot.result())
+                if len(latents) == len(slots):
+                    del active[id(job)]
+                    self._decoder.submit(job.continuous.finish, job.task_params, self.engine, latents)
+            if steps % 4 == 0:
+                for job, slots, _ in active.values():
+                    job.continuous.progress(job.task_params, slots[0].step / (len(slots[0].timesteps) - 1))
+
+            joining = self._take_joiners(first.batch_key, sampler.free_slots)
+
+    def _suspend(self, sampler, first: Job, active: dict, preemptor: Job, remaining_seconds: float):
+        """Pause a continuous batch, run the preempting jobs, and resume the batch; returns the seconds paused"""
+        start = time.monotonic()
+        logger.info(
+            f"Suspending continuous batch of {len(active)} job(s) for a job of priority {preemptor.priority}, "
+            f"queued {time.monotonic() - preemptor.enqueued_at:.1f}s ago"
+        )
+        for job, _, _ in active.values():
+            job.continuous.suspended(job.task_params)
+        sampler.suspend()
+        try:
+            while preemptor is not None:
+                self._preempt(preemptor)
+                preemptor = self._take_preemptor(first.priority, remaining_seconds)
+        finally:
+            # the preempting jobs may have switched the engine to their model
+            self.engine.load_models(first.task_params["audio_length"])
+            sampler.resume()
+            for job, _, _ in active.values():
+                job.continuous.resumed(job.task_params)
+        logger.info("Resuming continuous batch")
+        return time.monotonic() - start
+
+    def _run_batch(self, batch: List[Job]):
+        """Run a batch of jobs from _next_batch against the shared engine"""
+        first = batch[0]
+        if first.continuous is not None:
+            # records its own cost, without the time it was suspended
+            self._run_continuous(first)
+            return
+
+        start = time.monotonic()
+        if first.batch_key is None:
+            first.handler(first.task_params, self.engine)
+        else:
+            logger.info(f"Running batch of {len(batch)} job(s) for bucket {first.batch_key}")
+            first.handler([job.task_params for job in batch], self.engine)
+        self.cost_model.observe([job.task_params for job in batch], time.monotonic() - start)
+
+    def _run(self, index: int):
+        """Worker loop: take the next batch and run it against the shared engine"""
+        self.engine.profile.apply_to_worker(index)
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                logger.error(f"Unhandled error in inference worker: {str(e)}")
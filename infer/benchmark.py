@@ -0,0 +1,278 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sampling benchmark for the CFM/DiT model.
+
+Runs CFM.sample once per variant on the same noise, lyrics and style, and
+reports wall time, DiT and transformer block calls, peak memory and drift
+against a reference variant (32-step Euler by default). Drift is the relative
+L2 distance of the sampled latents, so a variant can be judged on speed and
+quality cost without decoding audio.
+
+A variant is `solver:steps[:key=value...]`, extra pairs are passed to
+CFM.sample, e.g. `multistep:16:schedule=logit_normal`.
+
+    python infer/benchmark.py --audio-length 95 --variants euler:16 heun:8 multistep:12
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import torch
+
+from infer_utils import (
+    get_lrc_token,
+    get_negative_style_prompt,
+    CNENTokenizer,
+    prepare_cfm_model,
+)
+from model import CFM, DiT
+from model.cfm import bucket_length
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def parse_variant(spec):
+    solver, steps, *extra = spec.split(":")
+    kwargs = dict(solver=solver, steps=int(steps))
+    for item in extra:
+        key, value = item.split("=", 1)
+        kwargs[key] = parse_value(value)
+    return kwargs
+
+
+def build_random_cfm(config_path, max_frames, device, dtype):
+    with open(config_path) as f:
+        model_config = json.load(f)
+    cfm = CFM(
+        transformer=DiT(**model_config["model"], max_frames=max_frames),
+        num_channels=model_config["model"]["mel_dim"],
+        max_frames=max_frames,
+    )
+    return cfm.to(device=device, dtype=dtype)
+
+
+def build_inputs(cfm, audio_length, lrc_path, batch, device, dtype, seed):
+    max_frames = cfm.max_frames
+    if lrc_path:
+        with open(lrc_path, "r", encoding="utf-8") as f:
+            lrc = f.read()
+        text, start_time, end_frame, song_duration = get_lrc_token(
+            max_frames, lrc, CNENTokenizer(), audio_length, device
+        )
+    else:
+        # synthetic lyrics: a short line of tokens every ~5 seconds
+        end_frame = max_frames if max_frames == 2048 else min(int(audio_length * 44100 / 2048), max_frames)
+        generator = torch.Generator().manual_seed(seed)
+        text = torch.zeros(1, end_frame, dtype=torch.long)
+        for start in range(0, end_frame - 32, 108):
+            text[0, start : start + 24] = torch.randint(3, 300, (24,), generator=generator)
+        text = text.to(device)
+        start_time = torch.zeros(1, device=device)
+        song_duration = torch.full((1,), end_frame / max_frames, device=device)
+
+    generator = torch.Generator().manual_seed(seed + 1)
+    style_prompt = torch.nn.functional.normalize(torch.randn(1, 512, generator=generator), dim=-1)
+
+    return dict(
+        cond=torch.zeros(batch, end_frame, cfm.num_channels, device=device, dtype=dtype),
+        text=text.repeat(batch, 1),
+        duration=end_frame,
+        max_duration=end_frame,
+        style_prompt=style_prompt.to(device=device, dtype=dtype).repeat(batch, 1),
+        negative_style_prompt=get_negative_style_prompt(device).to(dtype).repeat(batch, 1),
+        start_time=start_time.to(dtype).repeat(batch),
+        song_duration=song_duration.to(dtype).repeat(batch),
+        latent_pred_segments=[(0, end_frame)],
+    )
+
+
+def synchronize(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+class PeakMemory:
+    """Peak memory above the level at entry, in bytes.
+
+    Exact allocator statistics on CUDA. Elsewhere the resident set size is
+    sampled from /proc every few milliseconds (None where it is unavailable).
+    """
+
+    def __init__(self, device, interval=0.002):
+        self.device = device
+        self.interval = interval
+        self.peak = None
+
+    def _rss(self):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    def _sample(self):
+        while not self._done.is_set():
+            self._max = max(self._max, self._rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+            self._base = torch.cuda.memory_allocated()
+        elif os.path.exists("/proc/self/statm"):
+            self._base = self._max = self._rss()
+            self._done = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device == "cuda":
+            self.peak = torch.cuda.max_memory_allocated() - self._base
+        elif os.path.exists("/proc/self/statm"):
+            self._done.set()
+            self._thread.join()
+            self.peak = max(self._max, self._rss()) - self._base
+
+
+def run_variant(cfm, inputs, variant, seed, repeats, device):
+    stats = dict(dit=0, blocks=0, peak_memory=None)
+
+    def count(name):
+        def hook(module, args):
+            stats[name] += 1
+        return hook
+
+    handles = [cfm.transformer.register_forward_pre_hook(count("dit"))]
+    handles += [block.register_forward_pre_hook(count("blocks")) for block in cfm.transformer.transformer_blocks]
+    try:
+        timings = []
+        for _ in range(repeats):
+            stats.update(dit=0, blocks=0)
+            synchronize(device)
+            start = time.perf_counter()
+            with torch.inference_mode(), PeakMemory(device) as memory:
+                (latents,), _ = cfm.sample(**inputs, **variant, seed=seed)
+                synchronize(device)
+            timings.append(time.perf_counter() - start)
+    finally:
+        for handle in handles:
+            handle.remove()
+    stats["peak_memory"] = memory.peak
+    return latents.float(), sum(timings) / len(timings), stats
+
+
+def drift(latents, reference):
+    return ((latents - reference).norm() / reference.norm()).item()
+
+
+def run_benchmark(cfm, inputs, variants, reference, seed, repeats, device, common=None):
+    """Time each variant spec, the first result is the reference."""
+    common = common or {}
+    ref_latents = None
+    results = []
+    for spec in [reference] + variants:
+        variant = {**parse_variant(spec), **common}
+        latents, seconds, stats = run_variant(cfm, inputs, variant, seed, repeats, device)
+        if ref_latents is None:
+            ref_latents = latents
+        results.append(dict(
+            variant=spec, seconds=seconds, dit_calls=stats["dit"], block_calls=stats["blocks"],
+            peak_memory=stats["peak_memory"], drift=drift(latents, ref_latents),
+        ))
+    return results
+
+
+def print_results(results):
+    ref_time = results[0]["seconds"]
+    print(
+        f"{'variant':<48} {'seconds':>9} {'speedup':>8} {'DiT calls':>10} {'block calls':>12} "
+        f"{'peak MiB':>9} {'rel. drift':>11}"
+    )
+    for result in results:
+        peak = f"{result['peak_memory'] / 2**20:>9.0f}" if result["peak_memory"] is not None else f"{'-':>9}"
+        print(
+            f"{result['variant']:<48} {result['seconds']:>9.2f} "
+            f"{ref_time / result['seconds']:>7.2f}x {result['dit_calls']:>10d} {result['block_calls']:>12d} "
+            f"{peak} {result['drift']:>11.4f}"
+        )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="benchmark sampling speed and drift against a reference sampler")
+    parser.add_argument("--audio-length", type=int, default=95, help="95 or any value between 96 and 285")
+    parser.add_argument("--lrc-path", type=str, default=None, help="lyrics to condition on (synthetic tokens if omitted)")
+    parser.add_argument("--variants", type=str, nargs="+", default=["euler:16", "midpoint:8", "heun:8", "multistep:16", "multistep:12:schedule=logit_normal", "adaptive:8", "euler:32:cfg_interval=[0,0.8]", "euler:32:cfg_cache_steps=2", "euler:32:deep_cache_interval=2", "euler:32:deep_cache_interval=3:deep_cache_depth=2"], help="variants as solver:steps[:key=value...]")
+    parser.add_argument("--reference", type=str, default="euler:32", help="variant the drift is measured against")
+    parser.add_argument("--batch", type=int, default=1, help="songs sampled together")
+    parser.add_argument("--cfg-strength", type=float, default=4.0)
+    parser.add_argument("--batch-cfg", action="store_true", help="run both guidance branches in one forward")
+    parser.add_argument("--repeats", type=int, default=1, help="timed runs per variant")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--random-weights", action="store_true", help="skip the checkpoint download, timing only")
+    parser.add_argument("--config", type=str, default="./config/diffrhythm-1b.json", help="model config for --random-weights")
+    parser.add_argument("--compile", action="store_true", help="compile the DiT and warm up before timing")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    return parser
+
+
+def setup(args):
+    device = args.device
+    if device is None:
+        device = "cpu"
+        if torch.cuda.is_available():
+            device = "cuda"
+        elif torch.mps.is_available():
+            device = "mps"
+
+    max_frames = 2048 if args.audio_length == 95 else 6144
+    if args.random_weights:
+        cfm = build_random_cfm(args.config, max_frames, device, torch.float16 if device != "cpu" else torch.float32)
+    else:
+        cfm = prepare_cfm_model(max_frames, device)
+    dtype = next(cfm.parameters()).dtype
+    inputs = build_inputs(cfm, args.audio_length, args.lrc_path, args.batch, device, dtype, args.seed)
+    if args.compile:
+        cfm.compile_for_inference()
+        cfm.warmup(
+            lengths=[bucket_length(inputs["duration"], cfm.length_buckets)],
+            batch_sizes=(args.batch,), cfg_strength=args.cfg_strength, batch_cfg=args.batch_cfg,
+        )
+    return cfm, inputs, device
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    assert not (
+        args.compile and any("merge_ratio" in parse_variant(spec) for spec in [args.reference, *args.variants])
+    ), "compiled inference does not merge tokens"
+    cfm, inputs, device = setup(args)
+
+    common = dict(cfg_strength=args.cfg_strength, batch_cfg=args.batch_cfg)
+    results = run_benchmark(cfm, inputs, args.variants, args.reference, args.seed, args.repeats, device, common)
+    print_results(results)
+
+    if args.json:
+        # the API cost model (api/scheduler.py) is seeded from these
+        for result in results:
+            result.update(audio_length=args.audio_length, batch=args.batch)
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,153 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the native DiT block against the transformers Llama layer.
+
+Builds a stack of transformers LlamaDecoderLayer and a stack of LlamaBlock with
+the same weights (loaded through the key remapping), checks that they agree,
+and reports the per-step latency of the stack (one DiT call worth of blocks)
+and the import time of each implementation.
+
+    python infer/block_benchmark.py --config ./config/diffrhythm-1b.json --frames 2048 --depth 4
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+
+sys.path.append(os.getcwd())
+
+from model.modules import LlamaBlock, rotary_tables
+
+
+def import_seconds(statement, repeats=3):
+    """Best wall time of a fresh interpreter running `statement`, minus the bare interpreter."""
+
+    def best(code):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True, cwd=os.getcwd())
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    return best(f"import torch; {statement}") - best("import torch")
+
+
+def build_stacks(dim, heads, ff_mult, depth, max_frames, dtype, seed=0):
+    from transformers.models.llama import LlamaConfig
+    from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        hidden_size=dim,
+        intermediate_size=dim * ff_mult,
+        num_attention_heads=heads,
+        num_key_value_heads=heads,
+        hidden_act="silu",
+        max_position_embeddings=max_frames,
+    )
+    config._attn_implementation = "sdpa"
+    hf_layers = torch.nn.ModuleList([LlamaDecoderLayer(config, layer_idx=i) for i in range(depth)])
+    for p in hf_layers.parameters():
+        p.data.normal_(0, dim ** -0.5)
+
+    native = torch.nn.ModuleList([LlamaBlock(dim, heads, ff_mult=ff_mult) for _ in range(depth)])
+    native.load_state_dict(hf_layers.state_dict())
+    return hf_layers.to(dtype).eval(), native.to(dtype).eval()
+
+
+@torch.inference_mode()
+def run_hf(layers, x, rotary_embed):
+    for layer in layers:
+        x, *_ = layer(x, attention_mask=None, position_embeddings=rotary_embed, is_causal=False)
+    return x
+
+
+@torch.inference_mode()
+def run_native(blocks, x, rotary_embed):
+    for block in blocks:
+        x = block(x, rotary_embed)
+    return x
+
+
+def time_steps(fn, steps, warmup=1):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return (time.perf_counter() - start) / steps
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="native DiT block vs transformers Llama layer")
+    parser.add_argument("--config", type=str, default="./config/diffrhythm-1b.json")
+    parser.add_argument("--frames", type=int, default=2048, help="sequence length in latent frames")
+    parser.add_argument("--batch", type=int, default=2, help="2 matches a batched CFG step")
+    parser.add_argument("--depth", type=int, default=None, help="number of blocks, default: the config depth")
+    parser.add_argument("--steps", type=int, default=5, help="timed forward passes")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--max-diff", type=float, default=1e-3, help="fail when the relative difference exceeds this")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    dtype = getattr(torch, args.dtype)
+
+    with open(args.config) as f:
+        model_config = json.load(f)["model"]
+    dim, heads = model_config["dim"], model_config["heads"]
+    ff_mult = model_config.get("ff_mult", 4)
+    depth = args.depth or model_config["depth"]
+
+    hf_layers, native = build_stacks(dim, heads, ff_mult, depth, args.frames, dtype)
+    x = torch.randn(args.batch, args.frames, dim, dtype=dtype)
+    rotary_embed = rotary_tables(dim // heads, args.frames, dtype=dtype)
+
+    hf_out, native_out = run_hf(hf_layers, x, rotary_embed), run_native(native, x, rotary_embed)
+    diff = ((native_out.float() - hf_out.float()).norm() / hf_out.float().norm()).item()
+
+    hf_seconds = time_steps(lambda: run_hf(hf_layers, x, rotary_embed), args.steps)
+    native_seconds = time_steps(lambda: run_native(native, x, rotary_embed), args.steps)
+    results = dict(
+        relative_diff=diff,
+        step_ms=dict(transformers=hf_seconds * 1000, native=native_seconds * 1000),
+        import_seconds=dict(
+            transformers=import_seconds("import transformers.models.llama.modeling_llama"),
+            native=import_seconds("import model.modules"),
+        ),
+    )
+
+    print(f"{depth} blocks, dim {dim}, {heads} heads, batch {args.batch}, {args.frames} frames, {args.dtype}")
+    print(f"{'impl':<13} {'ms/step':>9} {'import s':>9}")
+    for name in ("transformers", "native"):
+        print(f"{name:<13} {results['step_ms'][name]:>9.1f} {results['import_seconds'][name]:>9.2f}")
+    print(f"speedup {hf_seconds / native_seconds:.2f}x, relative difference {diff:.2e}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if diff > args.max_diff:
+        raise SystemExit(f"parity check failed: relative difference {diff:.2e} > {args.max_diff}")
@@ -35,6 +35,33 @@ from infer_utils import (
 )
 
 
+def postprocess_latent(latent, vae_model, chunked=False):
+    latent = latent.to(torch.float32)
+    latent = latent.transpose(1, 2)  # [b d t]
+
+    output = decode_audio(latent, vae_model, chunked=chunked)
+
+    # Rearrange audio batch to a single sequence
+    output = rearrange(output, "b d n -> d (b n)")
+    # Peak normalize, clip, convert to int16, and save to file
+    output = (
+        output.to(torch.float32)
+        .div(torch.max(torch.abs(output)))
+        .clamp(-1, 1)
+        .mul(32767)
+        .to(torch.int16)
+        .cpu()
+    )
+    return output
+
+
+def preview_audio(latent, vae_model, max_frames=None):
+    """Decode the first max_frames latent frames of a sampling preview, chunked to bound memory."""
+    if max_frames is not None:
+        latent = latent[:, :max_frames]
+    return postprocess_latent(latent, vae_model, chunked=latent.shape[1] > 128)
+
+
 def inference(
     cfm_model,
     vae_model,
@@ -48,6 +75,21 @@ def inference(
     batch_infer_num,
     song_duration,
     chunked=False,
+    batch_cfg=False,
+    steps=32,
+    cfg_strength=4.0,
+    solver=None,
+    solver_options=None,
+    schedule="linear",
+    sway_sampling_coef=None,
+    cfg_interval=None,
+    cfg_cache_steps=1,
+    deep_cache_interval=1,
+    deep_cache_depth=None,
+    attn_chunk_size=None,
+    merge_ratio=None,
+    preview_callback=None,
+    preview_interval=8,
 ):
     with torch.inference_mode():
         latents, _ = cfm_model.sample(
@@ -58,32 +100,110 @@ def inference(
             max_duration=duration,
             song_duration=song_duration, 
             negative_style_prompt=negative_style_prompt,
-            steps=32,
-            cfg_strength=4.0,
+            steps=steps,
+            cfg_strength=cfg_strength,
+            sway_sampling_coef=sway_sampling_coef,
+            solver=solver,
+            solver_options=solver_options,
+            schedule=schedule,
+            cfg_interval=cfg_interval,
+            cfg_cache_steps=cfg_cache_steps,
+            deep_cache_interval=deep_cache_interval,
+            deep_cache_depth=deep_cache_depth,
+            attn_chunk_size=attn_chunk_size,
+            merge_ratio=merge_ratio,
+            preview_callback=preview_callback,
+            preview_interval=preview_interval,
             start_time=start_time,
             latent_pred_segments=pred_frames,
-            batch_infer_num=batch_infer_num
+            batch_infer_num=batch_infer_num,
+            batch_cfg=batch_cfg
         )
 
         outputs = []
         for latent in latents:
-            latent = latent.to(torch.float32)
-            latent = latent.transpose(1, 2)  # [b d t]
-
-            output = decode_audio(latent, vae_model, chunked=chunked)
-
-            # Rearrange audio batch to a single sequence
-            output = rearrange(output, "b d n -> d (b n)")
-            # Peak normalize, clip, convert to int16, and save to file
-            output = (
-                output.to(torch.float32)
-                .div(torch.max(torch.abs(output)))
-                .clamp(-1, 1)
-                .mul(32767)
-                .to(torch.int16)
-                .cpu()
-            )
-            outputs.append(output)
+            outputs.append(postprocess_latent(latent, vae_model, chunked=chunked))
+
+        return outputs
+
+
+def batch_inference(
+    cfm_model,
+    vae_model,
+    cond,
+    text,
+    duration,
+    style_prompt,
+    negative_style_prompt,
+    start_time,
+    pred_frames,
+    song_duration,
+    chunked=False,
+    batch_cfg=False,
+    steps=32,
+    cfg_strength=4.0,
+    solver=None,
+    solver_options=None,
+    schedule="linear",
+    sway_sampling_coef=None,
+    cfg_interval=None,
+    cfg_cache_steps=1,
+    deep_cache_interval=1,
+    deep_cache_depth=None,
+    attn_chunk_size=None,
+    merge_ratio=None,
+    preview_callback=None,
+    preview_interval=8,
+):
+    """Sample a batch of different songs in one call, one output per batch row.
+
+    All inputs are stacked along the batch dimension. `duration` is an int or a
+    list with one frame count per row (lyrics are padded to the longest), and
+    `pred_frames` is either shared or a list with one segment list per row.
+    `chunked` may be a list with one flag per row. `solver` and `schedule` name
+    entries of CFM.solvers / CFM.schedules (see model/solvers.py).
+    `preview_callback(evals, t, latents)` receives the clean estimate of all rows
+    every `preview_interval` model evaluations, see `preview_audio` to decode it.
+    """
+    batch = cond.shape[0]
+    if isinstance(duration, int):
+        duration = [duration] * batch
+    if not isinstance(chunked, (list, tuple)):
+        chunked = [chunked] * batch
+
+    with torch.inference_mode():
+        (latents,), _ = cfm_model.sample(
+            cond=cond,
+            text=text,
+            duration=duration,
+            style_prompt=style_prompt,
+            max_duration=max(duration),
+            song_duration=song_duration,
+            negative_style_prompt=negative_style_prompt,
+            steps=steps,
+            cfg_strength=cfg_strength,
+            sway_sampling_coef=sway_sampling_coef,
+            solver=solver,
+            solver_options=solver_options,
+            schedule=schedule,
+            cfg_interval=cfg_interval,
+            cfg_cache_steps=cfg_cache_steps,
+            deep_cache_interval=deep_cache_interval,
+            deep_cache_depth=deep_cache_depth,
+            attn_chunk_size=attn_chunk_size,
+            merge_ratio=merge_ratio,
+            preview_callback=preview_callback,
+            preview_interval=preview_interval,
+            start_time=start_time,
+            latent_pred_segments=pred_frames,
+            batch_infer_num=1,
+            batch_cfg=batch_cfg
+        )
+
+        outputs = []
+        for i in range(batch):
+            latent = latents[i : i + 1, : duration[i]]
+            outputs.append(postprocess_latent(latent, vae_model, chunked=chunked[i]))
 
         return outputs
 
@@ -153,6 +273,138 @@ if __name__ == "__main__":
         required=False,
         help="number of songs per batch",
     )  # number of songs per batch
+    parser.add_argument(
+        "--batch-cfg",
+        action="store_true",
+        help="run the conditional and unconditional guidance branches in one batched forward",
+    )  # batched classifier-free guidance
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=32,
+        help="number of sampling steps",
+    )  # number of sampling steps
+    parser.add_argument(
+        "--solver",
+        type=str,
+        default="euler",
+        help="ODE solver: euler, midpoint, heun, multistep, adaptive, picard, or any torchdiffeq method",
+    )  # ode solver
+    parser.add_argument(
+        "--picard-window",
+        type=int,
+        default=8,
+        help="picard solver: steps evaluated together in one batched forward",
+    )  # parallel-in-time window
+    parser.add_argument(
+        "--picard-tol",
+        type=float,
+        default=1e-3,
+        help="picard solver: RMS update below which a step is final",
+    )  # parallel-in-time tolerance
+    parser.add_argument(
+        "--schedule",
+        type=str,
+        default="linear",
+        choices=["linear", "cosine", "logit_normal"],
+        help="timestep schedule",
+    )  # timestep schedule
+    parser.add_argument(
+        "--sway-sampling-coef",
+        type=float,
+        default=None,
+        help="sway sampling coefficient, e.g. -1 to spend more steps near noise",
+    )  # sway sampling
+    parser.add_argument(
+        "--cfg-interval",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("T_LO", "T_HI"),
+        help="apply classifier-free guidance only for t within this interval, e.g. `0 0.8`",
+    )  # guidance interval
+    parser.add_argument(
+        "--cfg-cache-steps",
+        type=int,
+        default=1,
+        help="evaluate the unconditional branch every k guided steps and reuse the guidance in between",
+    )  # guidance caching
+    parser.add_argument(
+        "--deep-cache-interval",
+        type=int,
+        default=1,
+        help="run all DiT blocks every k model calls and reuse the deep block features in between",
+    )  # deep feature caching
+    parser.add_argument(
+        "--deep-cache-depth",
+        type=int,
+        default=None,
+        help="number of shallow DiT blocks recomputed on cached calls (default: a quarter of the blocks)",
+    )  # deep feature caching
+    parser.add_argument(
+        "--attn-chunk-size",
+        type=int,
+        default=None,
+        help="attend over chunks of this many frames (exact), bounds attention memory for long songs",
+    )  # chunked attention
+    parser.add_argument(
+        "--merge-ratio",
+        type=lambda value: [float(r) for r in value.split(",")],
+        default=None,
+        help="token merging: fraction of frames merged per DiT block, one value or comma separated per block",
+    )  # token merging
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="compile the DiT with torch.compile, sequence lengths are padded to static buckets",
+    )  # compiled inference
+    parser.add_argument(
+        "--tensor-parallel",
+        action="store_true",
+        help="shard the DiT blocks over the processes started by torchrun, e.g. torchrun --nproc_per_node 2",
+    )  # tensor-parallel DiT
+    parser.add_argument(
+        "--pipeline-parallel",
+        action="store_true",
+        help="split the DiT blocks into stages over the processes started by torchrun, e.g. torchrun --nproc_per_node 2; "
+        "implies --batch-cfg, the guidance branches are the pipeline micro-batches",
+    )  # pipeline-parallel DiT
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="convert the DiT linear layers to int8 weights, for CPU inference",
+    )  # int8 quantization
+    parser.add_argument(
+        "--quantized-path",
+        type=str,
+        default=None,
+        help="load a DiT quantized by infer/quantize.py instead of the checkpoint",
+    )  # int8 quantization
+    parser.add_argument(
+        "--stream-budget",
+        type=float,
+        default=None,
+        help="GB of DiT block weights kept on the device, the other blocks are streamed in per call (0: stream all)",
+    )  # weight streaming
+    parser.add_argument(
+        "--stream-path",
+        type=str,
+        default=None,
+        help="memory-map the streamed block weights from this file (written on first use) instead of host memory; "
+        "on CPU they are always memory-mapped, from a temporary file when this is not given",
+    )  # weight streaming
+    parser.add_argument(
+        "--preview-interval",
+        type=int,
+        default=None,
+        help="write a preview of the song to preview.wav every k model evaluations while sampling",
+    )  # progressive preview
+    parser.add_argument(
+        "--preview-seconds",
+        type=float,
+        default=30,
+        help="length of the previews in seconds",
+    )  # progressive preview
     args = parser.parse_args()
 
     assert (
@@ -172,6 +424,24 @@ if __name__ == "__main__":
     elif torch.mps.is_available():
         device = "mps"
 
+    assert not (
+        args.tensor_parallel and args.pipeline_parallel
+    ), "tensor and pipeline parallelism can not be combined"
+    assert not (
+        args.compile and args.stream_budget is not None
+    ), "compiled inference can not stream weights"
+    assert not (
+        args.compile and args.merge_ratio is not None
+    ), "compiled inference does not merge tokens, the merged lengths would each be compiled"
+    if args.pipeline_parallel:
+        # with separate guidance forwards of one song every call is a single micro-batch and the stages run in turn
+        args.batch_cfg = True
+    rank = 0
+    if args.tensor_parallel or args.pipeline_parallel:
+        from model.parallel import init_distributed, shard_dit, sync_seed
+
+        rank, world_size, device = init_distributed()
+
     audio_length = args.audio_length
     if audio_length == 95:
         max_frames = 2048
@@ -183,24 +453,48 @@ if __name__ == "__main__":
             "Supported values are exactly 95 or any value between 96 and 285 (inclusive)."
         )
 
-    cfm, tokenizer, muq, vae = prepare_model(max_frames, device)
+    cfm, tokenizer, muq, vae = prepare_model(
+        max_frames, device, quantize=args.quantize, quantized_path=args.quantized_path,
+        pipeline=args.pipeline_parallel,
+        stream_budget=int(args.stream_budget * 1024**3) if args.stream_budget is not None else None,
+        stream_path=args.stream_path,
+    )
+    if args.tensor_parallel:
+        shard_dit(cfm.transformer)
+    if args.compile:
+        cfm.compile_for_inference()
 
     if args.lrc_path:
         with open(args.lrc_path, "r", encoding='utf-8') as f:
             lrc = f.read()
     else:
         lrc = ""
-    lrc_prompt, start_time, end_frame, song_duration = get_lrc_token(max_frames, lrc, tokenizer, audio_length, device)
+    dtype = next(cfm.parameters()).dtype
+    lrc_prompt, start_time, end_frame, song_duration = get_lrc_token(max_frames, lrc, tokenizer, audio_length, device, dtype=dtype)
 
     if args.ref_audio_path:
-        style_prompt = get_style_prompt(muq, args.ref_audio_path)
+        style_prompt = get_style_prompt(muq, args.ref_audio_path, dtype=dtype)
     else:
-        style_prompt = get_style_prompt(muq, prompt=args.ref_prompt)
+        style_prompt = get_style_prompt(muq, prompt=args.ref_prompt, dtype=dtype)
 
-    negative_style_prompt = get_negative_style_prompt(device)
+    negative_style_prompt = get_negative_style_prompt(device, dtype=dtype)
 
     latent_prompt, pred_frames = get_reference_latent(device, max_frames, args.edit, args.edit_segments, args.ref_song, vae)
 
+    output_dir = args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    if args.tensor_parallel or args.pipeline_parallel:
+        # every rank samples from the same noise, rank 0 writes the results
+        sync_seed()
+
+    preview_callback = None
+    if args.preview_interval and rank == 0:
+        def preview_callback(evals, t, latents):
+            preview = preview_audio(latents[:1], vae, max_frames=int(args.preview_seconds * 44100 / 2048))
+            torchaudio.save(os.path.join(output_dir, "preview.wav"), preview, sample_rate=44100)
+            print(f"preview at t={t:.2f} ({evals} model evaluations, {time.time() - s_t:.2f} seconds)")
+
     s_t = time.time()
     generated_songs = inference(
         cfm_model=cfm,
@@ -214,15 +508,27 @@ if __name__ == "__main__":
         pred_frames=pred_frames,
         chunked=args.chunked,
         batch_infer_num=args.batch_infer_num,
-        song_duration=song_duration
+        song_duration=song_duration,
+        batch_cfg=args.batch_cfg,
+        steps=args.steps,
+        solver=args.solver,
+        solver_options=dict(window=args.picard_window, tol=args.picard_tol) if args.solver == "picard" else None,
+        schedule=args.schedule,
+        sway_sampling_coef=args.sway_sampling_coef,
+        cfg_interval=args.cfg_interval,
+        cfg_cache_steps=args.cfg_cache_steps,
+        deep_cache_interval=args.deep_cache_interval,
+        deep_cache_depth=args.deep_cache_depth,
+        attn_chunk_size=args.attn_chunk_size,
+        merge_ratio=args.merge_ratio,
+        preview_callback=preview_callback,
+        preview_interval=args.preview_interval or 8,
     )
     e_t = time.time() - s_t
     print(f"inference cost {e_t:.2f} seconds")
     
-    generated_song = random.sample(generated_songs, 1)[0]
-
-    output_dir = args.output_dir
-    os.makedirs(output_dir, exist_ok=True)
+    if rank == 0:
+        generated_song = random.sample(generated_songs, 1)[0]
 
-    output_path = os.path.join(output_dir, "output.wav")
-    torchaudio.save(output_path, generated_song, sample_rate=44100)
+        output_path = os.path.join(output_dir, "output.wav")
+        torchaudio.save(output_path, generated_song, sample_rate=44100)
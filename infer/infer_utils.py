@@ -29,6 +29,7 @@ from sys import path
 path.append(os.getcwd())
 
 from model import DiT, CFM
+from model.quantization import quantize_dit
 
 def vae_sample(mean, scale):
     stdev = torch.nn.functional.softplus(scale) + 1e-4
@@ -210,17 +211,30 @@ def encode_audio(audio, vae_model, chunked=False, overlap=32, chunk_size=128):
             y_final[:,:,t_start:t_end] = y_chunk[:,:,chunk_start:chunk_end]
         return y_final
 
-def prepare_model(max_frames, device, repo_id="ASLP-lab/DiffRhythm-1_2"):
-    # prepare cfm model
+def prepare_cfm_model(
+    max_frames, device, repo_id="ASLP-lab/DiffRhythm-1_2", dtype=None, quantize=False, quantized_path=None, pipeline=False,
+    stream_budget=None, stream_path=None,
+):
+    """Load the CFM model.
+
+    dtype defaults to float32 on CPU, where half precision matmuls are slow, and float16
+    elsewhere. With `quantize` the DiT linear layers are converted to int8 after loading;
+    `quantized_path` loads an artifact saved by infer/quantize.py instead of the checkpoint.
+    With `pipeline` only this rank's pipeline stage of the DiT blocks is built and loaded,
+    the process group must be initialized (model.parallel). With `stream_budget` (bytes of
+    DiT block weights on the device, 0 for none) the model is loaded on the CPU and the
+    blocks that do not fit are streamed from host memory, or from a memory-mapped file
+    at `stream_path` (model.streaming).
+    """
+    if dtype is None:
+        dtype = torch.float32 if device == "cpu" else torch.float16
+    load_device = "cpu" if stream_budget is not None else device
+
     if max_frames == 2048:
         repo_id = "ASLP-lab/DiffRhythm-1_2"
     else:
         repo_id = "ASLP-lab/DiffRhythm-1_2-full"
-        
-    dit_ckpt_path = hf_hub_download(
-        repo_id=repo_id, filename="cfm_model.pt", cache_dir="./pretrained"
-    )
-        
+
     dit_config_path = "./config/diffrhythm-1b.json"
     with open(dit_config_path) as f:
         model_config = json.load(f)
@@ -230,8 +244,45 @@ def prepare_model(max_frames, device, repo_id="ASLP-lab/DiffRhythm-1_2"):
         num_channels=model_config["model"]["mel_dim"],
         max_frames=max_frames
     )
-    cfm = cfm.to(device)
-    cfm = load_checkpoint(cfm, dit_ckpt_path, device=device, use_ema=False)
+    if pipeline:
+        from model.parallel import pipeline_dit
+
+        pipeline_dit(cfm.transformer)
+
+    if quantized_path:
+        quantize_dit(cfm.transformer)
+        cfm.load_state_dict(torch.load(quantized_path, map_location="cpu", weights_only=True), strict=not pipeline)
+        return stream_cfm_model(cfm.to(device=load_device, dtype=dtype), device, stream_budget, stream_path)
+
+    dit_ckpt_path = hf_hub_download(
+        repo_id=repo_id, filename="cfm_model.pt", cache_dir="./pretrained"
+    )
+    cfm = cfm.to(load_device)
+    cfm = load_checkpoint(cfm, dit_ckpt_path, device=load_device, use_ema=False, dtype=torch.float32 if quantize else dtype)
+    if quantize:
+        quantize_dit(cfm.transformer)
+        cfm = cfm.to(dtype)
+    return stream_cfm_model(cfm, device, stream_budget, stream_path)
+
+
+def stream_cfm_model(cfm, device, stream_budget=None, stream_path=None):
+    if stream_budget is None:
+        return cfm
+    from model.streaming import stream_dit
+
+    stream_dit(cfm.transformer, device, budget=stream_budget, path=stream_path)
+    return cfm.to(device)
+
+
+def prepare_model(
+    max_frames, device, repo_id="ASLP-lab/DiffRhythm-1_2", dtype=None, quantize=False, quantized_path=None, pipeline=False,
+    stream_budget=None, stream_path=None,
+):
+    # prepare cfm model
+    cfm = prepare_cfm_model(
+        max_frames, device, repo_id=repo_id, dtype=dtype, quantize=quantize, quantized_path=quantized_path,
+        pipeline=pipeline, stream_budget=stream_budget, stream_path=stream_path,
+    )
 
     # prepare tokenizer
     tokenizer = CNENTokenizer()
@@ -282,22 +333,22 @@ def get_reference_latent(device, max_frames, edit, pred_segments, ref_song, vae_
         return prompt, pred_frames
 
 
-def get_negative_style_prompt(device):
+def get_negative_style_prompt(device, dtype=torch.float16):
     file_path = "infer/example/vocal.npy"
     vocal_stlye = np.load(file_path)
 
     vocal_stlye = torch.from_numpy(vocal_stlye).to(device)  # [1, 512]
-    vocal_stlye = vocal_stlye.half()
+    vocal_stlye = vocal_stlye.to(dtype)
 
     return vocal_stlye
 
 
 @torch.no_grad()
-def get_style_prompt(model, wav_path=None, prompt=None):
+def get_style_prompt(model, wav_path=None, prompt=None, dtype=torch.float16):
     mulan = model
 
     if prompt is not None:
-        return mulan(texts=prompt).half()
+        return mulan(texts=prompt).to(dtype)
 
     ext = os.path.splitext(wav_path)[-1].lower()
     if ext == ".mp3":
@@ -325,7 +376,7 @@ def get_style_prompt(model, wav_path=None, prompt=None):
         audio_emb = mulan(wavs=wav)  # [1, 512]
 
     audio_emb = audio_emb
-    audio_emb = audio_emb.half()
+    audio_emb = audio_emb.to(dtype)
 
     return audio_emb
 
@@ -363,7 +414,7 @@ class CNENTokenizer:
         return "|".join([self.id2phone[x - 1] for x in token])
 
 
-def get_lrc_token(max_frames, text, tokenizer, max_secs, device):
+def get_lrc_token(max_frames, text, tokenizer, max_secs, device, dtype=torch.float16):
 
     lyrics_shift = 0
     sampling_rate = 44100
@@ -423,16 +474,16 @@ def get_lrc_token(max_frames, text, tokenizer, max_secs, device):
     lrc_emb = lrc.unsqueeze(0).to(device)
 
     normalized_start_time = torch.tensor(normalized_start_time).unsqueeze(0).to(device)
-    normalized_start_time = normalized_start_time.half()
+    normalized_start_time = normalized_start_time.to(dtype)
     
     normalized_duration = torch.tensor(normalized_duration).unsqueeze(0).to(device)
-    normalized_duration = normalized_duration.half()
+    normalized_duration = normalized_duration.to(dtype)
 
     return lrc_emb, normalized_start_time, end_frame, normalized_duration
 
 
-def load_checkpoint(model, ckpt_path, device, use_ema=True):
-    model = model.half()
+def load_checkpoint(model, ckpt_path, device, use_ema=True, dtype=torch.float16):
+    model = model.to(dtype)
 
     ckpt_type = ckpt_path.split(".")[-1]
     if ckpt_type == "safetensors":
@@ -450,10 +501,28 @@ def load_checkpoint(model, ckpt_path, device, use_ema=True):
             for k, v in checkpoint["ema_model_state_dict"].items()
             if k not in ["initted", "step"]
         }
-        model.load_state_dict(checkpoint["model_state_dict"], strict=False)
+        check_block_keys(model, model.load_state_dict(checkpoint["model_state_dict"], strict=False))
     else:
         if ckpt_type == "safetensors":
             checkpoint = {"model_state_dict": checkpoint}
-        model.load_state_dict(checkpoint["model_state_dict"], strict=False)
+        check_block_keys(model, model.load_state_dict(checkpoint["model_state_dict"], strict=False))
 
     return model.to(device)
+
+
+def check_block_keys(model, result, prefix="transformer.transformer_blocks."):
+    """Raise if the DiT blocks did not load completely.
+
+    The checkpoint is loaded non-strictly, other keys may differ between versions, but
+    the blocks' fused projections rely on remapping the Llama keys, and a key missed
+    there would leave randomly initialized weights. Unexpected keys of blocks another
+    pipeline stage holds (placeholders without weights) are expected.
+    """
+    blocks = model.get_submodule(prefix.rstrip("."))
+    held = {str(i) for i, block in enumerate(blocks) if any(True for _ in block.parameters())}
+    missing = [k for k in result.missing_keys if k.startswith(prefix)]
+    unexpected = [k for k in result.unexpected_keys if k.startswith(prefix) and k[len(prefix):].split(".")[0] in held]
+    if missing or unexpected:
+        raise RuntimeError(
+            f"DiT block weights did not load, missing keys: {missing[:8]}, unexpected keys: {unexpected[:8]}"
+        )
@@ -0,0 +1,149 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Check and benchmark of the tensor- and pipeline-parallel DiT with local processes.
+
+Runs one DiT forward (random weights from the config) on a single process,
+then sharded (--mode tensor) or split into stages (--mode pipeline) over
+--world-size local processes (gloo on CPU, NCCL with one GPU
+per process), checks that the sharded output matches and reports the latency
+of both. On CPU each process gets its share of --threads, so the comparison
+is at equal compute.
+
+    python infer/parallel_benchmark.py --config ./config/diffrhythm-1b.json --world-size 2 --frames 2048 --depth 4
+    python infer/parallel_benchmark.py --mode pipeline --world-size 2 --micro-batches 2 --depth 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.append(os.getcwd())
+
+from model import DiT
+from model.parallel import pipeline_dit, shard_dit
+
+
+def build_dit(args, device):
+    with open(args.config) as f:
+        model_config = json.load(f)["model"]
+    if args.depth:
+        model_config["depth"] = args.depth
+    torch.manual_seed(args.seed)
+    dit = DiT(**model_config, max_frames=6144 if args.frames > 2048 else 2048)
+    for p in dit.text_fusion_linears.parameters():
+        p.data.normal_(0, 0.02)  # zero-initialized in the checkpointless model
+    return dit.to(device).eval(), model_config
+
+
+def build_inputs(model_config, args, device):
+    generator = torch.Generator().manual_seed(args.seed)
+    batch, n = args.batch, args.frames
+    return dict(
+        x=torch.randn(batch, n, model_config["mel_dim"], generator=generator).to(device),
+        cond=torch.randn(batch, n, model_config["mel_dim"], generator=generator).to(device),
+        text=torch.randint(0, model_config["text_num_embeds"], (batch, n), generator=generator).to(device),
+        time=torch.rand(batch, generator=generator).to(device),
+        drop_audio_cond=False,
+        drop_text=False,
+        style_prompt=torch.randn(batch, 512, generator=generator).to(device),
+        start_time=torch.zeros(batch).to(device),
+        duration=torch.full((batch,), n / 6144).to(device),
+    )
+
+
+@torch.inference_mode()
+def time_forward(dit, inputs, steps, warmup=1):
+    for _ in range(warmup):
+        out = dit(**inputs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        out = dit(**inputs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - start) / steps
+
+
+def worker(rank, args, reference_path, port):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    backend = "nccl" if args.device == "cuda" else "gloo"
+    dist.init_process_group(backend, rank=rank, world_size=args.world_size)
+    device = f"cuda:{rank}" if args.device == "cuda" else "cpu"
+    if args.device == "cuda":
+        torch.cuda.set_device(rank)
+    else:
+        torch.set_num_threads(max(1, args.threads // args.world_size))
+
+    dit, model_config = build_dit(args, device)
+    if args.mode == "tensor":
+        shard_dit(dit)
+    else:
+        pipeline_dit(dit, micro_batches=args.micro_batches)
+    parameters = sum(p.numel() for p in dit.parameters())
+    out, seconds = time_forward(dit, build_inputs(model_config, args, device), args.steps)
+
+    if rank == 0:
+        reference = torch.load(reference_path)
+        diff = ((out.float().cpu() - reference["out"]).norm() / reference["out"].norm()).item()
+        print(f"{model_config['depth']} blocks, dim {model_config['dim']}, batch {args.batch}, {args.frames} frames")
+        print(f"{'processes':<10} {'ms/forward':>11}")
+        print(f"{1:<10} {reference['seconds'] * 1000:>11.1f}")
+        print(f"{args.world_size:<10} {seconds * 1000:>11.1f}")
+        print(f"{parameters / 1e6:.0f}M DiT parameters on rank 0")
+        print(f"speedup {reference['seconds'] / seconds:.2f}x, relative difference {diff:.2e}")
+        if diff > args.max_diff:
+            raise SystemExit(f"parity check failed: relative difference {diff:.2e} > {args.max_diff}")
+    dist.destroy_process_group()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="tensor- or pipeline-parallel DiT vs single process")
+    parser.add_argument("--mode", type=str, default="tensor", choices=["tensor", "pipeline"])
+    parser.add_argument("--config", type=str, default="./config/diffrhythm-1b.json")
+    parser.add_argument("--world-size", type=int, default=2, help="number of local processes")
+    parser.add_argument("--frames", type=int, default=2048, help="sequence length in latent frames")
+    parser.add_argument("--batch", type=int, default=2, help="2 matches a batched CFG step")
+    parser.add_argument("--micro-batches", type=int, default=2, help="pipeline micro-batches per forward")
+    parser.add_argument("--depth", type=int, default=None, help="number of blocks, default: the config depth")
+    parser.add_argument("--steps", type=int, default=3, help="timed forward passes")
+    parser.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads(), help="CPU threads, split over the processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=29511)
+    parser.add_argument("--max-diff", type=float, default=1e-4, help="fail when the relative difference exceeds this")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    device = "cuda:0" if args.device == "cuda" else "cpu"
+    torch.set_num_threads(args.threads)
+
+    dit, model_config = build_dit(args, device)
+    out, seconds = time_forward(dit, build_inputs(model_config, args, device), args.steps)
+    del dit
+
+    with tempfile.TemporaryDirectory() as tmp:
+        reference_path = os.path.join(tmp, "reference.pt")
+        torch.save(dict(out=out.float().cpu(), seconds=seconds), reference_path)
+        mp.spawn(worker, args=(args, reference_path, args.port), nprocs=args.world_size)
@@ -0,0 +1,127 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""INT8 quantization of the DiT for CPU inference.
+
+Converts the DiT linear layers to int8 weights with per-channel scales, checks
+parity against the float32 model and reports DiT throughput in latent frames
+(tokens) per second for both.
+
+    python infer/quantize.py --audio-length 95 --output pretrained/cfm_int8_2048.pt
+
+The saved artifact is loaded with `prepare_cfm_model(..., quantized_path=...)`,
+or QUANTIZED_MODEL_PATH in the API.
+"""
+
+import argparse
+import json
+import os
+
+import torch
+
+from benchmark import build_inputs, build_random_cfm, drift, run_variant
+from infer_utils import prepare_cfm_model
+from model.quantization import Int8Linear, quantize_dit
+
+
+def count_tokens(cfm):
+    """Count the latent frames the DiT processes, returns the counter and the hook handle."""
+    tokens = [0]
+
+    def hook(module, args, kwargs):
+        x = kwargs.get("x", args[0] if args else None)
+        tokens[0] += x.shape[0] * x.shape[1]
+
+    handle = cfm.transformer.register_forward_pre_hook(hook, with_kwargs=True)
+    return tokens, handle
+
+
+def measure(cfm, inputs, variant, seed, repeats):
+    tokens, handle = count_tokens(cfm)
+    try:
+        latents, seconds, stats = run_variant(cfm, inputs, variant, seed, repeats, "cpu")
+    finally:
+        handle.remove()
+    return dict(latents=latents, seconds=seconds, dit_calls=stats["dit"], tokens_per_second=tokens[0] / repeats / seconds)
+
+
+def weight_errors(dit, float_weights):
+    errors = {}
+    for name, module in dit.named_modules():
+        if isinstance(module, Int8Linear):
+            weight = float_weights[name]
+            errors[name] = ((module.dequantize() - weight).norm() / weight.norm()).item()
+    return errors
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="quantize the DiT to int8, check parity and throughput")
+    parser.add_argument("--audio-length", type=int, default=95, help="95 or any value between 96 and 285")
+    parser.add_argument("--output", type=str, default=None, help="save the quantized model to this file")
+    parser.add_argument("--steps", type=int, default=8, help="sampling steps of the parity and throughput run")
+    parser.add_argument("--cfg-strength", type=float, default=4.0)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=1, help="timed runs per model")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-drift", type=float, default=0.1, help="fail when the relative drift exceeds this")
+    parser.add_argument("--skip-check", action="store_true", help="only quantize and save")
+    parser.add_argument("--random-weights", action="store_true", help="skip the checkpoint download, timing only")
+    parser.add_argument("--config", type=str, default="./config/diffrhythm-1b.json", help="model config for --random-weights")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+
+    max_frames = 2048 if args.audio_length == 95 else 6144
+    if args.random_weights:
+        cfm = build_random_cfm(args.config, max_frames, "cpu", torch.float32)
+    else:
+        cfm = prepare_cfm_model(max_frames, "cpu", dtype=torch.float32)
+
+    results = {}
+    if not args.skip_check:
+        inputs = build_inputs(cfm, args.audio_length, None, args.batch, "cpu", torch.float32, args.seed)
+        variant = dict(solver="euler", steps=args.steps, cfg_strength=args.cfg_strength, batch_cfg=True)
+        float_run = measure(cfm, inputs, variant, args.seed, args.repeats)
+        float_weights = {name: m.weight.detach().clone() for name, m in cfm.transformer.named_modules()
+                         if isinstance(m, torch.nn.Linear)}
+
+    quantize_dit(cfm.transformer)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        torch.save(cfm.state_dict(), args.output)
+        print(f"saved quantized model to {args.output}")
+
+    if not args.skip_check:
+        int8_run = measure(cfm, inputs, variant, args.seed, args.repeats)
+        errors = weight_errors(cfm.transformer, float_weights)
+        results = dict(
+            drift=drift(int8_run["latents"], float_run["latents"]),
+            max_weight_error=max(errors.values()),
+            float32=dict(seconds=float_run["seconds"], tokens_per_second=float_run["tokens_per_second"]),
+            int8=dict(seconds=int8_run["seconds"], tokens_per_second=int8_run["tokens_per_second"]),
+        )
+        print(f"{'model':<8} {'seconds':>9} {'tokens/s':>10}")
+        for name in ("float32", "int8"):
+            print(f"{name:<8} {results[name]['seconds']:>9.2f} {results[name]['tokens_per_second']:>10.0f}")
+        print(f"speedup {float_run['seconds'] / int8_run['seconds']:.2f}x, "
+              f"relative drift {results['drift']:.4f}, max relative weight error {results['max_weight_error']:.4f}")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        if results["drift"] > args.max_drift:
+            raise SystemExit(f"parity check failed: drift {results['drift']:.4f} > {args.max_drift}")
@@ -0,0 +1,89 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of DiT weight streaming against full residency.
+
+Runs sampling steps (one DiT forward of a batched CFG step, random weights
+from the config) with all blocks resident and then with the blocks streamed
+under each of --budgets GB of block weights, checks that the outputs match
+and reports steps per second and peak memory. --stream-path memory-maps the
+streamed weights from a file instead of host memory.
+
+    python infer/streaming_benchmark.py --device cuda --frames 2048 --budgets 0,1,2,4
+"""
+
+import argparse
+
+import torch
+
+from benchmark import PeakMemory
+from parallel_benchmark import build_dit, build_inputs, time_forward
+from model.streaming import block_tensors, stream_dit, tensor_bytes
+
+
+def resident_bytes(dit):
+    # block weights held on the device between steps
+    return sum(tensor_bytes(block_tensors(block).values()) for block in dit.transformer_blocks)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="DiT weight streaming vs full residency")
+    parser.add_argument("--config", type=str, default="./config/diffrhythm-1b.json")
+    parser.add_argument("--budgets", type=lambda value: [float(b) for b in value.split(",")], default=[0, 1, 2])
+    parser.add_argument("--stream-path", type=str, default=None, help="memory-map the streamed weights from this file")
+    parser.add_argument("--frames", type=int, default=2048, help="sequence length in latent frames")
+    parser.add_argument("--batch", type=int, default=2, help="2 matches a batched CFG step")
+    parser.add_argument("--depth", type=int, default=None, help="number of blocks, default: the config depth")
+    parser.add_argument("--steps", type=int, default=3, help="timed steps")
+    parser.add_argument("--dtype", type=str, default=None, choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-diff", type=float, default=1e-5, help="fail when the relative difference exceeds this")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    dtype = getattr(torch, args.dtype) if args.dtype else torch.float32 if args.device == "cpu" else torch.float16
+
+    def run(budget=None):
+        dit, model_config = build_dit(args, "cpu")
+        dit = dit.to(dtype)
+        if budget is None:
+            dit = dit.to(args.device)
+        else:
+            stream_dit(dit, args.device, budget=int(budget * 1024**3), path=args.stream_path)
+        inputs = {
+            k: v.to(dtype) if isinstance(v, torch.Tensor) and v.is_floating_point() else v
+            for k, v in build_inputs(model_config, args, args.device).items()
+        }
+        with PeakMemory(args.device) as memory:
+            out, seconds = time_forward(dit, inputs, args.steps)
+        return out.float().cpu(), seconds, resident_bytes(dit), memory.peak
+
+    reference, reference_seconds, reference_bytes, reference_peak = run()
+    rows = [("resident", reference_seconds, reference_bytes, reference_peak, 0.0)]
+    for budget in args.budgets:
+        out, seconds, resident, peak = run(budget)
+        diff = ((out - reference).norm() / reference.norm()).item()
+        rows.append((f"{budget:g} GB", seconds, resident, peak, diff))
+
+    print(f"{args.frames} frames, batch {args.batch}, {args.device}, {dtype}")
+    print(f"{'budget':<10} {'steps/s':>8} {'blocks MiB':>11} {'peak MiB':>9} {'rel diff':>9}")
+    for name, seconds, resident, peak, diff in rows:
+        peak = f"{peak / 2**20:>9.0f}" if peak is not None else f"{'-':>9}"
+        print(f"{name:<10} {1 / seconds:>8.2f} {resident / 2**20:>11.0f} {peak} {diff:>9.2e}")
+    worst = max(row[4] for row in rows)
+    if worst > args.max_diff:
+        raise SystemExit(f"parity check failed: relative difference {worst:.2e} > {args.max_diff}")
@@ -1,6 +1,14 @@
 from model.cfm import CFM
 from model.dit import DiT
-from model.trainer import Trainer
+
+
+def __getattr__(name):
+    # the trainer pulls in accelerate, wandb and ema_pytorch, inference does not need it
+    if name == "Trainer":
+        from model.trainer import Trainer
+
+        return Trainer
+    raise AttributeError(f"module 'model' has no attribute {name!r}")
 
 
 __all__ = ["CFM"]
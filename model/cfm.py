@@ -29,10 +29,10 @@ import torch
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
 
-from torchdiffeq import odeint
-
+from model.solvers import SOLVERS, SCHEDULES, get_timesteps
 from model.utils import (
     exists,
+    default,
     list_str_to_idx,
     list_str_to_tensor,
     lens_to_mask,
@@ -59,7 +59,32 @@ def custom_mask_from_start_end_indices(
     
     return res_mask
 
+
+def repeat_batch(t, n):
+    # n copies along the batch, as a view where possible: no-op for one copy, expand for a single sample
+    if n == 1:
+        return t
+    if t.shape[0] == 1:
+        return t.expand(n, *t.shape[1:])
+    return t.repeat(n, *([1] * (t.ndim - 1)))
+
+
+# static sequence lengths (frames) for compiled inference, requests are padded up to the next one
+LENGTH_BUCKETS = (2048, 2560, 3072, 3584, 4096, 4608, 5120, 5632, 6144)
+
+
+def bucket_length(length, buckets):
+    for bucket in buckets:
+        if bucket >= length:
+            return bucket
+    return length
+
+
 class CFM(nn.Module):
+    # sampling registries, name -> solver(fn, y0, t, return_trajectory, **options) / schedule(u)
+    solvers = SOLVERS
+    schedules = SCHEDULES
+
     def __init__(
         self,
         transformer: nn.Module,
@@ -109,6 +134,45 @@ class CFM(nn.Module):
         
         self.max_frames = max_frames
 
+        # set by compile_for_inference
+        self.length_buckets = None
+
+    def compile_for_inference(self, buckets=LENGTH_BUCKETS, mode=None):
+        """Compile the DiT for sampling and pad sequences to a few static lengths.
+
+        Lyrics give arbitrary song lengths, padding them up to `buckets` (the padding is
+        masked) lets every request reuse one of a few compiled graphs. `mode` is passed
+        to torch.compile, e.g. "reduce-overhead" for CUDA graphs.
+        """
+        self.length_buckets = tuple(sorted(b for b in buckets if b <= self.max_frames)) or (self.max_frames,)
+        self.transformer.compile_for_inference(mode=mode)
+
+    def warmup(self, lengths=None, batch_sizes=(1, 2), **sample_kwargs):
+        """Sample two steps per length bucket so compilation happens ahead of the first request.
+
+        Each bucket is run both filled and padded, as they take different graphs
+        (no attention mask / key padding mask), and with each of `batch_sizes`. The
+        DiT batch dimension is dynamic from 2 rows on, so the default of one and two
+        songs compiles the graphs every batch size is served with.
+        """
+        lengths = default(lengths, self.length_buckets or (self.max_frames,))
+        device, dtype = self.device, next(self.parameters()).dtype
+        for length in lengths:
+            for duration in (length, length - 1):
+                for batch_size in batch_sizes:
+                    self.sample(
+                        cond=torch.zeros(batch_size, length, self.num_channels, device=device, dtype=dtype),
+                        text=torch.zeros(batch_size, length, device=device, dtype=torch.long),
+                        duration=duration,
+                        max_duration=length,
+                        style_prompt=torch.zeros(batch_size, 512, device=device, dtype=dtype),
+                        negative_style_prompt=torch.zeros(batch_size, 512, device=device, dtype=dtype),
+                        start_time=torch.zeros(batch_size, device=device, dtype=dtype),
+                        song_duration=torch.ones(batch_size, device=device, dtype=dtype),
+                        latent_pred_segments=[(0, length)],
+                        **{**sample_kwargs, "steps": 2},
+                    )
+
     @property
     def device(self):
         return next(self.parameters()).device
@@ -137,23 +201,72 @@ class CFM(nn.Module):
         start_time=None,
         latent_pred_segments=None,
         song_duration=None,
-        batch_infer_num=1
+        batch_infer_num=1,
+        batch_cfg=False,
+        return_trajectory=False,
+        solver: str | None = None,
+        solver_options: dict | None = None,
+        schedule="linear",
+        cfg_interval: tuple[float, float] | None = None,
+        cfg_cache_steps=1,
+        cfg_cache_mode="delta",
+        deep_cache_interval=1,
+        deep_cache_depth: int | None = None,
+        deep_cache_mode="residual",
+        attn_chunk_size: int | None = None,
+        merge_ratio: float | list[float] | None = None,
+        preview_callback: Callable[[int, float, float["b n d"]], None] | None = None,  # noqa: F722
+        preview_interval=8,
     ):
+        # cfg_interval: guidance is applied only for t within [lo, hi], other steps run the conditional branch alone
+        # cfg_cache_steps: the unconditional branch is evaluated every k guided steps, the ones in between
+        #   reuse the cached guidance delta (cfg_cache_mode="delta") or unconditional prediction ("uncond")
+        # deep_cache_interval: all DiT blocks run every k evaluations, the ones in between recompute only
+        #   the first deep_cache_depth blocks and reuse the deeper blocks' features (see DiT.init_deep_cache)
+        # attn_chunk_size: exact attention over chunks of this many queries, bounds attention memory
+        # merge_ratio: token merging, fraction of the frames merged into a neighbour in each block (one value,
+        #   or one per block), lyric frames are never merged, see model/tome.py
+        # preview_callback: called every preview_interval model evaluations as (evals, t, latents) with the
+        #   one-step clean estimate x + (1 - t) * v of the current state, post-processed like the output
+        # solver="picard": the steps of a window (solver_options window, tol) are evaluated in one batched
+        #   DiT call per Picard iteration, fewer sequential calls for a wider batch, see picard_solver
+        assert cfg_cache_mode in ("delta", "uncond")
         self.eval()
 
-        if next(self.parameters()).dtype == torch.float16:
-            cond = cond.half()
-
-        # raw wave
-        if cond.shape[1] > duration:
-            cond = cond[:, :duration, :]
+        # prompts may come in another precision than the model, e.g. half precision prompts for a CPU model
+        dtype = next(self.parameters()).dtype
+        cond = cond.to(dtype)
+        style_prompt = style_prompt.to(dtype)
+        negative_style_prompt = negative_style_prompt.to(dtype)
+        start_time = start_time.to(dtype)
+        song_duration = song_duration.to(dtype)
 
         if cond.ndim == 2:
             cond = self.mel_spec(cond)
             cond = cond.permute(0, 2, 1)
             assert cond.shape[-1] == self.num_channels
 
-        batch, cond_seq_len, device = *cond.shape[:2], cond.device
+        batch, device = cond.shape[0], cond.device
+
+        # duration, one target length per sample
+        if isinstance(duration, int):
+            duration = torch.full((batch,), duration, device=device, dtype=torch.long)
+        else:
+            duration = torch.as_tensor(duration, device=device, dtype=torch.long)
+
+        duration = duration.clamp(max=max_duration)
+        max_duration = out_duration = int(duration.amax())
+        if exists(self.length_buckets):
+            # pad to a static length so compiled graphs are reused, the padding is masked like in a mixed batch
+            max_duration = bucket_length(max_duration, self.length_buckets)
+
+        # raw wave
+        if cond.shape[1] > max_duration:
+            cond = cond[:, :max_duration, :]
+        elif cond.shape[1] < max_duration:
+            cond = F.pad(cond, (0, 0, 0, max_duration - cond.shape[1]), value=0.0)
+
+        cond_seq_len = cond.shape[1]
         if not exists(lens):
             lens = torch.full((batch,), cond_seq_len, device=device, dtype=torch.long)
 
@@ -165,58 +278,211 @@ class CFM(nn.Module):
                 text = list_str_to_tensor(text).to(device)
             assert text.shape[0] == batch
 
+        # lyrics of shorter songs are padded with the filler token
+        if text.shape[1] < max_duration:
+            text = F.pad(text, (0, max_duration - text.shape[1]), value=0)
+        text = text[:, :max_duration]
+
         # duration
         cond_mask = lens_to_mask(lens)
         if edit_mask is not None:
             cond_mask = cond_mask & edit_mask
 
-        latent_pred_segments = torch.tensor(latent_pred_segments).to(cond.device)
-        fixed_span_mask = custom_mask_from_start_end_indices(cond_seq_len, latent_pred_segments, device=cond.device, max_seq_len=duration)
+        # latent_pred_segments is either shared, [(start, end), ...], or one such list per sample
+        if len(latent_pred_segments) == 0 or not isinstance(latent_pred_segments[0][0], (list, tuple)):
+            latent_pred_segments = [latent_pred_segments] * batch
+        assert len(latent_pred_segments) == batch
+        fixed_span_mask = torch.stack([
+            custom_mask_from_start_end_indices(
+                cond_seq_len, torch.tensor(segments, device=device), device=device, max_seq_len=max_duration
+            ).reshape(-1)
+            for segments in latent_pred_segments
+        ])
         fixed_span_mask = fixed_span_mask.unsqueeze(-1)
         step_cond = torch.where(fixed_span_mask, torch.zeros_like(cond), cond)
 
-        if isinstance(duration, int):
-            duration = torch.full((batch_infer_num,), duration, device=device, dtype=torch.long)
-
-        duration = duration.clamp(max=max_duration)
-        max_duration = duration.amax()
-
         # duplicate test corner for inner time step oberservation
         if duplicate_test:
             test_cond = F.pad(cond, (0, 0, cond_seq_len, max_duration - 2 * cond_seq_len), value=0.0)
 
-        if batch > 1:
-            mask = lens_to_mask(duration)
-        else:  # save memory and speed up, as single inference need no mask currently
+        if (duration != max_duration).any():
+            mask = lens_to_mask(duration, length=max_duration)
+        else:  # save memory and speed up, as a batch of equal lengths needs no mask
             mask = None
 
         # test for no ref audio
         if no_ref_audio:
             cond = torch.zeros_like(cond)
 
-        cond = cond.repeat(batch_infer_num, 1, 1)
-        step_cond = step_cond.repeat(batch_infer_num, 1, 1)
-        text = text.repeat(batch_infer_num, 1)
-        style_prompt = style_prompt.repeat(batch_infer_num, 1)
-        negative_style_prompt = negative_style_prompt.repeat(batch_infer_num, 1)
-        start_time = start_time.repeat(batch_infer_num)
-        fixed_span_mask = fixed_span_mask.repeat(batch_infer_num, 1, 1)
-        song_duration = song_duration.repeat(batch_infer_num)
+        cond = repeat_batch(cond, batch_infer_num)
+        step_cond = repeat_batch(step_cond, batch_infer_num)
+        text = repeat_batch(text, batch_infer_num)
+        style_prompt = repeat_batch(style_prompt, batch_infer_num)
+        negative_style_prompt = repeat_batch(negative_style_prompt, batch_infer_num)
+        start_time = repeat_batch(start_time, batch_infer_num)
+        fixed_span_mask = repeat_batch(fixed_span_mask, batch_infer_num)
+        song_duration = repeat_batch(song_duration, batch_infer_num)
+        duration = repeat_batch(duration, batch_infer_num)
+        if exists(mask):
+            mask = repeat_batch(mask, batch_infer_num)
+        x_batch = batch * batch_infer_num
+
+        use_cfg = cfg_strength >= 1e-5
+        # guidance interval and guidance caching run some steps on the conditional branch alone
+        cond_only_steps = use_cfg and (exists(cfg_interval) or cfg_cache_steps > 1)
+
+        if batch_cfg and use_cfg:
+            # conditional and unconditional branches stacked along the batch, dropped per sample
+            cfg_drop = torch.arange(2 * x_batch, device=device) >= x_batch
+            cfg_step_cond = torch.cat((step_cond, step_cond), dim=0)
+            cfg_text = torch.cat((text, text), dim=0)
+            cfg_style_prompt = torch.cat((style_prompt, negative_style_prompt), dim=0)
+            cfg_start_time = torch.cat((start_time, start_time), dim=0)
+            cfg_song_duration = torch.cat((song_duration, song_duration), dim=0)
+            cfg_mask = torch.cat((mask, mask), dim=0) if exists(mask) else None
+            cfg_cache = self.transformer.forward_timestep_invariant(
+                cfg_text, max_duration, cfg_drop, cfg_start_time, duration=cfg_song_duration, mask=cfg_mask
+            )
+        if not (batch_cfg and use_cfg) or cond_only_steps:
+            # conditioning that does not depend on t, computed once per branch
+            cond_cache = self.transformer.forward_timestep_invariant(
+                text, max_duration, False, start_time, duration=song_duration, mask=mask
+            )
+        if use_cfg and not batch_cfg:
+            null_cache = self.transformer.forward_timestep_invariant(
+                text, max_duration, True, start_time, duration=song_duration, mask=mask
+            )
 
-        def fn(t, x):
-            # predict flow
-            pred = self.transformer(
+        # one deep feature cache per call site
+        if deep_cache_interval > 1:
+            deep_caches = {
+                name: self.transformer.init_deep_cache(deep_cache_interval, depth=deep_cache_depth, mode=deep_cache_mode)
+                for name in ("cond", "null", "cfg")
+            }
+        else:
+            deep_caches = dict(cond=None, null=None, cfg=None)
+
+        def cond_pred(t, x):
+            return self.transformer(
                 x=x, cond=step_cond, text=text, time=t, drop_audio_cond=False, drop_text=False, drop_prompt=False,
-                style_prompt=style_prompt, start_time=start_time, duration=song_duration
+                style_prompt=style_prompt, start_time=start_time, duration=song_duration, mask=mask,
+                cache=cond_cache, deep_cache=deep_caches["cond"], attn_chunk_size=attn_chunk_size,
+                merge_ratio=merge_ratio
             )
-            if cfg_strength < 1e-5:
-                return pred
 
+        def cfg_preds(t, x):
+            if batch_cfg:
+                return self.transformer(
+                    x=torch.cat((x, x), dim=0), cond=cfg_step_cond, text=cfg_text, time=t,
+                    drop_audio_cond=cfg_drop, drop_text=cfg_drop, drop_prompt=False,
+                    style_prompt=cfg_style_prompt, start_time=cfg_start_time, duration=cfg_song_duration, mask=cfg_mask,
+                    cache=cfg_cache, deep_cache=deep_caches["cfg"], attn_chunk_size=attn_chunk_size,
+                    merge_ratio=merge_ratio
+                ).chunk(2, dim=0)
+
+            pred = cond_pred(t, x)
             null_pred = self.transformer(
                 x=x, cond=step_cond, text=text, time=t, drop_audio_cond=True, drop_text=True, drop_prompt=False,
-                style_prompt=negative_style_prompt, start_time=start_time, duration=song_duration
+                style_prompt=negative_style_prompt, start_time=start_time, duration=song_duration, mask=mask,
+                cache=null_cache, deep_cache=deep_caches["null"], attn_chunk_size=attn_chunk_size,
+                merge_ratio=merge_ratio
+            )
+            return pred, null_pred
+
+        # guided evaluations so far, and the cached unconditional prediction or guidance delta
+        guidance = dict(evals=0, cached=None)
+
+        def fn(t, x):
+            # predict flow
+            if not use_cfg:
+                return cond_pred(t, x)
+            if not cond_only_steps:
+                pred, null_pred = cfg_preds(t, x)
+                return pred + (pred - null_pred) * cfg_strength
+
+            if exists(cfg_interval) and not cfg_interval[0] <= float(t) <= cfg_interval[1]:
+                return cond_pred(t, x)
+
+            if guidance["cached"] is None or guidance["evals"] % cfg_cache_steps == 0:
+                pred, null_pred = cfg_preds(t, x)
+                guidance["cached"] = pred - null_pred if cfg_cache_mode == "delta" else null_pred
+            else:
+                pred = cond_pred(t, x)
+            guidance["evals"] += 1
+
+            delta = guidance["cached"] if cfg_cache_mode == "delta" else pred - guidance["cached"]
+            return pred + delta * cfg_strength
+
+        # conditioning of a window of states for the picard solver, per window size
+        window_inputs = {}
+
+        def window_conditioning(w):
+            def tile(value):
+                return repeat_batch(value, w) if exists(value) else None
+
+            inputs = dict(
+                cond=tile(step_cond), text=tile(text), style_prompt=tile(style_prompt), start_time=tile(start_time),
+                duration=tile(song_duration), mask=tile(mask), drop_audio_cond=False, drop_text=False,
+            )
+            if use_cfg:
+                # conditional and unconditional branches of every state stacked along the batch
+                drop = torch.arange(2 * w * x_batch, device=device) >= w * x_batch
+                for name in ("cond", "text", "start_time", "duration", "mask"):
+                    if exists(inputs[name]):
+                        inputs[name] = torch.cat((inputs[name], inputs[name]), dim=0)
+                inputs.update(
+                    style_prompt=torch.cat((inputs["style_prompt"], tile(negative_style_prompt)), dim=0),
+                    drop_audio_cond=drop, drop_text=drop,
+                )
+            inputs["cache"] = self.transformer.forward_timestep_invariant(
+                inputs["text"], max_duration, inputs["drop_text"], inputs["start_time"],
+                duration=inputs["duration"], mask=inputs["mask"]
             )
-            return pred + (pred - null_pred) * cfg_strength
+            return inputs
+
+        def window_fn(t, x):
+            # t [w], x [w b n d]: states at w timesteps, evaluated in one batched call
+            w = t.shape[0]
+            if w not in window_inputs:
+                window_inputs[w] = window_conditioning(w)
+            rows, time = x.reshape(-1, *x.shape[2:]), t.repeat_interleave(x_batch)
+            if use_cfg:
+                rows, time = torch.cat((rows, rows), dim=0), torch.cat((time, time), dim=0)
+            pred = self.transformer(
+                x=rows, time=time, drop_prompt=False, attn_chunk_size=attn_chunk_size, merge_ratio=merge_ratio,
+                **window_inputs[w]
+            )
+            if use_cfg:
+                pred, null_pred = pred.chunk(2, dim=0)
+                pred = pred + (pred - null_pred) * cfg_strength
+            return pred.reshape(x.shape)
+
+        solver = default(solver, self.odeint_kwargs.get("method", "euler"))
+        if solver == "picard":
+            assert not cond_only_steps and deep_cache_interval == 1, (
+                "the picard solver does not support guidance intervals/caching or deep feature caching"
+            )
+            fn = window_fn
+
+        def finalize(latents):
+            latents = torch.where(fixed_span_mask, latents, cond)
+            if exists(mask):
+                latents = latents.masked_fill(~mask[..., None], 0.0)
+            return latents[:, :out_duration]
+
+        if exists(preview_callback):
+            velocity_fn = fn
+            previews = dict(evals=0)
+
+            def fn(t, x):
+                v = velocity_fn(t, x)
+                previews["evals"] += 1
+                if previews["evals"] % preview_interval == 0:
+                    # the flow is straight towards x1, so following the current velocity to t = 1
+                    # gives a cheap estimate of the final latents; a picard window previews its first state
+                    t_x, x_t, v_t = (t[0], x[0], v[0]) if t.ndim else (t, x, v)
+                    preview_callback(previews["evals"], float(t_x), finalize(x_t + (1 - t_x) * v_t))
+                return v
 
         # noise input
         # to make sure batch inference result is same with different batch size, and for sure single inference
@@ -227,6 +493,7 @@ class CFM(nn.Module):
                 torch.manual_seed(seed)
             y0.append(torch.randn(dur, self.num_channels, device=self.device, dtype=step_cond.dtype))
         y0 = pad_sequence(y0, padding_value=0, batch_first=True)
+        y0 = F.pad(y0, (0, 0, 0, max_duration - y0.shape[1]), value=0.0)
 
         t_start = 0
 
@@ -236,15 +503,24 @@ class CFM(nn.Module):
             y0 = (1 - t_start) * y0 + t_start * test_cond
             steps = int(steps * (1 - t_start))
         
-        t = torch.linspace(t_start, 1, steps, device=self.device, dtype=step_cond.dtype)
-        if sway_sampling_coef is not None:
-            t = t + sway_sampling_coef * (torch.cos(torch.pi / 2 * t) - 1 + t)
+        t = get_timesteps(
+            schedule, steps, t_start=t_start, sway_sampling_coef=sway_sampling_coef, device=self.device, dtype=step_cond.dtype
+        )
+
+        if solver in self.solvers:
+            # built-in solvers hold only the current state, the trajectory is kept on request only
+            sampled, trajectory = self.solvers[solver](
+                fn, y0, t, return_trajectory=return_trajectory, **default(solver_options, {})
+            )
+        else:
+            from torchdiffeq import odeint
 
-        trajectory = odeint(fn, y0, t, **self.odeint_kwargs)
+            trajectory = odeint(fn, y0, t, **{**self.odeint_kwargs, "method": solver})
+            sampled = trajectory[-1]
+            if not return_trajectory:
+                trajectory = None
 
-        sampled = trajectory[-1]
-        out = sampled
-        out = torch.where(fixed_span_mask, out, cond)
+        out = finalize(sampled)
 
         if exists(vocoder):
             out = out.permute(0, 2, 1)
@@ -0,0 +1,256 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Iteration-level (continuous) batching of the Euler sampling loop.
+
+Each batch row is a slot with its own position on the timestep grid. A song
+added between two steps starts at t = 0 while the other slots carry on
+mid-trajectory, and a slot leaves the batch as soon as it reaches t = 1, so
+its latents can be decoded while the others are still sampled. The DiT takes
+one time per row, so all slots advance with a single batched call per step.
+
+Guidance runs both branches in one batched call, as with `batch_cfg`. Guidance
+intervals/caching and deep feature caching are not supported here, they would
+be per slot.
+"""
+
+from __future__ import annotations
+
+import torch
+import torch.nn.functional as F
+
+from model.cfm import bucket_length, custom_mask_from_start_end_indices
+from model.solvers import get_timesteps
+from model.utils import exists, lens_to_mask
+
+
+class Slot:
+    """One song in the batch: its conditioning, current state and position on its timestep grid."""
+
+    def __init__(self, tag, x, cond, step_cond, fixed_span_mask, text, style_prompt, negative_style_prompt,
+                 start_time, song_duration, timesteps):
+        self.tag = tag
+        self.x = x  # [n d], sampled state
+        self.cond = cond
+        self.step_cond = step_cond
+        self.fixed_span_mask = fixed_span_mask  # [n 1], frames that are sampled, the others are kept from cond
+        self.text = text
+        self.style_prompt = style_prompt
+        self.negative_style_prompt = negative_style_prompt
+        self.start_time = start_time
+        self.song_duration = song_duration
+        self.timesteps = timesteps
+        self.step = 0
+
+    @property
+    def frames(self):
+        return self.x.shape[0]
+
+    @property
+    def done(self):
+        return self.step >= len(self.timesteps) - 1
+
+    def result(self):
+        return torch.where(self.fixed_span_mask, self.x, self.cond)
+
+
+class ContinuousBatchSampler:
+    def __init__(
+        self,
+        cfm,
+        max_batch_size=4,
+        steps=32,
+        cfg_strength=4.0,
+        schedule="linear",
+        sway_sampling_coef=None,
+        attn_chunk_size: int | None = None,
+        merge_ratio: float | list[float] | None = None,
+    ):
+        self.cfm = cfm
+        self.max_batch_size = max_batch_size
+        self.steps = steps
+        self.cfg_strength = cfg_strength
+        self.schedule = schedule
+        self.sway_sampling_coef = sway_sampling_coef
+        self.attn_chunk_size = attn_chunk_size
+        self.merge_ratio = merge_ratio
+        self.slots: list[Slot] = []
+        self._batch = None  # batched inputs of the current slots, rebuilt when slots join or leave
+
+    def __len__(self):
+        return len(self.slots)
+
+    @property
+    def free_slots(self):
+        return self.max_batch_size - len(self.slots)
+
+    def suspend(self, device="cpu"):
+        """Move the sampling state (slots, batched inputs and conditioning cache) off the model's device.
+
+        The state is kept as is, so sampling resumes bit-identically after resume(), while the
+        device memory is free for other jobs in between.
+        """
+        self._move(device)
+
+    def resume(self):
+        self._move(self.cfm.device)
+
+    def _move(self, device):
+        def move(value):
+            if isinstance(value, torch.Tensor):
+                return value.to(device)
+            if isinstance(value, dict):
+                return {key: move(item) for key, item in value.items()}
+            if isinstance(value, (list, tuple)):
+                return type(value)(move(item) for item in value)
+            return value
+
+        for slot in self.slots:
+            for name, value in vars(slot).items():
+                if isinstance(value, torch.Tensor):
+                    setattr(slot, name, value.to(device))
+        self._batch = move(self._batch)
+
+    @torch.no_grad()
+    def add(
+        self,
+        cond: float["n d"],  # noqa: F722
+        text: int["nt"],  # noqa: F821
+        duration: int,
+        style_prompt: float["d"],  # noqa: F821
+        negative_style_prompt: float["d"],  # noqa: F821
+        start_time: float[""],  # noqa: F722
+        song_duration: float[""],  # noqa: F722
+        latent_pred_segments,
+        seed: int | None = None,
+        steps: int | None = None,
+        tag=None,
+    ):
+        """Add a song, it joins the batch at t = 0 on the next step. Inputs are those of one CFM.sample row."""
+        assert self.free_slots > 0, "no free slot"
+        cfm = self.cfm
+        device, dtype = cfm.device, next(cfm.parameters()).dtype
+
+        cond = cond.to(device, dtype)[:duration]
+        cond = F.pad(cond, (0, 0, 0, duration - cond.shape[0]), value=0.0)
+        text = F.pad(text[:duration], (0, max(0, duration - text.shape[0])), value=0)
+        fixed_span_mask = custom_mask_from_start_end_indices(
+            duration, torch.tensor(latent_pred_segments, device=device), device=device, max_seq_len=duration
+        ).reshape(-1, 1)
+        step_cond = torch.where(fixed_span_mask, torch.zeros_like(cond), cond)
+
+        # same noise as CFM.sample for this seed and duration
+        if exists(seed):
+            torch.manual_seed(seed)
+        x = torch.randn(duration, cfm.num_channels, device=device, dtype=dtype)
+
+        timesteps = get_timesteps(
+            self.schedule, steps or self.steps, sway_sampling_coef=self.sway_sampling_coef, device=device, dtype=dtype
+        )
+        slot = Slot(
+            tag, x, cond, step_cond, fixed_span_mask, text.to(device),
+            style_prompt.to(device, dtype).reshape(-1), negative_style_prompt.to(device, dtype).reshape(-1),
+            start_time.to(device, dtype).reshape(()), song_duration.to(device, dtype).reshape(()), timesteps,
+        )
+        self._sync()
+        self.slots.append(slot)
+        self._batch = None
+        return slot
+
+    def _sync(self):
+        # write the batched state back to the slots before the batch changes
+        if self._batch is None:
+            return
+        for slot, x in zip(self.slots, self._batch["x"]):
+            slot.x = x[:slot.frames]
+
+    def _build(self):
+        cfm = self.cfm
+        slots = self.slots
+        frames = max(slot.frames for slot in slots)
+        if exists(cfm.length_buckets):
+            frames = bucket_length(frames, cfm.length_buckets)
+        lens = torch.tensor([slot.frames for slot in slots], device=cfm.device)
+
+        def stack(name, value=0.0):
+            return torch.stack([F.pad(getattr(slot, name), (0, 0, 0, frames - slot.frames), value=value) for slot in slots])
+
+        x = stack("x")
+        step_cond = stack("step_cond")
+        text = torch.stack([F.pad(slot.text, (0, frames - slot.frames), value=0) for slot in slots])
+        style_prompt = torch.stack([slot.style_prompt for slot in slots])
+        negative_style_prompt = torch.stack([slot.negative_style_prompt for slot in slots])
+        start_time = torch.stack([slot.start_time for slot in slots])
+        song_duration = torch.stack([slot.song_duration for slot in slots])
+        mask = lens_to_mask(lens, length=frames) if (lens != frames).any() else None
+
+        use_cfg = self.cfg_strength >= 1e-5
+        if use_cfg:
+            # conditional and unconditional branches stacked along the batch, dropped per sample
+            batch = len(slots)
+            drop = torch.arange(2 * batch, device=cfm.device) >= batch
+            step_cond = torch.cat((step_cond, step_cond), dim=0)
+            text = torch.cat((text, text), dim=0)
+            style_prompt = torch.cat((style_prompt, negative_style_prompt), dim=0)
+            start_time = torch.cat((start_time, start_time), dim=0)
+            song_duration = torch.cat((song_duration, song_duration), dim=0)
+            mask = torch.cat((mask, mask), dim=0) if exists(mask) else None
+        else:
+            drop = False
+
+        cache = cfm.transformer.forward_timestep_invariant(text, frames, drop, start_time, duration=song_duration, mask=mask)
+        self._batch = dict(
+            x=x, step_cond=step_cond, text=text, style_prompt=style_prompt, start_time=start_time,
+            song_duration=song_duration, mask=mask, drop=drop, cache=cache, use_cfg=use_cfg,
+        )
+
+    @torch.no_grad()
+    def step(self):
+        """Advance every slot by one Euler step, returns the slots that reached t = 1 (removed from the batch)."""
+        if not self.slots:
+            return []
+        if self._batch is None:
+            self._build()
+        batch = self._batch
+        slots = self.slots
+
+        t = torch.stack([slot.timesteps[slot.step] for slot in slots])
+        dt = torch.stack([slot.timesteps[slot.step + 1] - slot.timesteps[slot.step] for slot in slots])
+
+        x = batch["x"]
+        if batch["use_cfg"]:
+            x_in, time = torch.cat((x, x), dim=0), torch.cat((t, t), dim=0)
+        else:
+            x_in, time = x, t
+        pred = self.cfm.transformer(
+            x=x_in, cond=batch["step_cond"], text=batch["text"], time=time,
+            drop_audio_cond=batch["drop"], drop_text=batch["drop"], drop_prompt=False,
+            style_prompt=batch["style_prompt"], start_time=batch["start_time"], duration=batch["song_duration"],
+            mask=batch["mask"], cache=batch["cache"], attn_chunk_size=self.attn_chunk_size,
+            merge_ratio=self.merge_ratio,
+        )
+        if batch["use_cfg"]:
+            pred, null_pred = pred.chunk(2, dim=0)
+            pred = pred + (pred - null_pred) * self.cfg_strength
+
+        batch["x"] = x + dt[:, None, None] * pred
+        for slot in slots:
+            slot.step += 1
+
+        finished = [slot for slot in slots if slot.done]
+        if finished:
+            self._sync()
+            self.slots = [slot for slot in slots if not slot.done]
+            self._batch = None
+        return finished
@@ -21,12 +21,12 @@
 
 from __future__ import annotations
 
+import threading
+
 import torch
 from torch import nn
 import torch
-
-from transformers.models.llama.modeling_llama import LlamaDecoderLayer, LlamaRotaryEmbedding
-from transformers.models.llama import LlamaConfig
+import torch.nn.functional as F
 
 from model.modules import (
     TimestepEmbedding,
@@ -35,8 +35,12 @@ from model.modules import (
     AdaLayerNormZero_Final,
     precompute_freqs_cis,
     get_pos_embed_indices,
-    _prepare_decoder_attention_mask,
+    LlamaBlock,
+    rotary_tables,
 )
+from model.parallel import pipeline_blocks, pipeline_output
+from model.tome import merge, merge_attention_mask, merge_plan, merge_ratios, merge_rotary, unmerge
+from model.utils import default
 
 # Text embedding
 class TextEmbedding(nn.Module):
@@ -54,10 +58,12 @@ class TextEmbedding(nn.Module):
         else:
             self.extra_modeling = False
 
-    def forward(self, text: int["b nt"], seq_len, drop_text=False):  # noqa: F722
+    def forward(self, text: int["b nt"], seq_len, drop_text=False, mask: bool["b n"] | None = None):  # noqa: F722
         batch, text_len = text.shape[0], text.shape[1]
 
-        if drop_text:  # cfg for text
+        if isinstance(drop_text, torch.Tensor):  # per-sample cfg for text, [b] bool
+            text = text.masked_fill(drop_text[:, None], 0)
+        elif drop_text:  # cfg for text
             text = torch.zeros_like(text)
 
         text = self.text_embed(text)  # b n -> b n d
@@ -71,7 +77,8 @@ class TextEmbedding(nn.Module):
             text = text + text_pos_embed
 
             # convnextv2 blocks
-            text = self.text_blocks(text)
+            for block in self.text_blocks:
+                text = block(text, mask=mask)
 
         return text
 
@@ -83,17 +90,51 @@ class InputEmbedding(nn.Module):
         self.proj = nn.Linear(mel_dim * 2 + text_dim + cond_dim * 2, out_dim)
         self.conv_pos_embed = ConvPositionEmbedding(dim=out_dim)
 
-    def forward(self, x: float["b n d"], cond: float["b n d"], text_embed: float["b n d"], style_emb, time_emb, drop_audio_cond=False):  # noqa: F722
-        if drop_audio_cond:  # cfg for cond audio
+    def forward(self, x: float["b n d"], cond: float["b n d"], text_embed: float["b n d"], style_emb, time_emb, drop_audio_cond=False, mask: bool["b n"] | None = None):  # noqa: F722
+        if isinstance(drop_audio_cond, torch.Tensor):  # per-sample cfg for cond audio, [b] bool
+            cond = cond.masked_fill(drop_audio_cond[:, None, None], 0.0)
+        elif drop_audio_cond:  # cfg for cond audio
             cond = torch.zeros_like(cond)
-        style_emb = style_emb.unsqueeze(1).repeat(1, x.shape[1], 1)
-        time_emb = time_emb.unsqueeze(1).repeat(1, x.shape[1], 1)
-        x = self.proj(torch.cat((x, cond, text_embed, style_emb, time_emb), dim=-1))
-        x = self.conv_pos_embed(x) + x
+        # style and time are constant over the sequence, their part of the projection is a [b, dim] bias
+        # instead of being repeated to [b, n, 2 * cond_dim] and concatenated every call
+        frame_dim = x.shape[-1] + cond.shape[-1] + text_embed.shape[-1]
+        weight, bias = self.proj.weight, self.proj.bias
+        seq_bias = F.linear(torch.cat((style_emb, time_emb), dim=-1), weight[:, frame_dim:], bias)
+        x = F.linear(torch.cat((x, cond, text_embed), dim=-1), weight[:, :frame_dim]) + seq_bias[:, None]
+        x = self.conv_pos_embed(x, mask=mask) + x
         return x
 
 
 # Transformer backbone using Llama blocks
+class DynamoConfigScope:
+    """torch._dynamo config changes applied while a forward of `module` runs, not process-wide.
+
+    Compilation is lazy, so the config has to hold at every call that may compile, not
+    only around torch.compile. Overlapping forwards from several threads share one patch.
+    """
+
+    def __init__(self, module, **changes):
+        self.changes = changes
+        self.lock = threading.Lock()
+        self.active = 0
+        self.patch = None
+        module.register_forward_pre_hook(lambda module, args: self.enter())
+        module.register_forward_hook(lambda module, args, output: self.exit(), always_call=True)
+
+    def enter(self):
+        with self.lock:
+            if self.active == 0:
+                self.patch = torch._dynamo.config.patch(**self.changes)
+                self.patch.__enter__()
+            self.active += 1
+
+    def exit(self):
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.patch.__exit__(None, None, None)
+
+
 class DiT(nn.Module):
     def __init__(
         self,
@@ -127,12 +168,13 @@ class DiT(nn.Module):
         self.dim = dim
         self.depth = depth
 
-        llama_config = LlamaConfig(hidden_size=dim, intermediate_size=dim * ff_mult, hidden_act='silu', max_position_embeddings=self.max_frames)
-        llama_config._attn_implementation = 'sdpa'
+        self.heads = heads
         self.transformer_blocks = nn.ModuleList(
-            [LlamaDecoderLayer(llama_config, layer_idx=i) for i in range(depth)]
+            [LlamaBlock(dim, heads, ff_mult=ff_mult) for i in range(depth)]
         )
-        self.rotary_emb = LlamaRotaryEmbedding(config=llama_config)
+        self._rotary_cache = None  # (cos, sin) for positions [0, n), reused for every shorter sequence
+        self.pipeline = None  # this rank's pipeline stage, set by model.parallel.pipeline_dit
+        self._compiled = False
         self.long_skip_connection = nn.Linear(dim * 2, dim, bias=False) if long_skip_connection else None
 
         self.text_fusion_linears = nn.ModuleList(
@@ -150,15 +192,92 @@ class DiT(nn.Module):
         self.norm_out = AdaLayerNormZero_Final(dim, cond_dim)  # final modulation
         self.proj_out = nn.Linear(dim, mel_dim)
 
-    def forward_timestep_invariant(self, text, seq_len, drop_text, start_time):
+    def rotary_tables(self, seq_len, device, dtype):
+        """Rotary cos/sin of shape [1, seq_len, head_dim], broadcast over the batch.
+
+        Positions are always 0..seq_len-1, so in eval mode the tables are computed
+        once for the longest length seen and sliced for shorter sequences.
+        """
+        if self.training:
+            return rotary_tables(self.dim // self.heads, seq_len, device=device, dtype=dtype)
+
+        cached = self._rotary_cache
+        if cached is None or cached[0].shape[1] < seq_len or cached[0].device != device or cached[0].dtype != dtype:
+            cached = rotary_tables(self.dim // self.heads, max(seq_len, self.max_frames), device=device, dtype=dtype)
+            self._rotary_cache = cached
+        cos, sin = cached
+        return cos[:, :seq_len], sin[:, :seq_len]
+
+    def forward_timestep_invariant(self, text, seq_len, drop_text, start_time, duration=None, mask=None):
+        """Conditioning that does not depend on the flow time step.
+
+        Returns a cache that can be passed to `forward` for every ODE step of one
+        CFG branch, instead of recomputing the text embedding, fusion residuals,
+        start/duration embeddings, rotary tables and attention mask each call.
+        """
+        batch = text.shape[0]
         s_t = self.start_time_embed(start_time)
-        text_embed = self.text_embed(text, seq_len, drop_text=drop_text)
+        d_t = self.duration_time_embed(duration) if self.max_frames == 6144 else torch.zeros_like(s_t)
+        text_embed = self.text_embed(text, seq_len, drop_text=drop_text, mask=mask)
         text_residuals = []
         for layer in self.text_fusion_linears:
             text_residual = layer(text_embed)
             text_residuals.append(text_residual)
-        return s_t, text_embed, text_residuals
 
+        rotary_embed = self.rotary_tables(seq_len, text_embed.device, text_embed.dtype)
+
+        # no padding: no mask at all, so SDPA can pick its flash / memory-efficient kernels
+        # padding: a [b, 1, 1, n] boolean key-padding mask broadcast over heads and queries
+        attention_mask = mask[:, None, None, :] if mask is not None else None
+
+        # frames token merging leaves alone: lyric tokens and padding
+        merge_protect = F.pad(text[:, :seq_len] != 0, (0, max(0, seq_len - text.shape[1])), value=False)
+        if mask is not None:
+            merge_protect = merge_protect | ~mask
+
+        return dict(
+            s_t=s_t,
+            d_t=d_t,
+            text_embed=text_embed,
+            text_residuals=text_residuals,
+            rotary_embed=rotary_embed,
+            attention_mask=attention_mask,
+            merge_protect=merge_protect,
+        )
+
+    def compile_for_inference(self, mode=None):
+        # the embedding and each block are compiled, not forward as a whole, so the python side
+        # (caches, drop flags, deep_cache counters) does not cause graph breaks or recompiles;
+        # sequence lengths are static (dynamic=False, callers bucket them); the batch dimension is
+        # marked dynamic in forward, so request batches, guidance branches and Picard windows share
+        # one graph for every batch size of 2 and more (1 is always specialized) instead of
+        # recompiling per size; token merging is off, its merged lengths would each be a graph
+        self.eval()
+        for module in [self.input_embed, self.norm_out, *self.transformer_blocks]:
+            module.compile(mode=mode, dynamic=False)
+        # every block and bucket is a cache entry of the same code, the limit is raised only while this DiT runs
+        DynamoConfigScope(self, cache_size_limit=max(torch._dynamo.config.cache_size_limit, 64))
+        self._compiled = True
+
+    def _mark_batch_dynamic(self, batch, *tensors):
+        if not self._compiled:
+            return
+        for t in tensors:
+            if isinstance(t, torch.Tensor) and t.ndim > 0 and t.shape[0] == batch:
+                torch._dynamo.maybe_mark_dynamic(t, 0)
+
+    def init_deep_cache(self, interval, depth=None, mode="residual"):
+        """State for reusing deep-block features across calls (DeepCache / Delta-DiT style).
+
+        Every `interval`-th call runs all blocks and stores the output of the blocks
+        after the first `depth` (mode="output") or the change they made (mode="residual").
+        The calls in between run only the first `depth` blocks and add the stored change,
+        or run no block at all and take the stored output. Keep one state per call site,
+        as the features are per batch.
+        """
+        depth = default(depth, self.depth // 4)
+        assert 0 < depth < self.depth and mode in ("residual", "output")
+        return dict(interval=interval, depth=depth, mode=mode, calls=0, features=None)
 
     def forward(
         self,
@@ -166,59 +285,97 @@ class DiT(nn.Module):
         cond: float["b n d"],  # masked cond audio  # noqa: F722
         text: int["b nt"],  # text  # noqa: F722
         time: float["b"] | float[""],  # time step  # noqa: F821 F722
-        drop_audio_cond,  # cfg for cond audio
-        drop_text,  # cfg for text
-        drop_prompt=False,
+        drop_audio_cond,  # cfg for cond audio, bool or [b] bool tensor
+        drop_text,  # cfg for text, bool or [b] bool tensor
+        drop_prompt=False,  # bool or [b] bool tensor
         style_prompt=None, # [b d t]
         start_time=None,
-        duration=None
+        duration=None,
+        mask: bool["b n"] | None = None,  # padding mask for batches of different lengths  # noqa: F722
+        cache: dict | None = None,  # from forward_timestep_invariant, built with the same text/drop_text/mask
+        deep_cache: dict | None = None,  # from init_deep_cache, updated in place
+        attn_chunk_size: int | None = None,  # attend in chunks of this many queries to bound memory
+        merge_ratio: float | list[float] | None = None,  # token merging, fraction of frames merged per block
     ):
 
         batch, seq_len = x.shape[0], x.shape[1]
         if time.ndim == 0:
             time = time.repeat(batch)
 
+        if cache is None:
+            cache = self.forward_timestep_invariant(text, seq_len, drop_text, start_time, duration=duration, mask=mask)
+
         # t: conditioning time, c: context (text + masked cond audio), x: noised input audio
         t = self.time_embed(time)
-        s_t = self.start_time_embed(start_time)
-        d_t = self.duration_time_embed(duration) if self.max_frames == 6144 else torch.zeros_like(s_t)
-        c = t + s_t + d_t
-        text_embed = self.text_embed(text, seq_len, drop_text=drop_text)
+        c = t + cache["s_t"] + cache["d_t"]
+        text_embed = cache["text_embed"]
 
-        if drop_prompt:
+        if isinstance(drop_prompt, torch.Tensor):
+            style_prompt = style_prompt.masked_fill(drop_prompt[:, None], 0.0)
+        elif drop_prompt:
             style_prompt = torch.zeros_like(style_prompt)
         
         style_embed = style_prompt # [b, 512]
 
-        x = self.input_embed(x, cond, text_embed, style_embed, c, drop_audio_cond=drop_audio_cond)
+        self._mark_batch_dynamic(batch, x, cond, text_embed, style_embed, c, drop_audio_cond, mask)
+        x = self.input_embed(x, cond, text_embed, style_embed, c, drop_audio_cond=drop_audio_cond, mask=mask)
 
         if self.long_skip_connection is not None:
             residual = x
 
-        pos_ids = torch.arange(x.shape[1], device=x.device)
-        pos_ids = pos_ids.unsqueeze(0).repeat(x.shape[0], 1)
-        rotary_embed = self.rotary_emb(x, pos_ids)
-        
-        attention_mask = torch.ones(
-            (batch, seq_len),
-            dtype=torch.bool,
-            device=x.device,
-        )
-        attention_mask = _prepare_decoder_attention_mask(
-            attention_mask,
-            (batch, seq_len),
-            x,
-        )
+        rotary_embed = cache["rotary_embed"]
+        attention_mask = cache["attention_mask"]
+        self._mark_batch_dynamic(batch, attention_mask)
 
-        for i, block in enumerate(self.transformer_blocks):
-            x, *_ = block(x, attention_mask=attention_mask, position_embeddings=rotary_embed)
-            if i < self.depth // 2:
-                x = x + self.text_fusion_linears[i](text_embed)
+        reuse_deep = False
+        if deep_cache is not None:
+            reuse_deep = deep_cache["features"] is not None and deep_cache["calls"] % deep_cache["interval"] != 0
+            deep_cache["calls"] += 1
 
-        if self.long_skip_connection is not None:
-            x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
+        ratios = merge_ratios(merge_ratio, self.depth) if not self._compiled else None
+
+        if self.pipeline is not None:
+            assert deep_cache is None and ratios is None, "deep feature caching and token merging are not pipelined"
+            x = pipeline_blocks(self, x, cache, query_chunk_size=attn_chunk_size)
+        elif reuse_deep and deep_cache["mode"] == "output":
+            # the stored output already went through the shallow blocks too
+            x = deep_cache["features"]
+        else:
+            for i, block in enumerate(self.transformer_blocks):
+                if deep_cache is not None and i == deep_cache["depth"]:
+                    if reuse_deep:
+                        x = x + deep_cache["features"]
+                        break
+                    shallow = x
+                plan = merge_plan(x, ratios[i], cache["merge_protect"]) if ratios is not None and ratios[i] > 0 else None
+                if plan is None:
+                    self._mark_batch_dynamic(batch, x)
+                    x = block(x, rotary_embed, attention_mask=attention_mask, query_chunk_size=attn_chunk_size)
+                else:
+                    merged = merge(x, plan)
+                    update = block(
+                        merged, merge_rotary(rotary_embed, plan[0]),
+                        attention_mask=merge_attention_mask(attention_mask, plan[0]), query_chunk_size=attn_chunk_size,
+                    ) - merged
+                    x = unmerge(x, update, plan)
+                if i < self.depth // 2:
+                    x = x + cache["text_residuals"][i]
+
+        if deep_cache is not None and not reuse_deep:
+            deep_cache["features"] = x - shallow if deep_cache["mode"] == "residual" else x
+
+        if self.pipeline is None or self.pipeline["last"]:
+            if self.long_skip_connection is not None:
+                x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
+
+            self._mark_batch_dynamic(batch, x)
+            x = self.norm_out(x, c)
+            output = self.proj_out(x)
+        else:
+            # the other stages receive the output of the last one
+            output = x.new_empty(batch, seq_len, self.proj_out.out_features)
 
-        x = self.norm_out(x, c)
-        output = self.proj_out(x)
+        if self.pipeline is not None:
+            output = pipeline_output(self, output)
 
         return output
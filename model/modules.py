@@ -26,8 +26,6 @@ import torch
 import torch.nn.functional as F
 import torchaudio
 
-from x_transformers.x_transformers import apply_rotary_pos_emb
-
 
 
 class FiLMLayer(nn.Module):
@@ -127,17 +125,20 @@ class ConvPositionEmbedding(nn.Module):
         )
 
     def forward(self, x: float["b n d"], mask: bool["b n"] | None = None):  # noqa: F722
-        if mask is not None:
-            mask = mask[..., None]
-            x = x.masked_fill(~mask, 0.0)
-
-        x = x.permute(0, 2, 1)
-        x = self.conv1d(x)
+        if mask is None:
+            x = x.permute(0, 2, 1)
+            x = self.conv1d(x)
+            return x.permute(0, 2, 1)
+
+        # re-mask after every conv so padding never leaks into valid frames
+        mask = mask[:, None, :]
+        x = x.permute(0, 2, 1).masked_fill(~mask, 0.0)
+        for layer in self.conv1d:
+            x = layer(x)
+            if isinstance(layer, nn.Mish):
+                x = x.masked_fill(~mask, 0.0)
         out = x.permute(0, 2, 1)
 
-        if mask is not None:
-            out = out.masked_fill(~mask, 0.0)
-
         return out
 
 
@@ -207,14 +208,18 @@ class ConvNeXtV2Block(nn.Module):
         self.grn = GRN(intermediate_dim)
         self.pwconv2 = nn.Linear(intermediate_dim, dim)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, mask: bool["b n"] | None = None) -> torch.Tensor:  # noqa: F722
         residual = x
+        if mask is not None:  # padding must look like the conv's zero padding
+            x = x.masked_fill(~mask[..., None], 0.0)
         x = x.transpose(1, 2)  # b n d -> b d n
         x = self.dwconv(x)
         x = x.transpose(1, 2)  # b d n -> b n d
         x = self.norm(x)
         x = self.pwconv1(x)
         x = self.act(x)
+        if mask is not None:  # GRN normalizes over the sequence, keep padding out of it
+            x = x.masked_fill(~mask[..., None], 0.0)
         x = self.grn(x)
         x = self.pwconv2(x)
         return residual + x
@@ -364,6 +369,8 @@ class AttnProcessor:
 
         # apply rotary position embedding
         if rope is not None:
+            from x_transformers.x_transformers import apply_rotary_pos_emb  # slow to import, only needed here
+
             freqs, xpos_scale = rope
             q_xpos_scale, k_xpos_scale = (xpos_scale, xpos_scale**-1.0) if xpos_scale is not None else (1.0, 1.0)
 
@@ -433,6 +440,8 @@ class JointAttnProcessor:
         c_value = attn.to_v_c(c)
 
         # apply rope for context and noised input independently
+        if rope is not None or c_rope is not None:
+            from x_transformers.x_transformers import apply_rotary_pos_emb  # slow to import, only needed here
         if rope is not None:
             freqs, xpos_scale = rope
             q_xpos_scale, k_xpos_scale = (xpos_scale, xpos_scale**-1.0) if xpos_scale is not None else (1.0, 1.0)
@@ -491,6 +500,122 @@ class JointAttnProcessor:
 # DiT Block
 
 
+# Llama-style transformer block: RMSNorm, rotary self-attention and SwiGLU with fused projections.
+# Loads LlamaDecoderLayer weights, checkpoints in that layout are remapped when loaded
+
+
+class RMSNorm(nn.Module):
+    def __init__(self, dim, eps=1e-6):
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(dim))
+
+    def forward(self, x):
+        dtype = x.dtype
+        x = x.float()
+        x = x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
+        return self.weight * x.to(dtype)
+
+
+def rotary_tables(dim_head, seq_len, theta=10000.0, device=None, dtype=None):
+    # cos / sin of shape [1, seq_len, dim_head] for positions 0..seq_len-1, in the half-split layout
+    inv_freq = 1.0 / (theta ** (torch.arange(0, dim_head, 2, dtype=torch.int64, device=device).float() / dim_head))
+    freqs = torch.arange(seq_len, device=device).float()[:, None] * inv_freq[None, :]
+    emb = torch.cat((freqs, freqs), dim=-1)[None]
+    return emb.cos().to(dtype), emb.sin().to(dtype)
+
+
+def rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+def chunked_scaled_dot_product_attention(query, key, value, attn_mask=None, query_chunk_size=None):
+    # exact attention over chunks of the queries against all keys: the attention scores held at once
+    # shrink from [b, h, n, n] to [b, h, chunk, n], for when SDPA falls back to its math kernel
+    if query_chunk_size is None or query.shape[2] <= query_chunk_size:
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask)
+
+    out = torch.empty_like(query)
+    for start in range(0, query.shape[2], query_chunk_size):
+        end = start + query_chunk_size
+        mask = attn_mask
+        if mask is not None and mask.shape[-2] > 1:
+            mask = mask[:, :, start:end]
+        out[:, :, start:end] = F.scaled_dot_product_attention(query[:, :, start:end], key, value, attn_mask=mask)
+    return out
+
+
+class FusedSelfAttention(nn.Module):
+    def __init__(self, dim, heads):
+        super().__init__()
+        self.heads = heads
+        self.dim_head = dim // heads
+        self.qkv_proj = nn.Linear(dim, dim * 3, bias=False)
+        self.o_proj = nn.Linear(dim, dim, bias=False)
+
+    def forward(self, x, rotary_embed, attention_mask=None, query_chunk_size=None):
+        batch, seq_len = x.shape[:2]
+        query, key, value = self.qkv_proj(x).view(batch, seq_len, 3, self.heads, self.dim_head).permute(2, 0, 3, 1, 4)
+
+        cos, sin = rotary_embed[0].unsqueeze(1), rotary_embed[1].unsqueeze(1)
+        query = query * cos + rotate_half(query) * sin
+        key = key * cos + rotate_half(key) * sin
+
+        # the memory-efficient SDPA kernel needs contiguous inputs together with a mask on some torch versions
+        out = chunked_scaled_dot_product_attention(
+            query, key, value.contiguous(), attn_mask=attention_mask, query_chunk_size=query_chunk_size
+        )
+        return self.o_proj(out.transpose(1, 2).reshape(batch, seq_len, -1))
+
+
+class SwiGLUFeedForward(nn.Module):
+    def __init__(self, dim, hidden_dim):
+        super().__init__()
+        self.gate_up_proj = nn.Linear(dim, hidden_dim * 2, bias=False)
+        self.down_proj = nn.Linear(hidden_dim, dim, bias=False)
+
+    def forward(self, x):
+        gate, up = self.gate_up_proj(x).chunk(2, dim=-1)
+        return self.down_proj(F.silu(gate) * up)
+
+
+# fused projection -> the LlamaDecoderLayer projections it concatenates along the output features
+LLAMA_FUSED_PROJECTIONS = {
+    "self_attn.qkv_proj": ("self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj"),
+    "mlp.gate_up_proj": ("mlp.gate_proj", "mlp.up_proj"),
+}
+
+
+def remap_llama_layer_keys(state_dict, prefix=""):
+    """Fuse the projections of a LlamaDecoderLayer state dict in place, for LlamaBlock."""
+    for fused, parts in LLAMA_FUSED_PROJECTIONS.items():
+        # int8 weights and their per-channel scales concatenate like float weights
+        for suffix in ("weight", "weight_int8", "weight_scale", "bias"):
+            keys = [f"{prefix}{part}.{suffix}" for part in parts]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}{fused}.{suffix}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+    return state_dict
+
+
+class LlamaBlock(nn.Module):
+    def __init__(self, dim, heads, ff_mult=4, eps=1e-6):
+        super().__init__()
+        self.input_layernorm = RMSNorm(dim, eps=eps)
+        self.self_attn = FusedSelfAttention(dim, heads)
+        self.post_attention_layernorm = RMSNorm(dim, eps=eps)
+        self.mlp = SwiGLUFeedForward(dim, dim * ff_mult)
+
+    def forward(self, x, rotary_embed, attention_mask=None, query_chunk_size=None):
+        x = x + self.self_attn(self.input_layernorm(x), rotary_embed, attention_mask, query_chunk_size)
+        x = x + self.mlp(self.post_attention_layernorm(x))
+        return x
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_llama_layer_keys(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
 class DiTBlock(nn.Module):
     def __init__(self, dim, heads, dim_head, ff_mult=4, dropout=0.1, use_style_prompt=False):
         super().__init__()
@@ -617,44 +742,3 @@ class TimestepEmbedding(nn.Module):
         time_hidden = time_hidden.to(timestep.dtype)
         time = self.time_mlp(time_hidden)  # b d
         return time
-
-
-# attention mask realated
-
-
-def _prepare_decoder_attention_mask(attention_mask, input_shape, inputs_embeds):
-    # create noncausal mask
-    # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-    combined_attention_mask = None
-
-    def _expand_mask(
-        mask: torch.Tensor, dtype: torch.dtype, tgt_len: int = None
-    ):
-        """
-        Expands attention_mask from `[bsz, seq_len]` to `[bsz, 1, tgt_seq_len, src_seq_len]`.
-        """
-        bsz, src_len = mask.size()
-        tgt_len = tgt_len if tgt_len is not None else src_len
-
-        expanded_mask = (
-            mask[:, None, None, :].expand(bsz, 1, tgt_len, src_len).to(dtype)
-        )
-
-        inverted_mask = 1.0 - expanded_mask
-
-        return inverted_mask.masked_fill(
-            inverted_mask.to(torch.bool), torch.finfo(dtype).min
-        )
-
-    if attention_mask is not None:
-        # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-        expanded_attn_mask = _expand_mask(
-            attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1]
-        ).to(inputs_embeds.device)
-        combined_attention_mask = (
-            expanded_attn_mask
-            if combined_attention_mask is None
-            else expanded_attn_mask + combined_attention_mask
-        )
-
-    return combined_attention_mask
\ No newline at end of file
@@ -0,0 +1,224 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tensor- and pipeline-parallel DiT inference over torch.distributed.
+
+Each of N processes keeps 1/N of the attention heads and of the MLP hidden
+columns of every DiT block (Megatron-style): the qkv and gate/up projections
+are split along their outputs, the output and down projections along their
+inputs, and the partial outputs are summed with one all-reduce after the
+attention and one after the MLP. Everything else (embeddings, text fusion,
+output head) is replicated and computed by every rank, so all ranks run the
+same sampling loop on the same inputs and hold the same result.
+
+    torchrun --nproc_per_node 2 infer/infer.py ... --tensor-parallel
+
+In pipeline-parallel mode each process instead holds a contiguous range of
+the DiT blocks and nothing of the others, for devices that cannot hold the
+whole model. The batch is split into micro-batches (the two CFG branches of a
+batched guidance step by default) that flow from stage to stage with
+point-to-point sends, so stage k works on one micro-batch while stage k+1
+works on the previous one. The last stage broadcasts the DiT output to all
+ranks; the embeddings and output head stay replicated as above.
+
+    torchrun --nproc_per_node 2 infer/infer.py ... --pipeline-parallel
+
+Works with the NCCL backend on GPUs (one device per rank) and with gloo on
+CPU, see infer/parallel_benchmark.py for a local multi-process check.
+"""
+
+from __future__ import annotations
+
+import os
+import random
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+from model.modules import FusedSelfAttention, LlamaBlock, SwiGLUFeedForward
+from model.quantization import Int8Linear
+
+
+def init_distributed(backend=None):
+    """Join the process group described by the torchrun environment, returns (rank, world size, device)."""
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if backend == "nccl":
+        local_rank = int(os.environ.get("LOCAL_RANK", rank))
+        torch.cuda.set_device(local_rank)
+        device = f"cuda:{local_rank}"
+    else:
+        device = "cpu"
+    return rank, world_size, device
+
+
+def sync_seed():
+    """Seed every rank with the seed drawn by rank 0, so the sampling noise is the same on all ranks."""
+    seed = [random.randrange(2**31) if dist.get_rank() == 0 else None]
+    dist.broadcast_object_list(seed, src=0)
+    torch.manual_seed(seed[0])
+    return seed[0]
+
+
+@torch.no_grad()
+def shard_linear(linear, rows=None, cols=None):
+    # the given output rows / input columns of a linear layer, float or int8 (per output channel scales)
+    assert linear.bias is None or cols is None, "a bias would be added once per rank"
+    if isinstance(linear, Int8Linear):
+        weight = linear.weight_int8
+    else:
+        weight = linear.weight
+    if rows is not None:
+        weight = weight[rows]
+    if cols is not None:
+        weight = weight[:, cols]
+    out_features, in_features = weight.shape
+    has_bias = linear.bias is not None
+
+    if isinstance(linear, Int8Linear):
+        module = Int8Linear(in_features, out_features, bias=has_bias)
+        module.weight_int8 = weight.contiguous()
+        module.weight_scale = linear.weight_scale[rows] if rows is not None else linear.weight_scale.clone()
+        if has_bias:
+            module.bias = linear.bias[rows] if rows is not None else linear.bias.clone()
+        return module
+
+    module = nn.Linear(in_features, out_features, bias=has_bias, device=weight.device, dtype=weight.dtype)
+    module.weight.copy_(weight)
+    if has_bias:
+        module.bias.copy_(linear.bias[rows] if rows is not None else linear.bias)
+    return module
+
+
+class ShardedSelfAttention(FusedSelfAttention):
+    """FusedSelfAttention over the heads of one rank, the output projection is summed over the ranks."""
+
+    def __init__(self, attn: FusedSelfAttention, rank, world_size, group=None):
+        nn.Module.__init__(self)
+        assert attn.heads % world_size == 0, f"{attn.heads} heads do not split over {world_size} ranks"
+        self.heads = attn.heads // world_size
+        self.dim_head = attn.dim_head
+        self.group = group
+
+        dim = attn.heads * attn.dim_head
+        local = torch.arange(rank * self.heads * self.dim_head, (rank + 1) * self.heads * self.dim_head)
+        # q, k and v rows of this rank's heads, in the fused [q; k; v] layout
+        self.qkv_proj = shard_linear(attn.qkv_proj, rows=torch.cat((local, local + dim, local + 2 * dim)))
+        self.o_proj = shard_linear(attn.o_proj, cols=local)
+
+    def forward(self, x, rotary_embed, attention_mask=None, query_chunk_size=None):
+        out = super().forward(x, rotary_embed, attention_mask, query_chunk_size)
+        dist.all_reduce(out, group=self.group)
+        return out
+
+
+class ShardedFeedForward(SwiGLUFeedForward):
+    """SwiGLUFeedForward over the hidden columns of one rank, the down projection is summed over the ranks."""
+
+    def __init__(self, mlp: SwiGLUFeedForward, rank, world_size, group=None):
+        nn.Module.__init__(self)
+        hidden = mlp.down_proj.in_features
+        assert hidden % world_size == 0, f"{hidden} hidden features do not split over {world_size} ranks"
+        self.group = group
+
+        size = hidden // world_size
+        local = torch.arange(rank * size, (rank + 1) * size)
+        # gate and up rows of this rank's columns, in the fused [gate; up] layout
+        self.gate_up_proj = shard_linear(mlp.gate_up_proj, rows=torch.cat((local, local + hidden)))
+        self.down_proj = shard_linear(mlp.down_proj, cols=local)
+
+    def forward(self, x):
+        out = super().forward(x)
+        dist.all_reduce(out, group=self.group)
+        return out
+
+
+def shard_dit(dit, group=None):
+    """Shard the blocks of a DiT in place over the ranks of `group`, the other weights stay replicated."""
+    rank, world_size = dist.get_rank(group), dist.get_world_size(group)
+    for block in dit.transformer_blocks:
+        assert isinstance(block, LlamaBlock)
+        block.self_attn = ShardedSelfAttention(block.self_attn, rank, world_size, group)
+        block.mlp = ShardedFeedForward(block.mlp, rank, world_size, group)
+    return dit
+
+
+def pipeline_dit(dit, micro_batches=2, group=None):
+    """Keep only this rank's contiguous range of the DiT blocks, the forward then runs as a pipeline over `group`.
+
+    Call before loading the checkpoint (non-strict) to never allocate the other stages' blocks.
+    """
+    rank, world_size = dist.get_rank(group), dist.get_world_size(group)
+    assert dit.depth >= world_size, f"{dit.depth} blocks do not split over {world_size} stages"
+    start, end = rank * dit.depth // world_size, (rank + 1) * dit.depth // world_size
+    for i in range(dit.depth):
+        if not start <= i < end:
+            # placeholders keep the global block indices, so the checkpoint keys of this stage still match
+            dit.transformer_blocks[i] = nn.Identity()
+    ranks = dist.get_process_group_ranks(group) if group is not None else list(range(world_size))
+    dit.pipeline = dict(
+        blocks=(start, end), micro_batches=micro_batches, group=group, rank=rank, ranks=ranks,
+        last=rank == world_size - 1,
+    )
+    return dit
+
+
+def pipeline_blocks(dit, x, cache, query_chunk_size=None):
+    # -> output of the last block on the last stage, the unchanged input elsewhere, which DiT.forward
+    # does not use further (see pipeline_output)
+    stage = dit.pipeline
+    start, end = stage["blocks"]
+    rank, ranks, group = stage["rank"], stage["ranks"], stage["group"]
+    first, last = rank == 0, stage["last"]
+
+    rotary_embed, attention_mask = cache["rotary_embed"], cache["attention_mask"]
+    micro_batches = x.tensor_split(min(stage["micro_batches"], x.shape[0]))
+
+    outputs, sends, row = [], [], 0
+    for micro_batch in micro_batches:
+        rows = slice(row, row + micro_batch.shape[0])
+        row = rows.stop
+        if first:
+            h = micro_batch
+        else:
+            h = torch.empty_like(micro_batch)
+            dist.recv(h, src=ranks[rank - 1], group=group)
+        mask = attention_mask[rows] if attention_mask is not None else None
+        for i in range(start, end):
+            h = dit.transformer_blocks[i](h, rotary_embed, attention_mask=mask, query_chunk_size=query_chunk_size)
+            if i < dit.depth // 2:
+                h = h + cache["text_residuals"][i][rows]
+        if last:
+            outputs.append(h)
+        else:
+            # asynchronous, this stage goes on with the next micro-batch while the next stage works on this one;
+            # the tensor is kept referenced until the send completes
+            h = h.contiguous()
+            sends.append((dist.isend(h, dst=ranks[rank + 1], group=group), h))
+    for send, _ in sends:
+        send.wait()
+    return torch.cat(outputs) if last else x
+
+
+def pipeline_output(dit, output):
+    # the DiT output of the last stage on every rank, it is much smaller than the hidden state;
+    # `output` is the receive buffer on the other ranks
+    stage = dit.pipeline
+    output = output.contiguous()
+    dist.broadcast(output, src=stage["ranks"][-1], group=stage["group"])
+    return output
@@ -0,0 +1,101 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" INT8 weight quantization of the DiT linear layers for inference.
+
+Weights are stored as int8 with one scale per output channel. On CPU the
+matmul runs on the int8 GEMM kernels of the quantized engine (fbgemm / onednn)
+with activations quantized on the fly, elsewhere the weight is dequantized
+to the activation dtype.
+"""
+
+from __future__ import annotations
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+class Int8Linear(nn.Module):
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight_int8", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.ones(out_features))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+        self._packed = None  # (weight_int8 version, prepacked weight) for the CPU kernel
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear: nn.Linear):
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        weight = linear.weight.float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        module.weight_int8.copy_(torch.round(weight / scale[:, None]).clamp(-127, 127))
+        module.weight_scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.float())
+        return module.to(linear.weight.device)
+
+    def dequantize(self, dtype=torch.float32):
+        return self.weight_int8.to(dtype) * self.weight_scale.to(dtype)[:, None]
+
+    def _prepacked(self):
+        key = (self.weight_int8.data_ptr(), self.weight_int8._version, self.weight_scale._version)
+        if self._packed is None or self._packed[0] != key:
+            qweight = torch._make_per_channel_quantized_tensor(
+                self.weight_int8.cpu(),
+                self.weight_scale.cpu().double(),
+                torch.zeros(self.out_features, dtype=torch.long),
+                0,
+            )
+            bias = self.bias.float() if self.bias is not None else None
+            self._packed = (key, torch.ops.quantized.linear_prepack(qweight, bias))
+        return self._packed[1]
+
+    def forward(self, x):
+        if x.device.type == "cpu":
+            return torch.ops.quantized.linear_dynamic(x.float(), self._prepacked()).to(x.dtype)
+        out = F.linear(x, self.weight_int8.to(x.dtype)) * self.weight_scale.to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+def quantized_linear_names(dit):
+    """Linear layers that are quantized: attention, MLP, text fusion and output projection."""
+    names = []
+    for name, module in dit.named_modules():
+        if not isinstance(module, nn.Linear):
+            continue
+        if name.startswith(("transformer_blocks.", "text_fusion_linears.")) or name == "proj_out":
+            names.append(name)
+    return names
+
+
+def quantize_dit(dit):
+    """Replace the DiT linear layers by Int8Linear in place, converting their weights."""
+    for name in quantized_linear_names(dit):
+        parent_name, _, child_name = name.rpartition(".")
+        parent = dit.get_submodule(parent_name) if parent_name else dit
+        setattr(parent, child_name, Int8Linear.from_linear(getattr(parent, child_name)))
+    return dit
+
+
+def is_quantized(module):
+    return any(isinstance(m, Int8Linear) for m in module.modules())
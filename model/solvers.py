@@ -0,0 +1,194 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" ODE solvers and timestep schedules for flow matching sampling.
+
+A solver integrates dy/dt = fn(t, y) from t[0] to t[-1] and returns the final
+state, plus the stacked intermediate states when `return_trajectory` is set.
+A schedule maps `steps` grid points onto [t_start, 1].
+"""
+
+from __future__ import annotations
+import math
+
+import torch
+
+
+# timestep schedules, u in [0, 1] -> t in [0, 1]
+
+
+def linear_schedule(u):
+    return u
+
+
+def cosine_schedule(u):
+    # denser near noise (t = 0)
+    return 1 - torch.cos(torch.pi / 2 * u)
+
+
+def logit_normal_schedule(u, eps=1e-3):
+    # quantiles of sigmoid(N(0, 1)), the time distribution used in training
+    t = torch.sigmoid(math.sqrt(2) * torch.erfinv(2 * u.clamp(eps, 1 - eps) - 1))
+    t = (t - t[0]) / (t[-1] - t[0])
+    return t
+
+
+SCHEDULES = {
+    "linear": linear_schedule,
+    "cosine": cosine_schedule,
+    "logit_normal": logit_normal_schedule,
+}
+
+
+def get_timesteps(schedule, steps, t_start=0.0, sway_sampling_coef=None, device=None, dtype=None):
+    if schedule == "linear":
+        t = torch.linspace(t_start, 1, steps, device=device, dtype=dtype)
+    else:
+        u = torch.linspace(0, 1, steps, device=device)
+        t = (t_start + (1 - t_start) * SCHEDULES[schedule](u)).to(dtype)
+    if sway_sampling_coef is not None:
+        t = t + sway_sampling_coef * (torch.cos(torch.pi / 2 * t) - 1 + t)
+    return t
+
+
+# fixed-step solvers, one or two model evaluations per interval
+
+
+def _finish(y, trajectory):
+    return y, torch.stack(trajectory) if trajectory is not None else None
+
+
+def euler_solver(fn, y0, t, return_trajectory=False):
+    y = y0
+    trajectory = [y0] if return_trajectory else None
+    for t_cur, t_next in zip(t[:-1], t[1:]):
+        y = y + (t_next - t_cur) * fn(t_cur, y)
+        if return_trajectory:
+            trajectory.append(y)
+    return _finish(y, trajectory)
+
+
+def midpoint_solver(fn, y0, t, return_trajectory=False):
+    y = y0
+    trajectory = [y0] if return_trajectory else None
+    for t_cur, t_next in zip(t[:-1], t[1:]):
+        h = t_next - t_cur
+        y_mid = y + h / 2 * fn(t_cur, y)
+        y = y + h * fn(t_cur + h / 2, y_mid)
+        if return_trajectory:
+            trajectory.append(y)
+    return _finish(y, trajectory)
+
+
+def heun_solver(fn, y0, t, return_trajectory=False):
+    y = y0
+    trajectory = [y0] if return_trajectory else None
+    for t_cur, t_next in zip(t[:-1], t[1:]):
+        h = t_next - t_cur
+        v_cur = fn(t_cur, y)
+        v_next = fn(t_next, y + h * v_cur)
+        y = y + h / 2 * (v_cur + v_next)
+        if return_trajectory:
+            trajectory.append(y)
+    return _finish(y, trajectory)
+
+
+def multistep_solver(fn, y0, t, return_trajectory=False):
+    # second order multistep in the style of DPM-Solver++(2M): one model evaluation per
+    # interval, the previous velocity extrapolates the current one over non-uniform steps
+    y = y0
+    trajectory = [y0] if return_trajectory else None
+    v_prev, h_prev = None, None
+    for t_cur, t_next in zip(t[:-1], t[1:]):
+        h = t_next - t_cur
+        v_cur = fn(t_cur, y)
+        if v_prev is None:
+            y = y + h * v_cur
+        else:
+            y = y + h * (v_cur + h / (2 * h_prev) * (v_cur - v_prev))
+        v_prev, h_prev = v_cur, h
+        if return_trajectory:
+            trajectory.append(y)
+    return _finish(y, trajectory)
+
+
+# adaptive solver, error controlled with an embedded euler / heun pair
+
+
+def adaptive_solver(fn, y0, t, return_trajectory=False, rtol=1e-2, atol=1e-2, min_step=0.0, max_evals=256):
+    # t only gives the integration range and the initial step size
+    t_cur, t_end = float(t[0]), float(t[-1])
+    h = float(t[1] - t[0]) if len(t) > 1 else t_end - t_cur
+    y = y0
+    v_cur = None
+    evals = 0
+    trajectory = [y0] if return_trajectory else None
+    while t_cur < t_end - 1e-6:
+        h = min(max(h, min_step), t_end - t_cur)
+        if v_cur is None:  # kept on rejection, the step restarts from the same state
+            v_cur = fn(t.new_tensor(t_cur), y)
+            evals += 1
+        y_euler = y + h * v_cur
+        v_next = fn(t.new_tensor(t_cur + h), y_euler)
+        evals += 1
+        y_heun = y + h / 2 * (v_cur + v_next)
+
+        scale = atol + rtol * torch.maximum(y.abs(), y_heun.abs())
+        err = ((y_heun - y_euler).float() / scale.float()).pow(2).mean().sqrt().item()
+        if err <= 1.0 or h <= min_step or evals >= max_evals:
+            t_cur, y, v_cur = t_cur + h, y_heun, None
+            if return_trajectory:
+                trajectory.append(y)
+        h = h * min(5.0, max(0.2, 0.9 * (err + 1e-10) ** -0.5))
+    return _finish(y, trajectory)
+
+
+# parallel-in-time solver, fixed point iterations over a window of euler steps
+
+
+def picard_solver(fn, y0, t, return_trajectory=False, window=8, tol=1e-3):
+    # ParaDiGMS-style Picard iterations: fn(t[w], y[w ...]) evaluates the states of a window of w
+    # steps in one batched call, and each iteration integrates the window from its first state
+    # with those velocities. States whose update falls below tol (RMS, worst batch row) are final
+    # and the window slides past them; it moves at least one step per iteration, so it never takes
+    # more batched calls than euler takes steps, and with tol=0 it is euler
+    steps = len(t) - 1
+    dt = (t[1:] - t[:-1]).reshape(-1, *([1] * y0.ndim))
+    ys = y0.expand(steps + 1, *y0.shape).clone()  # current guess of every state
+    start = 0  # states up to start are final
+    frontier = 0  # states after frontier were never updated
+    while start < steps:
+        end = min(start + window, steps)
+        if end > frontier:
+            # states new to the window start from the latest guess
+            ys[frontier + 1:end + 1] = ys[frontier]
+            frontier = end
+        v = fn(t[start:end], ys[start:end])
+        new = ys[start] + torch.cumsum(dt[start:end] * v, dim=0)
+        err = (new - ys[start + 1:end + 1]).float().pow(2).flatten(2).mean(-1).sqrt().amax(-1)
+        ys[start + 1:end + 1] = new
+
+        unconverged = (err > tol).nonzero()
+        start += max(1, int(unconverged[0])) if len(unconverged) else end - start
+    return ys[-1], ys if return_trajectory else None
+
+
+SOLVERS = {
+    "euler": euler_solver,
+    "midpoint": midpoint_solver,
+    "heun": heun_solver,
+    "multistep": multistep_solver,
+    "adaptive": adaptive_solver,
+    "picard": picard_solver,
+}
@@ -0,0 +1,194 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Layer-wise weight streaming of the DiT blocks under a memory budget.
+
+As many blocks as fit the budget stay resident on the compute device. The
+weights of the others live in host memory (pinned, for asynchronous copies)
+or memory-mapped from a file, and are copied to the device right before the
+block runs and dropped right after. While block i runs, the next streamed
+block is already being copied on a side CUDA stream, so with enough resident
+blocks in between the copies hide behind the compute. Resident blocks are
+spread between the streamed ones to give every copy that time. On GPUs
+pinned memory is faster than a memory-mapped file, which is not copied
+asynchronously.
+
+On CPU there is no copy: the streamed blocks are read from the memory-mapped
+file in place, the OS pages them in and evicts them under memory pressure,
+and the pages of the next streamed block are read ahead in a thread. Host
+memory would be the same RAM, so without a path the weights are written to a
+temporary file, which is deleted once mapped (or at exit where it can not be).
+
+Embeddings, text fusion and the output head are always resident, the budget
+only covers the blocks. Not compatible with torch.compile, which would
+specialize on the swapped weights. The blocks' weights are swapped in place,
+so forwards of a streamed DiT from several threads run one at a time.
+"""
+
+from __future__ import annotations
+
+import atexit
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def block_tensors(block):
+    # the parameters and buffers of a block, whose .data is swapped while streaming
+    tensors = dict(block.named_parameters())
+    tensors.update((name, buffer) for name, buffer in block.named_buffers() if buffer is not None)
+    return tensors
+
+
+def tensor_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def streamed_blocks(sizes, budget):
+    """Indices of the blocks to stream so that the resident blocks plus two streaming buffers fit `budget` bytes."""
+    if sum(sizes) <= budget:
+        return []
+    buffers = 2 * max(sizes)
+    resident = 0
+    for size in sorted(sizes):
+        if buffers + size > budget:
+            break
+        buffers += size
+        resident += 1
+    # evenly spaced, so every copy overlaps the compute of the resident blocks before it
+    n = len(sizes) - resident
+    return sorted({int(k * len(sizes) / n) for k in range(n)})
+
+
+@torch.no_grad()
+def host_copies(tensors, device, path=None):
+    # name -> host tensor, memory-mapped from `path` (written when missing or stale) or in (pinned) RAM
+    if path is None and torch.device(device).type == "cpu":
+        # in RAM the streamed weights would stay as resident as on the device, map a temporary file
+        fd, path = tempfile.mkstemp(suffix=".pt", prefix="dit_stream_")
+        os.close(fd)
+        torch.save({name: t.detach().cpu() for name, t in tensors.items()}, path)
+        stored = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        try:
+            os.remove(path)  # the mapping keeps the data
+        except OSError:
+            atexit.register(os.remove, path)
+        return stored
+    if path is None:
+        pin = torch.device(device).type == "cuda"
+        return {name: t.detach().cpu().pin_memory() if pin else t.detach().cpu() for name, t in tensors.items()}
+
+    if os.path.exists(path):
+        stored = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        if stored.keys() == tensors.keys() and all(
+            stored[name].shape == t.shape and stored[name].dtype == t.dtype for name, t in tensors.items()
+        ):
+            return stored
+    torch.save({name: t.detach().cpu() for name, t in tensors.items()}, path)
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def read_ahead(tensors):
+    # touch one element per 4 KiB page, so the pages of a memory-mapped block are in RAM when it runs
+    for t in tensors:
+        t.reshape(-1).view(torch.uint8)[::4096].sum()
+
+
+class BlockStreamer:
+    """Copies the weights of the streamed DiT blocks to the device around their forward, see stream_dit."""
+
+    def __init__(self, dit, blocks, device, path=None):
+        self.device = torch.device(device)
+        self.blocks = blocks  # index -> block
+        self.order = sorted(blocks)
+        self.tensors = {i: block_tensors(block) for i, block in blocks.items()}
+        flat = {f"{i}.{name}": t for i, tensors in self.tensors.items() for name, t in tensors.items()}
+        host = host_copies(flat, self.device, path)
+        self.host = {i: {name: host[f"{i}.{name}"] for name in tensors} for i, tensors in self.tensors.items()}
+
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.reader = ThreadPoolExecutor(1) if self.device.type == "cpu" else None
+        self.pending = None  # (block index, device tensors, copy event or read-ahead future)
+        # held for a whole DiT forward: the swapped weights and the prefetch are shared by all callers
+        self.lock = threading.Lock()
+        dit.register_forward_pre_hook(lambda module, args: self.lock.acquire())
+        dit.register_forward_hook(lambda module, args, output: self.lock.release(), always_call=True)
+
+        for i, tensors in self.tensors.items():
+            for t in tensors.values():
+                # the device holds nothing of a streamed block between its calls
+                t.data = torch.empty(0, device=self.device, dtype=t.dtype)
+            self.blocks[i].register_forward_pre_hook(self.pre_hook(i))
+            self.blocks[i].register_forward_hook(self.post_hook(i), always_call=True)
+
+    def fetch(self, i):
+        host = list(self.host[i].values())
+        if self.device.type == "cpu":
+            return i, host, self.reader.submit(read_ahead, host)
+        if self.stream is None:
+            return i, [h.to(self.device) for h in host], None
+        with torch.cuda.stream(self.stream):
+            tensors = [h.to(self.device, non_blocking=True) for h in host]
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return i, tensors, event
+
+    def pre_hook(self, i):
+        def hook(module, args):
+            if self.pending is not None and self.pending[0] == i:
+                _, tensors, ready = self.pending
+            else:
+                _, tensors, ready = self.fetch(i)
+            if self.stream is not None:
+                current = torch.cuda.current_stream(self.device)
+                current.wait_event(ready)
+                for t in tensors:
+                    # the copies were allocated on the side stream but are used and freed on this one
+                    t.record_stream(current)
+            for t, data in zip(self.tensors[i].values(), tensors):
+                t.data = data
+            # prefetch the next streamed block while this one runs
+            self.pending = self.fetch(self.order[(self.order.index(i) + 1) % len(self.order)])
+        return hook
+
+    def post_hook(self, i):
+        def hook(module, args, output):
+            for t in self.tensors[i].values():
+                t.data = torch.empty(0, device=self.device, dtype=t.dtype)
+            for m in module.modules():
+                if getattr(m, "_packed", None) is not None:
+                    m._packed = None  # the prepacked int8 weights are a copy of the streamed ones
+        return hook
+
+
+def stream_dit(dit, device, budget=0, path=None):
+    """Stream the DiT blocks that do not fit `budget` bytes of block weights on `device`.
+
+    The DiT should be on the CPU, the streamed blocks' weights are moved to host memory
+    (or to a memory-mapped file at `path`, on a CPU device a temporary one when no path
+    is given) and the rest is moved to `device`. A budget of 0
+    streams every block. Returns the BlockStreamer, or None when all blocks fit.
+    """
+    sizes = [tensor_bytes(block_tensors(block).values()) for block in dit.transformer_blocks]
+    # placeholder blocks of other pipeline stages hold no weights and take no part in the budget
+    real = [i for i, size in enumerate(sizes) if size > 0]
+    indices = [real[k] for k in streamed_blocks([sizes[i] for i in real], budget)] if real else []
+    streamer = None
+    if indices:
+        streamer = BlockStreamer(dit, {i: dit.transformer_blocks[i] for i in indices}, device, path)
+    dit.to(device)
+    return streamer
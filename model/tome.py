@@ -0,0 +1,108 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Inference-time token merging (ToMe) around the DiT blocks.
+
+Before a block, a fraction of the frames is merged (averaged) into the adjacent
+frame it is most similar to, the block runs on the shorter sequence, and every
+merged frame then receives the update of the frame it was merged into, so the
+residual stream is full length again between blocks. Matching is local: each
+even frame may merge into one of its odd neighbours. That keeps the matching
+linear in the sequence length and fits audio latents, where the redundancy is
+between adjacent frames (sustained notes, silence). Protected frames (lyric
+tokens, padding) neither merge nor absorb other frames.
+"""
+
+from __future__ import annotations
+
+import torch
+import torch.nn.functional as F
+
+
+def merge_ratios(ratio, depth):
+    # one ratio (or a single-item list) for all blocks, or one per block (missing trailing blocks do not merge)
+    if ratio is None:
+        return None
+    if isinstance(ratio, (int, float)):
+        ratio = [ratio]
+    ratios = [float(r) for r in ratio]
+    if len(ratios) == 1:
+        return ratios * depth
+    assert len(ratios) <= depth, "more merge ratios than blocks"
+    return ratios + [0.0] * (depth - len(ratios))
+
+
+def merge_plan(x: float["b n d"], ratio: float, protected: bool["b n"]):  # noqa: F722
+    # -> (keep [b m], src [b r], dst [b r]) frame indices, or None when nothing can merge;
+    # r = ratio * n frames merge, fewer if a row has fewer mergeable pairs (at most every even frame)
+    batch, n = x.shape[:2]
+    r = int(ratio * n)
+    if r <= 0 or n < 2:
+        return None
+
+    metric = F.normalize(x, dim=-1)
+    src = torch.arange(0, n, 2, device=x.device)
+    left, right = (src - 1).clamp(min=0), (src + 1).clamp(max=n - 1)
+    sim_left = (metric[:, src] * metric[:, left]).sum(-1).float()
+    sim_right = (metric[:, src] * metric[:, right]).sum(-1).float()
+    sim_left = sim_left.masked_fill(protected[:, src] | protected[:, left] | (src == 0), -torch.inf)
+    sim_right = sim_right.masked_fill(protected[:, src] | protected[:, right] | (src + 1 >= n), -torch.inf)
+
+    score = torch.maximum(sim_left, sim_right)
+    dst = torch.where(sim_right >= sim_left, right, left).expand(batch, -1)
+    r = min(r, int(torch.isfinite(score).sum(-1).min()))
+    if r <= 0:
+        return None
+
+    order = score.argsort(dim=-1, descending=True)[:, :r]
+    src_idx, dst_idx = src[order], dst.gather(1, order)
+    merged = torch.zeros(batch, n, dtype=torch.bool, device=x.device).scatter_(1, src_idx, True)
+    # the kept frames in their original order
+    keep = torch.argsort(merged.to(torch.uint8), dim=-1, stable=True)[:, :n - r]
+    return keep, src_idx, dst_idx
+
+
+def _expand(index, dim):
+    return index[..., None].expand(-1, -1, dim)
+
+
+def merge(x: float["b n d"], plan):  # noqa: F722
+    # average each merged frame into its destination, keep the others: [b m d]
+    keep, src, dst = plan
+    dim = x.shape[-1]
+    sums = x.scatter_add(1, _expand(dst, dim), x.gather(1, _expand(src, dim)))
+    counts = torch.ones_like(x[..., :1]).scatter_add(1, dst[..., None], torch.ones_like(src[..., None], dtype=x.dtype))
+    return (sums / counts).gather(1, _expand(keep, dim))
+
+
+def unmerge(x: float["b n d"], update: float["b m d"], plan):  # noqa: F722
+    # add the block's update of the kept frames, merged frames get the update of their destination
+    keep, src, dst = plan
+    dim = x.shape[-1]
+    full = torch.zeros_like(x).scatter(1, _expand(keep, dim), update)
+    full = full.scatter(1, _expand(src, dim), full.gather(1, _expand(dst, dim)))
+    return x + full
+
+
+def merge_rotary(rotary_embed, keep):
+    # positions of the kept frames, [1 n d] tables -> [b m d]
+    cos, sin = rotary_embed
+    return cos[0][keep], sin[0][keep]
+
+
+def merge_attention_mask(attention_mask, keep):
+    # [b 1 1 n] key padding mask -> [b 1 1 m]
+    if attention_mask is None:
+        return None
+    return attention_mask.expand(keep.shape[0], -1, -1, -1).gather(-1, keep[:, None, None, :])
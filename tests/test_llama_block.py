@@ -0,0 +1,60 @@
+import torch
+import torch.nn.functional as F
+
+from model.modules import LlamaBlock, rotary_tables
+
+
+def baseline_state_dict(dim, hidden, generator):
+    # the separate projections of the LlamaDecoderLayer the released checkpoints were saved from
+    def weight(*shape):
+        return torch.randn(*shape, generator=generator) * 0.05
+
+    return {
+        "input_layernorm.weight": 1 + weight(dim),
+        "self_attn.q_proj.weight": weight(dim, dim),
+        "self_attn.k_proj.weight": weight(dim, dim),
+        "self_attn.v_proj.weight": weight(dim, dim),
+        "self_attn.o_proj.weight": weight(dim, dim),
+        "post_attention_layernorm.weight": 1 + weight(dim),
+        "mlp.gate_proj.weight": weight(hidden, dim),
+        "mlp.up_proj.weight": weight(hidden, dim),
+        "mlp.down_proj.weight": weight(dim, hidden),
+    }
+
+
+def baseline_forward(state, x, heads, cos, sin, eps=1e-6):
+    def rms_norm(h, weight):
+        return weight * h * torch.rsqrt(h.pow(2).mean(-1, keepdim=True) + eps)
+
+    def rope(h):
+        h1, h2 = h.chunk(2, dim=-1)
+        return h * cos[:, None] + torch.cat((-h2, h1), dim=-1) * sin[:, None]
+
+    batch, n, dim = x.shape
+    h = rms_norm(x, state["input_layernorm.weight"])
+    q, k, v = (
+        F.linear(h, state[f"self_attn.{name}_proj.weight"]).view(batch, n, heads, -1).transpose(1, 2)
+        for name in "qkv"
+    )
+    scores = rope(q) @ rope(k).transpose(-1, -2) / (dim // heads) ** 0.5
+    attn = (scores.softmax(-1) @ v).transpose(1, 2).reshape(batch, n, dim)
+    x = x + F.linear(attn, state["self_attn.o_proj.weight"])
+    h = rms_norm(x, state["post_attention_layernorm.weight"])
+    gate, up = F.linear(h, state["mlp.gate_proj.weight"]), F.linear(h, state["mlp.up_proj.weight"])
+    return x + F.linear(F.silu(gate) * up, state["mlp.down_proj.weight"])
+
+
+def test_baseline_block_state_dict_loads_into_llama_block():
+    dim, heads, ff_mult = 64, 4, 2
+    generator = torch.Generator().manual_seed(0)
+    state = baseline_state_dict(dim, dim * ff_mult, generator)
+
+    block = LlamaBlock(dim, heads, ff_mult=ff_mult).eval()
+    block.load_state_dict(dict(state))  # strict: every baseline key is remapped, nothing is left out
+
+    x = torch.randn(2, 16, dim, generator=generator)
+    cos, sin = rotary_tables(dim // heads, 16)
+    with torch.inference_mode():
+        out = block(x, (cos, sin))
+        reference = baseline_forward(state, x, heads, cos, sin)
+    torch.testing.assert_close(out, reference, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,53 @@
+import torch
+from torch import nn
+
+import model.parallel
+from model import DiT
+from model.parallel import pipeline_dit
+from model.streaming import block_tensors, stream_dit, tensor_bytes
+
+
+def small_dit(depth=8):
+    torch.manual_seed(0)
+    return DiT(dim=64, depth=depth, heads=4, ff_mult=2, mel_dim=8, text_num_embeds=10, text_dim=16, conv_layers=1).eval()
+
+
+def block_bytes(dit):
+    return [tensor_bytes(block_tensors(block).values()) for block in dit.transformer_blocks]
+
+
+def test_pipeline_stage_stays_within_budget(monkeypatch, tmp_path):
+    # the second of two pipeline stages, without a process group
+    monkeypatch.setattr(model.parallel.dist, "get_rank", lambda group=None: 1)
+    monkeypatch.setattr(model.parallel.dist, "get_world_size", lambda group=None: 2)
+    dit = pipeline_dit(small_dit())
+    assert all(isinstance(block, nn.Identity) for block in dit.transformer_blocks[:4])
+
+    block = max(block_bytes(dit))
+    budget = int(3.5 * block)
+    streamer = stream_dit(dit, "cpu", budget=budget, path=str(tmp_path / "stream.pt"))
+
+    resident = sum(block_bytes(dit))
+    assert resident + 2 * block <= budget
+    assert len(streamer.blocks) == 3 and all(i >= 4 for i in streamer.blocks)
+
+
+def test_streamed_output_matches_resident(tmp_path):
+    dit = small_dit(depth=4)
+    batch, n = 2, 16
+    inputs = dict(
+        x=torch.randn(batch, n, 8),
+        cond=torch.randn(batch, n, 8),
+        text=torch.randint(0, 10, (batch, n)),
+        time=torch.rand(batch),
+        drop_audio_cond=False,
+        drop_text=False,
+        style_prompt=torch.randn(batch, 512),
+        start_time=torch.zeros(batch),
+    )
+    with torch.inference_mode():
+        reference = dit(**inputs)
+        stream_dit(dit, "cpu", budget=0, path=str(tmp_path / "stream.pt"))
+        assert sum(block_bytes(dit)) == 0
+        out = dit(**inputs)
+    torch.testing.assert_close(out, reference)